@@ -0,0 +1,24 @@
+"""Fact version counter, for invalidating in-memory fact caches.
+
+Revision ID: 3f1d6c2a9e47
+Revises: 2926c3520001
+Create Date: 2017-06-02 18:12:40.512311
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1d6c2a9e47'
+down_revision = '2926c3520001'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('status', sa.Column('facts_version', sa.Integer, nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('status', 'facts_version')
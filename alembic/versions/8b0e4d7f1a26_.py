@@ -0,0 +1,50 @@
+"""Indexes for fact search.
+
+Revision ID: 8b0e4d7f1a26
+Revises: 3f1d6c2a9e47
+Create Date: 2017-06-09 21:40:13.208455
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8b0e4d7f1a26'
+down_revision = '3f1d6c2a9e47'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def trigram_available(conn):
+    """
+    Returns True if pg_trgm is installed, or could be installed and was.  Creating an extension needs privileges the
+    bot's role may not have (or, before PostgreSQL 13, superuser), so it is tried in a savepoint and failure is not fatal.
+    """
+    if conn.execute(sa.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar():
+        return True
+    if not conn.execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar():
+        return False
+    savepoint = conn.begin_nested()
+    try:
+        conn.execute(sa.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except sa.exc.DBAPIError as ex:
+        savepoint.rollback()
+        print("Unable to create the pg_trgm extension, skipping trigram indexes: " + str(ex.orig).strip())
+        return False
+    savepoint.commit()
+    return True
+
+
+def upgrade():
+    # Full text search over messages.  'simple' since facts come in many languages.
+    op.execute("CREATE INDEX fact_message_fts_ix ON fact USING gin (to_tsvector('simple', message))")
+
+    # Trigram matching on names needs pg_trgm, which may not be available.  The bot falls back to searching in memory.
+    if trigram_available(op.get_bind()):
+        op.execute("CREATE INDEX fact_name_trgm_ix ON fact USING gin (name gin_trgm_ops)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS fact_name_trgm_ix")
+    op.execute("DROP INDEX IF EXISTS fact_message_fts_ix")
@@ -0,0 +1,46 @@
+"""Trigram index for local starsystem name search.
+
+Revision ID: c4a7e2d95b13
+Revises: 8b0e4d7f1a26
+Create Date: 2017-06-14 19:02:51.733120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4a7e2d95b13'
+down_revision = '8b0e4d7f1a26'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def trigram_available(conn):
+    """
+    Returns True if pg_trgm is installed, or could be installed and was.  Creating an extension needs privileges the
+    bot's role may not have (or, before PostgreSQL 13, superuser), so it is tried in a savepoint and failure is not fatal.
+    """
+    if conn.execute(sa.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar():
+        return True
+    if not conn.execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar():
+        return False
+    savepoint = conn.begin_nested()
+    try:
+        conn.execute(sa.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except sa.exc.DBAPIError as ex:
+        savepoint.rollback()
+        print("Unable to create the pg_trgm extension, skipping trigram indexes: " + str(ex.orig).strip())
+        return False
+    savepoint.commit()
+    return True
+
+
+def upgrade():
+    # Without pg_trgm, local system search is unavailable and !search relies on the Systems API alone.
+    if trigram_available(op.get_bind()):
+        op.execute("CREATE INDEX starsystem_name_trgm_ix ON starsystem USING gin (name_lower gin_trgm_ops)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS starsystem_name_trgm_ix")
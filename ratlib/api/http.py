@@ -208,9 +208,10 @@ class ShortenerError(ValueError):
 
 
 class Shortener:
-    def __init__(self, url, token):
+    def __init__(self, url, token, timeout=10):
         self.url = url
         self.token = token
+        self.timeout = timeout
 
     def shorten(self, url, keyword=None):
         params = {
@@ -223,7 +224,7 @@ class Shortener:
         if keyword:
             params['keyword'] = keyword
 
-        response = requests.get(self.url, params=params)
+        response = requests.get(self.url, params=params, timeout=self.timeout)
         response.raise_for_status()
         data = response.json()
 
@@ -14,6 +14,7 @@ import ratlib.api.http
 import functools
 from sopel.module import NOLIMIT
 from enum import Enum
+from ratlib.replication import is_leader
 
 class Permissions(Enum):
     recruit = (0, None)
@@ -259,7 +260,8 @@ def require_permission(privilage:Permissions, message =''):
     def actual_decorator(function):
         @functools.wraps(function)
         def guarded(bot, trigger, *args, **kwargs):
-
+            if not is_leader(bot):
+                return NOLIMIT  # Another instance is answering.
             if getPrivLevel(trigger)<privilage.value[0]:
                 if message and not callable(message):
                     bot.say(message)
@@ -0,0 +1,214 @@
+"""
+quotes.py - Compact storage for rescue quotes.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+
+import datetime
+import functools
+import iso8601
+
+from ratlib.api.props import EventEmitter, InstrumentedList, InstrumentedProperty
+
+
+__all__ = ['Quote', 'QuoteList', 'QuoteDelta', 'QuoteListProperty', 'parse_timestamp', 'dump_timestamp']
+
+
+UTC = datetime.timezone.utc
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(value):
+    """
+    Parses an API timestamp.  Memoized, since refreshes hand us the same timestamps over and over again.
+
+    :param value: ISO 8601 string, datetime or None.
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return iso8601.parse_date(value, UTC)
+
+
+def dump_timestamp(value):
+    """
+    Formats a datetime the same way as timeutil.utc_now_tz()
+    """
+    if value is None:
+        return None
+    return value.astimezone(UTC).isoformat().replace('+00:00', 'Z')
+
+
+class Quote:
+    """
+    A single line of a rescue's quotes.  Timestamps are stored as parsed datetimes.
+
+    Supports read-only dict-style access (quote['message']) for compatibility with code expecting the API format.
+    """
+    __slots__ = ('message', 'author', 'lastAuthor', 'createdAt', 'updatedAt')
+
+    def __init__(self, message, author=None, lastAuthor=None, createdAt=None, updatedAt=None):
+        self.message = message
+        self.author = author
+        self.lastAuthor = lastAuthor
+        self.createdAt = parse_timestamp(createdAt)
+        self.updatedAt = parse_timestamp(updatedAt)
+
+    @classmethod
+    def load(cls, json):
+        """
+        Creates a Quote from its API representation.  Quotes are returned unchanged.
+        """
+        if isinstance(json, cls):
+            return json
+        return cls(
+            json.get('message'), json.get('author'), json.get('lastAuthor'), json.get('createdAt'), json.get('updatedAt')
+        )
+
+    @classmethod
+    def create(cls, message, author):
+        """
+        Creates a new quote timestamped now.
+        """
+        now = datetime.datetime.now(tz=UTC)
+        return cls(message, author, author, now, now)
+
+    def edit(self, message, author):
+        """
+        Returns a copy of this quote with a new message, keeping the original author and creation time.
+        """
+        return type(self)(message, self.author, author, self.createdAt, datetime.datetime.now(tz=UTC))
+
+    def dump(self):
+        """
+        Returns the API representation of this quote.
+        """
+        return {
+            'message': self.message, 'author': self.author, 'lastAuthor': self.lastAuthor,
+            'createdAt': dump_timestamp(self.createdAt), 'updatedAt': dump_timestamp(self.updatedAt)
+        }
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Quote):
+            return NotImplemented
+        return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+
+    def __repr__(self):
+        return "<{0.__class__.__name__}({0.author!r}, {0.message!r})>".format(self)
+
+
+class QuoteList(InstrumentedList):
+    """
+    InstrumentedList of Quotes that only keeps the most recent MAX_QUOTES in memory.
+
+    'offset' is the number of older quotes that were dropped (and still exist on the API), so the quote at index ix in
+    this list is line number ix + offset of the case.
+    """
+    MAX_QUOTES = 100
+    _default = object()
+
+    def __init__(self, iterable=(), offset=0, maxlen=_default):
+        """
+        :param iterable: Quotes, either as Quote objects or in API format.
+        :param offset: Number of older quotes that are not included.
+        :param maxlen: Maximum number of quotes to hold, or None for no limit.  Defaults to MAX_QUOTES.
+        """
+        super().__init__(Quote.load(quote) for quote in iterable)
+        self.offset = offset
+        self.maxlen = self.MAX_QUOTES if maxlen is QuoteList._default else maxlen
+        self._trim()
+
+    def _trim(self):
+        if self.maxlen is None:
+            return
+        excess = len(self) - self.maxlen
+        if excess > 0:
+            list.__delitem__(self, slice(0, excess))  # Not a change to the case, so no notifications.
+            self.offset += excess
+
+    @property
+    def total(self):
+        """Total number of quotes in the case, including ones not held in memory."""
+        return self.offset + len(self)
+
+    def append(self, item):
+        result = super().append(Quote.load(item))
+        self._trim()
+        return result
+
+    def extend(self, items):
+        result = super().extend(Quote.load(item) for item in items)
+        self._trim()
+        return result
+
+    def __setitem__(self, key, value):
+        return super().__setitem__(key, Quote.load(value))
+
+    def merge(self, other):
+        if self.replace:
+            return self
+        if not isinstance(other, QuoteList):
+            other = QuoteList(other)
+        list.clear(self)
+        list.extend(self, other)
+        list.extend(self, self.appends)
+        self.offset = other.offset
+        self.maxlen = self.MAX_QUOTES
+        self._trim()
+        self.commit(EventEmitter.MERGED)
+        return self
+
+    def dump(self):
+        """
+        Returns the API representation of these quotes, or a QuoteDelta if older quotes are not held in memory.
+        """
+        if self.offset:
+            return QuoteDelta(self)
+        return [quote.dump() for quote in self]
+
+
+class QuoteDelta:
+    """
+    Snapshot of pending changes to a QuoteList whose older quotes are not in memory.
+
+    The API needs the complete list, so apply() combines this with the full list of quotes retrieved from it.  Plain
+    additions are appended to whatever the API currently has; anything else replaces the in-memory tail.
+    """
+    __slots__ = ('offset', 'replace', 'appends', 'tail')
+
+    def __init__(self, quotes):
+        self.offset = quotes.offset
+        self.replace = quotes.replace
+        self.appends = [quote.dump() for quote in quotes.appends]
+        self.tail = [quote.dump() for quote in quotes] if quotes.replace else None
+
+    def apply(self, history):
+        """
+        Returns the complete list of quotes to send to the API.
+
+        :param history: The complete list of quotes currently on the API, in API format.
+        """
+        if self.replace:
+            return list(history[:self.offset]) + self.tail
+        return list(history) + self.appends
+
+
+class QuoteListProperty(InstrumentedProperty):
+    """
+    Property holding a QuoteList.
+    """
+    def __init__(self, name=None, default=None, remote_name=None):
+        super().__init__(name, default, remote_name, coerce=QuoteList)
+
+    def dump(self, instance):
+        quotes = self.get(instance)
+        return None if quotes is None else quotes.dump()
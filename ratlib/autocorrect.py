@@ -11,6 +11,9 @@ See LICENSE.md
 import re
 import collections
 import functools
+import itertools
+import threading
+import time
 
 
 class CorrectionResult:
@@ -41,8 +44,18 @@ class CorrectionResult:
         self.corrections = collections.OrderedDict()
         self.matched = 0
         self.fixed = 0
+        if not self.may_match(input):
+            self.output = input
+            return
         self.output = self.regex.sub(self._subfn, input)
 
+    @staticmethod
+    def may_match(input):
+        """
+        Cheap test for whether the regex could possibly match input.  Every system name we correct contains a dash.
+        """
+        return '-' in input
+
     def _subfn(self, match):
         """Performs corrections on patterns"""
         self.matched += 1
@@ -76,14 +89,216 @@ class CorrectionResult:
         return "<{0.__class__.__name__}(matched={0.matched}, fixed={0.fixed}, input={0.input!r}, corrections={0.corrections!r})>".format(self)
 
 
-@functools.lru_cache(typed=True)
+class CorrectionCache:
+    """
+    Bounded LRU cache of CorrectionResults, with hit statistics.
+
+    Lines that cannot match (see CorrectionResult.may_match) are counted as skipped and never cached, so ordinary chat
+    does not push out the lines worth remembering.
+
+    lookup() and store() can be used on their own to cache other values, such as catalogue lookups in
+    ratlib.starsystem.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._results = collections.OrderedDict()
+        self.hits = self.misses = self.skipped = 0
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._results) > max(maxsize, 0):
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = self.misses = self.skipped = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def lookup(self, key):
+        """
+        Returns the value cached for key, or None.  Counts a hit or a miss.
+        """
+        with self._lock:
+            value = self._results.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def store(self, key, value):
+        """
+        Caches value for key, forgetting the least recently used entry if the cache is full.
+        """
+        if self.maxsize > 0:
+            with self._lock:
+                self._results[key] = value
+                if len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+
+    def get(self, input):
+        if not CorrectionResult.may_match(input):
+            with self._lock:
+                self.skipped += 1
+            return CorrectionResult(input)
+        result = self.lookup(input)
+        if result is None:
+            result = CorrectionResult(input)
+            self.store(input, result)
+        return result
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._results), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+            'skipped': self.skipped, 'hit_rate': self.hits / lookups if lookups else None,
+        }
+
+
+cache = CorrectionCache()
+
+
 def correct(input):
-    return CorrectionResult(input)
+    """
+    Returns the CorrectionResult for input.
+    """
+    return cache.get(input)
+
+
+def correct_many(lines):
+    """
+    Returns a list of CorrectionResults, one per line.  Repeated lines are only corrected once.
+    """
+    results = {}
+    return [results[line] if line in results else results.setdefault(line, cache.get(line)) for line in lines]
 
 
 pattern = CorrectionResult.pattern
 regex = CorrectionResult.regex
 
+
+class CandidateSet:
+    """
+    Every plausible reading of one procedurally generated system name in a line, for checking against the catalogue.
+
+    Lookalikes are more generous than CorrectionResult's, since results are checked before being used: each position
+    may take any character that could have been mistyped for something valid there.
+    """
+    # Character as typed -> characters it could stand for.  Valid characters always stand for themselves as well.
+    lookalikes = {
+        'L': {'0': 'do', '1': 'il', '2': 'z', '5': 's', '6': 'g', '7': 't', '8': 'b'},
+        'D': {'o': '0', 'd': '0', 'q': '0', 'i': '1', 'l': '1', 'z': '2', 's': '5', 'g': '6', 't': '7', 'b': '8'},
+    }
+    allowed = {'L': 'a-z', 'D': '0-9'}
+    pattern = (r'\w+\s+(?P<l>LL-L\s+L)(?P<d>D+(?:-D+)?'
+               r')\b')
+    for search, characters in allowed.items():
+        pattern = pattern.replace(search, "[" + characters + "".join(lookalikes[search].keys()) + "]")
+    regex = re.compile("(?i)" + pattern)
+    del search, characters
+
+    MAX_VARIANTS = 64  # Per name; names with more ambiguous characters than this allows are only partly explored.
+    CONTEXT_WORDS = 3  # Sector names have up to this many words before the one the regex matches.
+
+    def __init__(self, line, match):
+        """
+        :param line: Line of text.
+        :param match: Match of CandidateSet.regex against line.
+        """
+        self.match = match
+        self.typed = match.group(0)
+        code_start = match.start('l') - match.start(0)
+        sector = self.typed[:code_start].lower()
+        codes = self.variants(match.group('l'), match.group('d'))
+        self.code = codes[0]
+        self.codes = codes
+        # Longest sector name first, so "Pru Aescs" wins over a system in a hypothetical "Aescs" sector.
+        context = line[:match.start(0)].split()[-self.CONTEXT_WORDS:]
+        self.sectors = [
+            " ".join(word.lower() for word in context[ix:]) + (" " if ix < len(context) else "") + sector
+            for ix in range(len(context) + 1)
+        ]
+        self.names = [sector + code for sector in self.sectors for code in codes]
+
+    @classmethod
+    def variants(cls, letters, digits):
+        """
+        Returns possible readings of the letter and digit parts of a code, lowercased, fewest changes first.
+        The first is always the code as typed.
+        """
+        options = []
+        for kind, text in (('L', letters.lower()), ('D', digits.lower())):
+            table = cls.lookalikes[kind]
+            for ch in text:
+                choices = []
+                if ch == '-' or ch.isspace() or (ch.isdigit() if kind == 'D' else ch.isalpha() and ch.isascii()):
+                    choices.append(ch)
+                choices.extend(c for c in table.get(ch, '') if c not in choices)
+                options.append(choices or [ch])
+        typed = letters.lower() + digits.lower()
+        results = {typed: 0}
+        for combination in itertools.islice(itertools.product(*options), cls.MAX_VARIANTS * 4):
+            variant = "".join(combination)
+            results.setdefault(variant, sum(a != b for a, b in zip(variant, typed)))
+        return sorted(results, key=lambda variant: (results[variant], variant != typed))[:cls.MAX_VARIANTS]
+
+    @classmethod
+    def find_all(cls, line):
+        """
+        Returns a CandidateSet for each possible system name in line.
+        """
+        if not CorrectionResult.may_match(line):
+            return []
+        return [cls(line, match) for match in cls.regex.finditer(line)]
+
+
+def benchmark(lines, repeat=3):
+    """
+    Times correcting every line in lines through the cache, and the way it was done before: no pre-filter, and a
+    128-entry functools.lru_cache.
+
+    Returns a dict with seconds per line for each, and the cache statistics.
+    """
+    lines = list(lines)
+    count = max(len(lines) * repeat, 1)
+
+    class Unfiltered(CorrectionResult):
+        may_match = staticmethod(lambda input: True)
+
+    old = functools.lru_cache(maxsize=128, typed=True)(Unfiltered)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            old(line)
+    before = time.perf_counter() - started
+
+    cache.clear()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            correct(line)
+    cached = time.perf_counter() - started
+    return {'lines': len(lines), 'before': before / count, 'cached': cached / count, 'cache': cache.stats()}
+
+
 if __name__ == '__main__':
-    print(repr(correct("Should trigger correction: Imaginary Sector CX-5 DS-9 Blah blah")))
-    print(repr(correct("Should not trigger correction: Blah Blah Sector DE-F A2-33")))
+    import sys
+
+    if len(sys.argv) > 1:
+        # Benchmark against a channel log, one message per line.
+        with open(sys.argv[1], encoding='utf-8', errors='replace') as f:
+            result = benchmark(line.rstrip('\n') for line in f)
+        print(
+            "{lines} lines: {before_us:.2f} us/line before, {cached_us:.2f} us/line now."
+            .format(before_us=result['before'] * 1e6, cached_us=result['cached'] * 1e6, **result)
+        )
+        print("Cache: {}".format(result['cache']))
+    else:
+        print(repr(correct("Should trigger correction: Imaginary Sector CX-5 DS-9 Blah blah")))
+        print(repr(correct("Should not trigger correction: Blah Blah Sector DE-F A2-33")))
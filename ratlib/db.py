@@ -8,9 +8,18 @@ Licensed under the BSD 3-Clause License.
 
 See LICENSE.md
 """
+import collections
+import contextlib
 import functools
+import hashlib
+import json
+import os
 import re
 import math
+import sys
+import threading
+import time
+import warnings
 
 import sqlalchemy as sa
 from sqlalchemy import sql, orm, schema
@@ -18,11 +27,14 @@ from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
 import alembic.command
 import alembic.config
+import alembic.script
 from ratlib.exttypes import SQLPoint, Point
+from ratlib.sqlprofile import QueryProfiler
+from ratlib.util import timed
 
 
 __all__ = [
-    'setup', 'get_session', 'with_session',
+    'setup', 'shutdown', 'upgrade_schema', 'get_session', 'session_scope', 'with_session', 'SessionTracker',
     'Base', 'Fact', 'Status', 'StarsystemPrefix', 'Starsystem', 'get_status',
     'SQLPoint', 'Point'
 ]
@@ -32,6 +44,8 @@ def setup(bot):
     """
     Initial SQLAlchemy setup for this bot session.  Also performs in-place db upgrades.
 
+    Time spent in each phase is recorded in bot.memory['ratbot']['stats']['startup'].
+
     :param bot: Sopel bot
     :return: Nothing
     """
@@ -39,46 +53,340 @@ def setup(bot):
     if not url:
         raise ValueError("Database is not configured.")
 
+    config = bot.config.ratbot
+    phases = bot.memory['ratbot']['stats'].setdefault('startup', collections.OrderedDict())
+    with timed() as t:
+        engine = sa.create_engine(
+            url,
+            echo=bool(config.debug_sql),
+            pool_size=config.db_pool_size,
+            max_overflow=config.db_max_overflow,
+            pool_timeout=config.db_pool_timeout,
+            pool_pre_ping=True,  # Survive database restarts and connections dropped by firewalls.
+        )
+        tracker = SessionTracker(leak_timeout=config.db_leak_timeout)
+        tracker.attach(engine)
+        profiler = QueryProfiler(slow_threshold=config.db_slow_query or None).attach(engine)
+    phases['db_engine'] = t.seconds
+
     # Schema migration/upgrade
+    upgrade_schema(bot, engine, url, phases)
+
+    bot.memory['ratbot']['engine'] = engine
+    bot.memory['ratbot']['db'] = orm.scoped_session(orm.sessionmaker(engine))
+    bot.memory['ratbot']['db_tracker'] = tracker
+    bot.memory['ratbot']['db_profiler'] = profiler
+
+    with timed() as t, session_scope(bot, 'ratlib.db.setup') as db:
+        status = get_status(db)
+        if status is None:
+            status = Status(id=1, starsystem_refreshed=None)
+            db.add(status)
+            db.commit()
+    phases['db_status'] = t.seconds
+
+
+def versions_digest(path):
+    """
+    Returns a digest of the migration scripts in an alembic versions directory, or None if there are none.
+    """
+    digest = hashlib.sha1()
+    try:
+        filenames = sorted(name for name in os.listdir(path) if name.endswith('.py'))
+    except OSError:
+        return None
+    for filename in filenames:
+        with open(os.path.join(path, filename), 'rb') as f:
+            digest.update(filename.encode('utf-8') + b'\0' + f.read() + b'\0')
+    return digest.hexdigest() if filenames else None
+
+
+def upgrade_schema(bot, engine, url, phases=None):
+    """
+    Upgrades the database schema to the latest revision.
+
+    Loading alembic's migration environment means importing every revision, so the head revision is cached in the
+    work directory along with a digest of the versions directory.  If the digest still matches and the database is
+    already at that head, the upgrade is skipped entirely.
+
+    :param bot: Sopel bot
+    :param engine: Engine connected to the database.
+    :param url: Database URL.
+    :param phases: Optional dict that receives the time spent in each phase.
+    :return: True if alembic's upgrade was run, False if it was skipped.
+    """
+    phases = {} if phases is None else phases
     cfg = alembic.config.Config(bot.config.ratbot.alembic or "alembic.ini")
     cfg.set_main_option("sqlalchemy.url", url)
-    alembic.command.upgrade(cfg, "head")
-    bot.memory['ratbot']['db'] = orm.scoped_session(orm.sessionmaker(sa.create_engine(url)))
+    cache_file = os.path.join(bot.config.ratbot.workdir, 'alembic_head.json')
+
+    with timed() as t:
+        digest = None
+        script_location = cfg.get_main_option("script_location") or ''
+        if ':' not in script_location:  # Package resources ("pkg:path") are not worth special-casing.
+            digest = versions_digest(os.path.join(os.path.abspath(script_location), 'versions'))
+        cached = None
+        try:
+            with open(cache_file, 'r', encoding='utf8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            pass
+        current = None
+        if digest and cached and cached.get('digest') == digest:
+            try:
+                with engine.connect() as conn:
+                    current = {row[0] for row in conn.execute(sa.text("SELECT version_num FROM alembic_version"))}
+            except sa.exc.DBAPIError:
+                pass  # No alembic_version table yet; let alembic create everything.
+        skip = current is not None and current == {cached.get('head')}
+    phases['db_schema_check'] = t.seconds
+    if skip:
+        return False
+
+    with timed() as t:
+        alembic.command.upgrade(cfg, "head")
+        head = alembic.script.ScriptDirectory.from_config(cfg).get_current_head()
+    phases['db_migrate'] = t.seconds
+
+    if digest and head:
+        try:
+            with open(cache_file, 'w', encoding='utf8') as f:
+                json.dump({'digest': digest, 'head': head}, f)
+        except OSError as ex:
+            print("Unable to cache schema head revision: " + str(ex))
+    return True
+
+
+def restart(bot):
+    """
+    Undoes shutdown().  The engine opens new connections by itself once they are needed.
+    """
+    tracker = bot.memory['ratbot'].get('db_tracker')
+    if tracker is not None:
+        tracker.start()
+
+
+def shutdown(bot):
+    """
+    Stops the leak detector and closes all pooled connections.  See restart().
+    """
+    tracker = bot.memory['ratbot'].get('db_tracker')
+    if tracker is not None:
+        tracker.stop()
+    engine = bot.memory['ratbot'].get('engine')
+    if engine is not None:
+        engine.dispose()
+
+
+# Call sites that are expected to hold connections for a long time, e.g. starsystem refreshes.  See with_session()
+LONG_RUNNING_SITES = set()
+
+
+class SiteStats:
+    """
+    Connection usage of one call site.  Times are in seconds.
+    """
+    __slots__ = ('sessions', 'checkout_total', 'checkout_max', 'holds', 'hold_total', 'hold_max')
+
+    def __init__(self):
+        self.sessions = self.holds = 0
+        self.checkout_total = self.checkout_max = self.hold_total = self.hold_max = 0.0
 
-    db = get_session(bot)
-    status = get_status(db)
-    if status is None:
-        status = Status(id=1, starsystem_refreshed=None)
-        db.add(status)
-        db.commit()
-    db.close()
+    def as_dict(self):
+        return {
+            'sessions': self.sessions, 'holds': self.holds,
+            'checkout_avg': self.checkout_total / self.sessions if self.sessions else None,
+            'checkout_max': self.checkout_max,
+            'hold_avg': self.hold_total / self.holds if self.holds else None,
+            'hold_max': self.hold_max,
+        }
+
+
+class SessionTracker:
+    """
+    Tracks how long each call site waits for a pooled connection and how long it holds on to it, and warns about
+    connections that are held for longer than leak_timeout seconds: usually a session that was never closed.
+
+    Call sites are named by session_scope(), or found by walking the stack for connections checked out some other way.
+    """
+    def __init__(self, leak_timeout=120):
+        """
+        :param leak_timeout: Seconds a connection may be checked out before it is reported.  0 disables the detector.
+        """
+        self._lock = threading.Lock()
+        self.local = threading.local()
+        self.sites = collections.defaultdict(SiteStats)
+        self.checkouts = {}  # id(connection record) -> [checked out at, thread name, site, warned]
+        self.leak_timeout = leak_timeout
+        self._stop = threading.Event()
+        self._thread = None
+
+    def attach(self, engine):
+        sa.event.listen(engine, 'checkout', self._on_checkout)
+        sa.event.listen(engine, 'checkin', self._on_checkin)
+        self.start()
+
+    def start(self):
+        """
+        Starts the leak detector, if it is enabled and not already running.
+        """
+        if not self.leak_timeout or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='db-leak-detector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def site(self):
+        """
+        Returns the name of the current call site.
+        """
+        stack = getattr(self.local, 'sites', None)
+        if stack:
+            return stack[-1]
+        frame = sys._getframe(1)
+        # session_scope() is entered through contextlib, which is not the call site either.
+        skip = ('sqlalchemy', 'contextlib', __name__)
+        while frame is not None and frame.f_globals.get('__name__', '').startswith(skip):
+            frame = frame.f_back
+        if frame is None:
+            return '<unknown>'
+        return "{}:{}".format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+    def _on_checkout(self, dbapi_connection, record, proxy):
+        with self._lock:
+            self.checkouts[id(record)] = [time.monotonic(), threading.current_thread().name, self.site(), False]
+
+    def _on_checkin(self, dbapi_connection, record):
+        with self._lock:
+            checkout = self.checkouts.pop(id(record), None)
+            if checkout is None:
+                return
+            held = time.monotonic() - checkout[0]
+            stats = self.sites[checkout[2]]
+            stats.holds += 1
+            stats.hold_total += held
+            stats.hold_max = max(stats.hold_max, held)
+
+    def record_checkout(self, site, seconds):
+        with self._lock:
+            stats = self.sites[site]
+            stats.sessions += 1
+            stats.checkout_total += seconds
+            stats.checkout_max = max(stats.checkout_max, seconds)
+
+    def leaks(self, max_age=None):
+        """
+        Returns a list of (age, thread name, site) for connections checked out longer than max_age seconds, oldest first.
+
+        :param max_age: Defaults to leak_timeout.
+        """
+        max_age = self.leak_timeout if max_age is None else max_age
+        now = time.monotonic()
+        with self._lock:
+            result = [
+                (now - started, thread, site) for started, thread, site, warned in self.checkouts.values()
+                if now - started > max_age and site not in LONG_RUNNING_SITES
+            ]
+        return sorted(result, reverse=True)
+
+    def _watch(self):
+        while not self._stop.wait(max(1, self.leak_timeout / 2)):
+            now = time.monotonic()
+            with self._lock:
+                for checkout in self.checkouts.values():
+                    started, thread, site, warned = checkout
+                    if warned or site in LONG_RUNNING_SITES or now - started <= self.leak_timeout:
+                        continue
+                    checkout[3] = True
+                    warnings.warn(
+                        "Database connection checked out by {site} (thread {thread}) for {age:.0f}s.  Was the session"
+                        " closed?".format(site=site, thread=thread, age=now - started)
+                    )
+
+    def stats(self):
+        """
+        Returns a dict mapping call sites to their connection usage.
+        """
+        with self._lock:
+            return {site: stats.as_dict() for site, stats in self.sites.items()}
+
+    @contextlib.contextmanager
+    def scope(self, site):
+        stack = self.local.__dict__.setdefault('sites', [])
+        stack.append(site)
+        try:
+            yield
+        finally:
+            stack.pop()
 
 
 def get_session(bot):
     """
-    Returns a database session.
+    Returns the current thread's database session.  Prefer session_scope(), which also closes it.
 
     :param bot: Bot to examine
     """
     return bot.memory['ratbot']['db']()
 
 
-def with_session(fn=None):
+@contextlib.contextmanager
+def session_scope(bot, site=None):
+    """
+    Context manager providing a database session that is closed (and its connection returned to the pool) afterwards.
+
+    Nested scopes on the same thread share the outermost scope's session, and only the outermost scope closes it.  An
+    exception rolls the session back.
+
+    :param bot: Bot to examine
+    :param site: Name for this call site in connection metrics.  Defaults to the calling module and function.
+    """
+    registry = bot.memory['ratbot']['db']
+    tracker = bot.memory['ratbot'].get('db_tracker')
+    if tracker is None:  # Not set up through setup()
+        tracker = bot.memory['ratbot']['db_tracker'] = SessionTracker(leak_timeout=0)
+    if site is None:
+        site = tracker.site()
+    outermost = not getattr(tracker.local, 'depth', 0)
+    tracker.local.depth = getattr(tracker.local, 'depth', 0) + 1
+    db = registry()
+    try:
+        with tracker.scope(site):
+            if outermost:
+                started = time.perf_counter()
+                db.connection()  # Check out now, so pool contention is measured where it happens.
+                tracker.record_checkout(site, time.perf_counter() - started)
+            yield db
+    except:
+        db.rollback()
+        raise
+    finally:
+        tracker.local.depth -= 1
+        if outermost:
+            db.close()
+            registry.remove()
+
+
+def with_session(fn=None, long_running=False):
     """
     Ensures that a database session is is passed to the wrapped function as a 'db' parameter.
 
     :param fn: Function to wrap.
+    :param long_running: If True, the leak detector ignores this function holding a connection for a long time.
 
     If fn is None, returns a decorator rather than returning the decorating fn.
     """
     def decorator(fn):
+        site = "{}:{}".format(fn.__module__, fn.__qualname__)
+        if long_running:
+            LONG_RUNNING_SITES.add(site)
+
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
-            db = get_session(args[0])
-            try:
+            with session_scope(args[0], site) as db:
                 return fn(*args, db=db, **kwargs)
-            finally:
-                db.close()
         return wrapper
     return decorator(fn) if fn else decorator
 
@@ -190,6 +498,7 @@ class Fact(Base):
 class Status(Base):
     id = sa.Column(sa.Integer, primary_key=True)
     starsystem_refreshed = sa.Column(sa.DateTime(timezone=True), nullable=True)  # Time of last refresh
+    facts_version = sa.Column(sa.Integer, nullable=False, default=0, server_default='0')  # Bumped when facts change
 
 
 class StarsystemUtilsMixin(Base):
@@ -31,12 +31,29 @@ class Point(tuple):
         return self.__class__.__name__ + super().__repr__()
 
 
+def parse_point(value, number_type=float):
+    """
+    Parses a PostgreSQL POINT in its text form, e.g. "(1.5,-2)", into a Point.
+
+    PostgreSQL always outputs points as "(x,y)" with no whitespace, so that case is handled with plain string
+    operations; anything else goes through a regular expression.
+    """
+    if value[:1] == '(' and value[-1:] == ')':
+        x, sep, z = value[1:-1].partition(',')
+        if sep:
+            return tuple.__new__(Point, (number_type(x), number_type(z)))
+    match = SQLPoint._re_pattern.match(value)
+    if not match:
+        raise ValueError("Invalid point: {!r}".format(value))
+    return tuple.__new__(Point, (number_type(match.group(1)), number_type(match.group(2))))
+
+
 class SQLPoint(types.UserDefinedType):
     _re_pattern = re.compile(r'\s*\(\s*(.*)\s*,\s*(.*)\s*\)\s*')
 
     def __init__(self, number_type=float):
         super().__init__()
-        self.number_type = float
+        self.number_type = number_type
 
     def get_col_spec(self):
         return "POINT"
@@ -54,13 +71,48 @@ class SQLPoint(types.UserDefinedType):
         return process
 
     def result_processor(self, dialect, coltype):
+        number_type = self.number_type
+
         def process(value):
             if value is None:
                 return value
-            return Point(self.number_type(x) for x in self._re_pattern.match(value).groups())
+            return parse_point(value, number_type)
         return process
 
     def bind_expression(self, bindvalue):
         if bindvalue.value is None:
             return None
         return sql.func.point(bindvalue, type_=self)
+
+
+def benchmark(rows=1000000):
+    """
+    Times parse_point() against the previous regular expression parser on rows synthetic points.
+
+    Returns a dict of seconds per million points.
+    """
+    import random
+    import time
+
+    rng = random.Random(0)
+    values = ["({},{})".format(rng.uniform(-50000, 50000), rng.uniform(-50000, 50000)) for _ in range(rows)]
+    pattern = SQLPoint._re_pattern
+
+    started = time.perf_counter()
+    for value in values:
+        Point(float(x) for x in pattern.match(value).groups())
+    regex = time.perf_counter() - started
+
+    process = SQLPoint().result_processor(None, None)
+    started = time.perf_counter()
+    for value in values:
+        process(value)
+    fast = time.perf_counter() - started
+
+    scale = 1000000 / max(rows, 1)
+    return {'regex': regex * scale, 'fast': fast * scale}
+
+
+if __name__ == '__main__':
+    result = benchmark()
+    print("Parsing 1,000,000 points: regex {regex:.2f}s, parse_point {fast:.2f}s".format(**result))
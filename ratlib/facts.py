@@ -0,0 +1,468 @@
+"""
+In-memory fact cache.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+Every !command that isn't claimed by another module is a potential fact, so looking facts up has to be cheap.  The
+complete fact table is small, so it is held in memory and only reloaded when Status.facts_version changes.  Anything
+that changes facts should call FactCache.invalidate() afterwards, which bumps the version so that other processes
+sharing the database pick up the change on their next check().
+"""
+import collections
+import difflib
+import glob
+import hashlib
+import itertools
+import json
+import os.path
+import re
+import sys
+import threading
+import time
+
+from sqlalchemy import sql, exc
+from sqlalchemy.dialects.postgresql import insert
+
+from ratlib import fuzzy
+from ratlib.db import Fact, Status, get_status
+from ratlib.formatting import split_message
+from ratlib.util import timed
+
+
+__all__ = [
+    'CachedFact', 'FactCache', 'bump_version', 'fact_rows', 'ImportResult', 'bulk_import', 'search_database',
+    'FactWatcher'
+]
+
+
+_re_words = re.compile(r'\w+')
+
+
+# 'lines' is the message split for sending to IRC (see ratlib.formatting.split_message)
+CachedFact = collections.namedtuple('CachedFact', ['name', 'lang', 'message', 'author', 'lines'])
+
+
+def bump_version(db):
+    """
+    Increments Status.facts_version and commits.  Returns the new version.
+    """
+    db.execute(sql.update(Status.__table__).values(facts_version=Status.facts_version + 1))
+    db.commit()
+    return get_status(db).facts_version
+
+
+def fact_rows(data, lang='en'):
+    """
+    Yields (name, lang, message, author) tuples from the contents of a facts .json file.  Names and languages are
+    normalized the same way as Fact() does; message is None for explicit deletions.
+
+    Supports three formats:
+    - Old style: {name: message}, all in the default language.
+    - {lang: {name: message}}
+    - {lang: {name: {'fact': message, 'author': author}}}
+
+    :param data: Parsed json.
+    :param lang: Language for old-style files.
+    """
+    for k, v in data.items():
+        if isinstance(v, dict):
+            for name, message in v.items():
+                if isinstance(message, dict):  # New-style facts.json with attribution
+                    yield name.lower().strip(), k.lower().strip(), message['fact'], message.get('author')
+                else:  # Newer-style facts.json with language but not attribution -- or explicit deletion of fact.
+                    yield name.lower().strip(), k.lower().strip(), message, None
+        else:  # Old-style facts.json, single language
+            yield k.lower().strip(), lang, v, None
+
+
+class ImportResult:
+    """
+    Row counts from bulk_import().  Results can be added together.
+    """
+    __slots__ = ('inserted', 'updated', 'deleted', 'seconds')
+
+    def __init__(self, inserted=0, updated=0, deleted=0, seconds=0.0):
+        self.inserted = inserted
+        self.updated = updated
+        self.deleted = deleted
+        self.seconds = seconds
+
+    def __add__(self, other):
+        return ImportResult(
+            self.inserted + other.inserted, self.updated + other.updated, self.deleted + other.deleted,
+            self.seconds + other.seconds
+        )
+
+    def __bool__(self):
+        return bool(self.inserted or self.updated or self.deleted)
+
+    def __str__(self):
+        return "{0.inserted} added, {0.updated} updated, {0.deleted} deleted in {0.seconds:.2f}s".format(self)
+
+
+def bulk_import(db, rows, merge=False, chunksize=5000):
+    """
+    Writes facts with INSERT ... ON CONFLICT rather than one merge and savepoint per fact.  Does not commit.
+
+    :param db: Database session.
+    :param rows: Iterable of (name, lang, message, author).  A message of None deletes the fact.  Later rows override
+        earlier ones with the same name and lang.
+    :param merge: If True, existing facts are overwritten (and deleted where message is None).  Otherwise only facts
+        that don't exist yet are added.
+    :param chunksize: Maximum rows per statement, to stay clear of the bind parameter limit.
+    :return: An ImportResult
+    """
+    result = ImportResult()
+    with timed() as t:
+        facts = collections.OrderedDict()
+        for name, lang, message, author in rows:
+            if not name or not lang:
+                continue
+            facts[name, lang] = (message, author)
+
+        table = Fact.__table__
+        deletions = [key for key, (message, author) in facts.items() if message is None]
+        values = [
+            {'name': name, 'lang': lang, 'message': message, 'author': author}
+            for (name, lang), (message, author) in facts.items() if message is not None
+        ]
+
+        if merge:
+            for ix in range(0, len(deletions), chunksize):
+                stmt = table.delete().where(sql.tuple_(table.c.name, table.c.lang).in_(deletions[ix:ix + chunksize]))
+                result.deleted += db.execute(stmt).rowcount
+
+        for ix in range(0, len(values), chunksize):
+            stmt = insert(table).values(values[ix:ix + chunksize])
+            if merge:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c.name, table.c.lang],
+                    set_={'message': stmt.excluded.message, 'author': stmt.excluded.author},
+                    where=(
+                        table.c.message.is_distinct_from(stmt.excluded.message) |
+                        table.c.author.is_distinct_from(stmt.excluded.author)
+                    )
+                )
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=[table.c.name, table.c.lang])
+            # xmax is 0 for freshly inserted rows and nonzero for updated ones.
+            stmt = stmt.returning(sql.literal_column('xmax = 0').label('inserted'))
+            for inserted, in db.execute(stmt):
+                if inserted:
+                    result.inserted += 1
+                else:
+                    result.updated += 1
+    result.seconds = t.seconds
+    return result
+
+
+def search_database(db, text, limit=10):
+    """
+    Searches fact names (by trigram similarity) and messages (by full text search) in the database.
+
+    Requires pg_trgm.  Returns a list of (name, score) tuples, best match first.
+
+    :param db: Database session.
+    :param text: Search terms.
+    :param limit: Maximum number of results.
+    """
+    tsvector = sql.func.to_tsvector('simple', Fact.message)  # Must match the expression in fact_message_fts_ix
+    tsquery = sql.func.plainto_tsquery('simple', text)
+    score = sql.func.max(2 * sql.func.similarity(Fact.name, text) + sql.func.ts_rank(tsvector, tsquery))
+    query = (
+        db.query(Fact.name, score.label('score'))
+        .filter(sql.or_(Fact.name.op('%')(text), tsvector.op('@@')(tsquery)))
+        .group_by(Fact.name)
+        .order_by(score.desc(), Fact.name)
+        .limit(limit)
+    )
+    return [(name, float(score)) for name, score in query]
+
+
+class FactCache:
+    """
+    Maps fact names to {lang: CachedFact}.
+
+    Also maintains a trigram index of names and a word index of messages for search(), which works without the
+    database.
+    """
+    CHECK_INTERVAL = 30  # Seconds between checks for changes made by other processes.
+    MAX_SEARCHES = 256  # Number of search results remembered.
+    NAME_WEIGHT = 2  # Weight of name similarity relative to the fraction of search terms found in a message.
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.facts = {}
+        self.langs = frozenset()
+        self.translations = {}  # (attr, value) -> (facts, missing), see translation_stats()
+        self.version = None
+        self.loaded = None  # time.monotonic() of last load or check
+        self.names_index = fuzzy.TrigramIndex()
+        self.words_index = {}  # word -> set of fact names
+        self.searches = collections.OrderedDict()  # (source, text, limit) -> results
+
+    def __len__(self):
+        return sum(len(langs) for langs in self.facts.values())
+
+    def load(self, db):
+        """
+        (Re)loads all facts from the database.
+        """
+        status = get_status(db)
+        version = status.facts_version if status else 0
+        facts = {}
+        intern = sys.intern
+        for name, lang, message, author in db.query(Fact.name, Fact.lang, Fact.message, Fact.author):
+            lang = intern(lang)
+            facts.setdefault(name, {})[lang] = CachedFact(
+                name, lang, message, author and intern(author), split_message(message)
+            )
+
+        names_index = fuzzy.TrigramIndex()
+        words_index = collections.defaultdict(set)
+        for name, langs in facts.items():
+            names_index.add(fuzzy.normalize(name), name)
+            for fact in langs.values():
+                for word in _re_words.findall(fuzzy.normalize(fact.message)):
+                    words_index[intern(word)].add(name)
+
+        with self._lock:
+            self.facts = facts
+            self.langs = frozenset(itertools.chain.from_iterable(facts.values()))
+            self.translations.clear()
+            self.names_index = names_index
+            self.words_index = dict(words_index)
+            self.searches.clear()
+            self.version = version
+            self.loaded = time.monotonic()
+        return self
+
+    def check(self, db, force=False):
+        """
+        Reloads if the fact version in the database differs from ours.  Returns True if we reloaded.
+
+        :param db: Database session.
+        :param force: Check even if the last check was less than CHECK_INTERVAL seconds ago.
+        """
+        if not force and self.loaded is not None and time.monotonic() - self.loaded < self.CHECK_INTERVAL:
+            return False
+        status = get_status(db)
+        version = status.facts_version if status else 0
+        if version == self.version:
+            self.loaded = time.monotonic()
+            return False
+        self.load(db)
+        return True
+
+    def invalidate(self, db):
+        """
+        Marks facts as changed for all processes and reloads them.  Call after committing fact changes.
+        """
+        bump_version(db)
+        self.load(db)
+
+    def find(self, name, lang=None):
+        """
+        Returns the first matching fact in language order, or None.  Behaves like Fact.find(), without the database.
+
+        :param name: Fact name.
+        :param lang: Language or sequence of languages, in order of preference.  None (or an empty sequence) matches
+            any language, preferring them alphabetically.
+        """
+        langs = self.facts.get(name.strip().lower())
+        if not langs:
+            return None
+        if not lang:
+            return langs[min(langs)]
+        if isinstance(lang, str):
+            lang = (lang,)
+        for item in lang:
+            fact = langs.get(item.strip().lower())
+            if fact is not None:
+                return fact
+        return None
+
+    def names(self):
+        """
+        Returns a sorted list of all known fact names.
+        """
+        return sorted(self.facts)
+
+    def translation_stats(self, attr, value):
+        """
+        Reports which translations of a fact, or which facts in a language, exist.
+
+        :param attr: 'name' to look up the translations of fact 'value', 'lang' to look up the facts in language
+            'value'.
+        :return: None if nothing matches, otherwise a tuple of (existing facts, missing keys): the CachedFacts sorted by
+            language (or name) and the sorted languages (or names) lacking one.
+        """
+        key = (attr, value)
+        result = self.translations.get(key)
+        if result is not None or key in self.translations:
+            return result
+        if attr == 'name':
+            langs = self.facts.get(value)
+            if langs:
+                result = tuple(langs[lang] for lang in sorted(langs)), tuple(sorted(self.langs - langs.keys()))
+        elif attr == 'lang':
+            found = tuple(self.facts[name][value] for name in sorted(self.facts) if value in self.facts[name])
+            if found:
+                result = found, tuple(sorted(name for name, langs in self.facts.items() if value not in langs))
+        else:
+            raise ValueError("attr must be 'name' or 'lang'")
+        with self._lock:
+            self.translations[key] = result
+        return result
+
+    def _remember(self, key, results):
+        with self._lock:
+            self.searches[key] = results
+            while len(self.searches) > self.MAX_SEARCHES:
+                self.searches.popitem(last=False)
+        return results
+
+    def search(self, text, limit=10, db=None):
+        """
+        Searches fact names and messages.  Returns a list of (name, score) tuples, best match first.
+
+        Results are cached until facts are next reloaded.
+
+        :param text: Search terms.
+        :param limit: Maximum number of results.
+        :param db: If set, search the database (see search_database) and only fall back to searching in memory if
+            that fails.
+        """
+        text = fuzzy.normalize(text)
+        if not text:
+            return []
+        if db is not None:
+            key = ('db', text, limit)
+            results = self.searches.get(key)
+            if results is not None:
+                return results
+            try:
+                return self._remember(key, search_database(db, text, limit))
+            except exc.DBAPIError:  # Most likely pg_trgm is missing.
+                db.rollback()
+
+        key = ('memory', text, limit)
+        results = self.searches.get(key)
+        if results is not None:
+            return results
+        scores = collections.Counter()
+        for name, score in self.names_index.search(text, limit=None, threshold=0.2):
+            scores[name] += self.NAME_WEIGHT * score
+        words = set(_re_words.findall(text))
+        for word in words:
+            for name in self.words_index.get(word, ()):
+                scores[name] += 1 / len(words)
+        results = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return self._remember(key, results)
+
+    def suggest(self, text, limit=3, threshold=0.75):
+        """
+        Returns up to 'limit' fact names that look like text, for "did you mean" hints.  Never uses the database.
+
+        :param text: Attempted fact name, optionally including a language suffix.
+        :param limit: Maximum number of suggestions.
+        :param threshold: Minimum similarity (0..1), as in difflib.  Typos are usually transpositions and dropped
+            letters, which trigrams handle poorly in short names.
+        """
+        text = fuzzy.normalize(text)
+        return difflib.get_close_matches(text, self.facts.keys(), n=limit, cutoff=threshold)
+
+
+class FactWatcher:
+    """
+    Watches fact .json files and imports only what changed in them since the last scan.
+
+    Files are only re-read when their mtime or size changes, and only re-parsed when their content hash changes.  The
+    parsed entries of each file are kept, so a changed file is imported as a diff: added and changed facts are
+    upserted, facts removed from the file (or the file itself) are deleted.
+    """
+    def __init__(self, path, lang='en'):
+        """
+        :param path: A .json file, or a directory of them.
+        :param lang: Language for old-style files.
+        """
+        self.path = path
+        self.lang = lang
+        self.files = {}  # filename -> (mtime, size, digest, {(name, lang): (message, author)})
+
+    def filenames(self):
+        if os.path.isdir(self.path):
+            return sorted(glob.iglob(os.path.join(self.path, "*.json")))
+        return [self.path] if os.path.exists(self.path) else []
+
+    def _read(self, filename, previous):
+        """
+        Returns the new state of filename, or previous if its content has not changed.
+        """
+        stat = os.stat(filename)
+        if previous and previous[:2] == (stat.st_mtime, stat.st_size):
+            return previous
+        with open(filename, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha1(content).digest()
+        if previous and previous[2] == digest:
+            return (stat.st_mtime, stat.st_size, digest, previous[3])
+        data = json.loads(content.decode('utf-8-sig'))
+        if not isinstance(data, dict):
+            raise RuntimeError("{}: json structure is not a dict.".format(filename))
+        entries = collections.OrderedDict()
+        for name, lang, message, author in fact_rows(data, self.lang):
+            entries[name, lang] = (message, author)
+        return (stat.st_mtime, stat.st_size, digest, entries)
+
+    @staticmethod
+    def diff(old, new):
+        """
+        Returns rows for bulk_import() that turn the facts in old into those in new.
+        """
+        rows = []
+        for key, value in new.items():
+            if old.get(key) != value:
+                rows.append(key + value)
+        for key in old.keys() - new.keys():
+            rows.append(key + (None, None))
+        return rows
+
+    def scan(self, db, initial=False):
+        """
+        Applies changes to the database (without committing).  Returns a list of (filename, ImportResult) for files
+        that changed.
+
+        :param db: Database session.
+        :param initial: If True, files we haven't seen before only add facts that don't exist yet, like a non-merging
+            import.  Otherwise new files are imported in full.
+        """
+        results = []
+        seen = set()
+        for filename in self.filenames():
+            seen.add(filename)
+            previous = self.files.get(filename)
+            try:
+                state = self._read(filename, previous)
+            except (OSError, ValueError, RuntimeError) as ex:
+                print("[RatFacts] Failed to read {!r}: {}".format(filename, ex))
+                continue  # Keep the old state, so the next successful read is diffed against it.
+            self.files[filename] = state
+            if state is previous or (previous and state[3] is previous[3]):
+                continue
+            if previous is None and initial:
+                rows = (key + value for key, value in state[3].items())
+                result = bulk_import(db, rows, merge=False)
+            else:
+                result = bulk_import(db, self.diff(previous[3] if previous else {}, state[3]), merge=True)
+            results.append((filename, result))
+
+        for filename in list(self.files.keys() - seen):  # Deleted files
+            _, _, _, entries = self.files.pop(filename)
+            results.append((filename, bulk_import(db, self.diff(entries, {}), merge=True)))
+        return results
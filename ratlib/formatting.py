@@ -0,0 +1,153 @@
+"""
+IRC text formatting utilities.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import re
+
+
+__all__ = ['MAX_LINE_BYTES', 'FormatState', 'split_message', 'split_recipients', 'group_recipients']
+
+
+MAX_LINE_BYTES = 400  # Leaves room for the PRIVMSG prefix, target and a short reply prefix within IRC's 512 bytes.
+
+_re_codes = re.compile(r'\x03(?:\d{1,2}(?:,\d{1,2})?)?|[\x02\x0f\x16\x1d\x1f]')
+_re_recipients = re.compile(r'[,\s+]+')
+
+
+class FormatState:
+    """
+    Tracks which IRC formatting (bold, color, etc.) is in effect at some point in a message.
+    """
+    __slots__ = ('toggles', 'color')
+    TOGGLES = '\x02\x16\x1d\x1f'  # Bold, reverse, italic, underline
+
+    def __init__(self):
+        self.toggles = set()
+        self.color = None
+
+    def update(self, text):
+        """
+        Applies all formatting codes in text.  Returns self.
+        """
+        for code in _re_codes.findall(text):
+            if code == '\x0f':
+                self.toggles.clear()
+                self.color = None
+            elif code[0] == '\x03':
+                self.color = code if len(code) > 1 else None
+            else:
+                self.toggles ^= {code}
+        return self
+
+    def prefix(self):
+        """
+        Returns the codes needed at the start of a new line to continue in this state.
+        """
+        return "".join(code for code in self.TOGGLES if code in self.toggles) + (self.color or '')
+
+
+def _tokens(word):
+    """
+    Splits a word into single characters and whole formatting codes, which must not be split.
+    """
+    pos = 0
+    for match in _re_codes.finditer(word):
+        yield from word[pos:match.start()]
+        yield match.group(0)
+        pos = match.end()
+    yield from word[pos:]
+
+
+def _size(text):
+    return len(text.encode('utf-8'))
+
+
+def split_message(text, maxbytes=MAX_LINE_BYTES):
+    """
+    Splits text into lines of at most maxbytes bytes when encoded as UTF-8.
+
+    Lines are broken at spaces where possible.  Formatting that is still in effect at the end of a line is reopened at
+    the start of the next one, so bold and colored spans survive being split.  Words longer than a line are broken
+    between characters, but never inside a multibyte character or a formatting code.
+
+    :param text: Text to split.
+    :param maxbytes: Maximum line length in bytes.
+    :return: A tuple of lines.
+    """
+    if _size(text) <= maxbytes:
+        return (text,) if text else ()
+
+    lines = []
+    state = FormatState()
+    line = ''    # Current line, without its formatting prefix
+    prefix = ''  # Formatting reopened at the start of the current line
+    used = 0     # Bytes in prefix + line
+
+    def flush():
+        nonlocal line, prefix, used
+        if line:
+            lines.append(prefix + line)
+            state.update(line)
+        prefix = state.prefix()
+        line = ''
+        used = _size(prefix)
+
+    for word in text.split(' '):
+        size = _size(word)
+        if line and used + 1 + size <= maxbytes:
+            line += ' ' + word
+            used += 1 + size
+            continue
+        if line:
+            flush()
+        if used + size <= maxbytes:
+            line = word
+            used += size
+            continue
+        # Word does not fit on a line of its own.
+        for token in _tokens(word):
+            size = _size(token)
+            if line and used + size > maxbytes:
+                flush()
+            line += token
+            used += size
+    if line:
+        lines.append(prefix + line)
+    return tuple(lines)
+
+
+def split_recipients(text):
+    """
+    Splits a list of nicknames separated by whitespace, commas or plus signs.
+    """
+    return [nick for nick in _re_recipients.split(text) if nick] if text else []
+
+
+def group_recipients(nicks, maxbytes=60, separator=', '):
+    """
+    Joins nicknames into as few groups as possible, each at most maxbytes long, for addressing several people at once.
+
+    :param nicks: Sequence of nicknames.
+    :param maxbytes: Maximum length of each group in bytes.  A single nickname longer than this gets a group of its own.
+    :param separator: Separator between nicknames.
+    :return: A list of strings.
+    """
+    groups = []
+    current = []
+    used = 0
+    for nick in nicks:
+        size = _size(nick)
+        if current and used + len(separator) + size > maxbytes:
+            groups.append(separator.join(current))
+            current, used = [], 0
+        used += (len(separator) if current else 0) + size
+        current.append(nick)
+    if current:
+        groups.append(separator.join(current))
+    return groups
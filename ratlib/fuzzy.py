@@ -0,0 +1,146 @@
+"""
+Fuzzy string matching support.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import collections
+import re
+import unicodedata
+
+
+__all__ = ['normalize', 'trigrams', 'similarity', 'TrigramIndex']
+
+
+_re_whitespace = re.compile(r'[\s_]+')
+
+
+def normalize(text):
+    """
+    Normalizes text for fuzzy comparisons.
+
+    Strips accents and other combining characters, casefolds, treats underscores as spaces and collapses whitespace.
+    "CMDR  Zoë_Stárdust" becomes "cmdr zoe stardust".
+
+    :param text: Text to normalize.
+    """
+    text = unicodedata.normalize('NFKD', str(text))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _re_whitespace.sub(' ', text.casefold()).strip()
+
+
+def trigrams(text):
+    """
+    Returns the set of trigrams in text, which should already be normalized.
+
+    Like PostgreSQL's pg_trgm, each word is padded with two leading spaces and one trailing space so that short words
+    and word starts carry more weight.
+    """
+    result = set()
+    for word in text.split(' '):
+        if not word:
+            continue
+        word = '  ' + word + ' '
+        result.update(word[ix:ix + 3] for ix in range(len(word) - 2))
+    return result
+
+
+def similarity(a, b):
+    """
+    Returns the trigram similarity (0..1) of two normalized strings.
+    """
+    a, b = trigrams(a), trigrams(b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class TrigramIndex:
+    """
+    Incrementally maintained trigram index mapping normalized keys to values.
+
+    Several values may share a key, and a value may be stored under several keys.
+    """
+    def __init__(self):
+        self.keys = {}  # key -> (trigram set, set of values)
+        self.postings = collections.defaultdict(set)  # trigram -> set of keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def add(self, key, value):
+        """
+        Adds value under key.  key should already be normalized.
+        """
+        entry = self.keys.get(key)
+        if entry is None:
+            entry = self.keys[key] = (trigrams(key), set())
+            for gram in entry[0]:
+                self.postings[gram].add(key)
+        entry[1].add(value)
+
+    def discard(self, key, value):
+        """
+        Removes value from key, if present.  Drops the key entirely once it has no values left.
+        """
+        entry = self.keys.get(key)
+        if entry is None:
+            return
+        entry[1].discard(value)
+        if entry[1]:
+            return
+        del self.keys[key]
+        for gram in entry[0]:
+            keys = self.postings.get(gram)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.postings[gram]
+
+    def clear(self):
+        self.keys.clear()
+        self.postings.clear()
+
+    def get(self, key):
+        """
+        Returns the set of values stored under the exact key, or an empty set.
+        """
+        entry = self.keys.get(key)
+        return set(entry[1]) if entry else set()
+
+    def search(self, text, limit=5, threshold=0.3):
+        """
+        Returns up to 'limit' (value, score) tuples for values whose keys are similar to text, best match first.
+
+        A value stored under several keys is reported once, with its best score.
+
+        :param text: Text to search for.  Normalized automatically.
+        :param limit: Maximum number of results, or None for no limit.
+        :param threshold: Minimum similarity (0..1) to report.
+        """
+        grams = trigrams(normalize(text))
+        if not grams:
+            return []
+        shared = collections.Counter()
+        for gram in grams:
+            for key in self.postings.get(gram, ()):
+                shared[key] += 1
+
+        best = {}
+        for key, count in shared.items():
+            score = count / (len(grams) + len(self.keys[key][0]) - count)
+            if score < threshold:
+                continue
+            for value in self.keys[key][1]:
+                if best.get(value, -1) < score:
+                    best[value] = score
+        result = sorted(best.items(), key=lambda item: -item[1])
+        return result if limit is None else result[:limit]
@@ -0,0 +1,139 @@
+"""
+Small JSON documents in the work directory, kept in memory and written behind.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+A JSONStore loads its file once.  Reads are served from memory, changes are made under a lock, and the file is
+rewritten a moment later: changes made in the meantime are coalesced into one write.  Files are written to a temporary
+file and then moved over the original, so a crash leaves either the old or the new version, never half of one.
+
+Usage:
+```
+store = get_store(bot, 'drills.json')
+with store.change() as data:
+    data['Some Rat'] = {'ratdrill': True}
+```
+"""
+import contextlib
+import copy
+import json
+import os
+import threading
+import traceback
+
+import ratlib.sopel
+
+
+__all__ = ['JSONStore', 'get_store', 'close_stores']
+
+
+_stores_lock = threading.Lock()
+
+
+class JSONStore:
+    """
+    A JSON document held in memory and persisted to a file.
+
+    :ivar filename: File the document lives in.
+    :ivar delay: Seconds to wait after a change before writing, so that a burst of changes is written once.
+    """
+    def __init__(self, filename, default=dict, delay=1.0):
+        """
+        Loads filename, or starts with default() if it does not exist.  A file that cannot be parsed is set aside as
+        filename.bad rather than being overwritten.
+        """
+        self.filename = filename
+        self.delay = delay
+        self.lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        self.writes = 0
+        try:
+            with open(filename, 'r', encoding='utf8') as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = default()
+        except ValueError as ex:
+            print("[JSONStore] Unable to parse {}, moving it to {}.bad: {}".format(filename, filename, ex))
+            os.replace(filename, filename + '.bad')
+            self.data = default()
+
+    def read(self):
+        """
+        Returns a copy of the document that is safe to use without the lock.
+        """
+        with self.lock:
+            return copy.deepcopy(self.data)
+
+    @contextlib.contextmanager
+    def change(self):
+        """
+        Returns a context manager that holds the lock, yields the document for modification and schedules a write.
+        """
+        with self.lock:
+            yield self.data
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Writes the document now if it has unwritten changes.
+        """
+        with self._write_lock:
+            with self.lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                payload = json.dumps(self.data)
+                self._dirty = False
+            temp = self.filename + '.tmp'
+            try:
+                with open(temp, 'w', encoding='utf8') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp, self.filename)
+                self.writes += 1
+            except OSError:
+                traceback.print_exc()
+                with self.lock:
+                    self._dirty = True  # Try again with the next change or flush.
+
+    def close(self):
+        """
+        Writes any pending changes.  The store can still be used afterwards.
+        """
+        self.flush()
+
+
+def get_store(bot, filename, default=dict, delay=1.0):
+    """
+    Returns the shared JSONStore for filename (relative to workdir), loading it on first use.
+    """
+    stores = bot.memory['ratbot']['stores']
+    with _stores_lock:
+        store = stores.get(filename)
+        if store is None:
+            store = stores[filename] = JSONStore(
+                ratlib.sopel.makepath(bot.config.ratbot.workdir, filename), default=default, delay=delay
+            )
+        return store
+
+
+def close_stores(bot):
+    """
+    Writes pending changes of every store.  Call on shutdown.
+    """
+    for store in list(bot.memory['ratbot'].get('stores', {}).values()):
+        store.close()
@@ -1,3 +1,102 @@
+import bisect
+import difflib
+import threading
+
+
+class _ReverseIndex:
+    """
+    Case-folded name -> code lookup over one of the tables at the bottom of this module, built on first use.
+
+    Every name of an entry maps to its code; where two entries share a name, the first one in the table wins, as with
+    the linear search this replaces.
+    """
+    def __init__(self, table):
+        self._table = table
+        self._lock = threading.Lock()
+        self._built = False
+        self.names = {}      # folded name -> code
+        self.tuples = {}     # full tuple of names -> code
+        self.sorted = []     # folded names, for prefix searches
+
+    def _build(self):
+        with self._lock:
+            if self._built:
+                return
+            for code, value in self._table().items():
+                values = (value,) if isinstance(value, str) else value
+                if not isinstance(value, str):
+                    self.tuples.setdefault(value, code)
+                for name in values:
+                    folded = name.casefold()
+                    self.names.setdefault(folded, code)
+            self.sorted = sorted(self.names)
+            self._built = True
+
+    def code(self, name):
+        """Returns the code for a name (or a full tuple of names), or None."""
+        if not self._built:
+            self._build()
+        if isinstance(name, str):
+            return self.names.get(name.strip().casefold())
+        return self.tuples.get(tuple(name))
+
+    def find(self, text, limit=5, cutoff=0.75):
+        """
+        Returns up to limit codes for a name as a user might type it: exact match first, then names starting with
+        text, then close spellings.
+        """
+        if not self._built:
+            self._build()
+        folded = text.strip().casefold()
+        if not folded:
+            return []
+        result = []
+
+        def add(name):
+            code = self.names[name]
+            if code not in result:
+                result.append(code)
+            return len(result) >= limit
+
+        if folded in self.names and add(folded):
+            return result
+        ix = bisect.bisect_left(self.sorted, folded)
+        while ix < len(self.sorted) and self.sorted[ix].startswith(folded):
+            if add(self.sorted[ix]):
+                return result
+            ix += 1
+        for name in difflib.get_close_matches(folded, self.sorted, n=limit, cutoff=cutoff):
+            if add(name):
+                break
+        return result
+
+    def best(self, text, cutoff=0.9):
+        """
+        Returns the code for a name as a user might type it, but only if there is no doubt about it: an exact match,
+        else the one entry with names starting with text, else the one entry with a name spelled very nearly like text.
+        Returns None if no entry or several entries match.
+        """
+        if not self._built:
+            self._build()
+        folded = text.strip().casefold()
+        if not folded:
+            return None
+        if folded in self.names:
+            return self.names[folded]
+        codes = set()
+        ix = bisect.bisect_left(self.sorted, folded)
+        while ix < len(self.sorted) and self.sorted[ix].startswith(folded):
+            codes.add(self.names[self.sorted[ix]])
+            ix += 1
+        if not codes:
+            codes = {self.names[name] for name in difflib.get_close_matches(folded, self.sorted, n=3, cutoff=cutoff)}
+        return codes.pop() if len(codes) == 1 else None
+
+
+_language_index = _ReverseIndex(lambda: languages)
+_country_index = _ReverseIndex(lambda: countries)
+
+
 class Language:
     """Static class to hold some functions for handling languages"""
     @staticmethod
@@ -23,23 +122,40 @@ class Language:
                 return None
 
     @staticmethod
-    def code(name: str or tuple, raise_error: bool=True) -> str or None:
+    def code(name: str or tuple, raise_error: bool=True, fuzzy: bool=False) -> str or None:
         """
-        Get ISO 639-1 code corresponding to language name
+        Get ISO 639-1 code corresponding to language name.  Names are not case-sensitive.
+        :param name: Language name, or the full tuple of names of a language with several
+        :param raise_error: Raise KeyError if language not found (rather than return None)
+        :param fuzzy: If there is no exact match, accept a prefix or close match, as long as only one language matches
+        :return: ISO 639-1 code
         """
-        try:
-            if isinstance(name, str):
-                return [key for key, value in languages.items()
-                        if isinstance(value, str) and value == name or isinstance(value, tuple) and name in value][0]
-            else:
-                return [key for key, value in languages.items()
-                        if isinstance(value, tuple) and value == name][0]
+        result = _language_index.code(name)
+        if result is None and fuzzy and isinstance(name, str):
+            result = _language_index.best(name)
+        if result is None and raise_error:
+            raise KeyError(name)
+        return result
 
-        except IndexError:
-            if raise_error:
-                raise KeyError(name)
-            else:
-                return None
+    @staticmethod
+    def find(text: str, limit: int=5) -> list:
+        """
+        Get ISO 639-1 codes of languages matching a name as typed by a user: an exact match, then languages with a
+        name starting with text, then close spellings.
+        """
+        return _language_index.find(text, limit)
+
+    @staticmethod
+    def resolve(text: str, fuzzy: bool=True) -> str or None:
+        """
+        Get the ISO 639-1 code for text that is either a code or a language name, or None if it is not clear which
+        language text means.  Text shorter than three characters is only matched exactly, so a mistyped code is not
+        taken for the start of a name.
+        """
+        code = text.strip().lower()
+        if code in languages:
+            return code
+        return Language.code(text, raise_error=False, fuzzy=fuzzy and len(code) >= 3)
 
 
 class Country:
@@ -62,24 +178,23 @@ class Country:
                 return None
 
     @staticmethod
-    def code(name: str, raise_error: bool=True) -> str or None:
+    def code(name: str, raise_error: bool=True, fuzzy: bool=False) -> str or None:
         """
-        Get ISO 3166-1 alpha-2 code corresponding to country name
+        Get ISO 3166-1 alpha-2 code corresponding to country name.  Names are not case-sensitive.
         """
-        try:
-            if isinstance(name, str):
-                return [key for key, value in countries.items()
-                        if isinstance(value, str) and value == name or isinstance(value, tuple) and name in value][0]
-            else:
-                return [key for key, value in countries.items()
-                        if isinstance(value, tuple) and value == name][0]
-
-        except IndexError:
-            if raise_error:
-                raise KeyError(name)
-            else:
-                return None
+        result = _country_index.code(name)
+        if result is None and fuzzy and isinstance(name, str):
+            result = _country_index.best(name)
+        if result is None and raise_error:
+            raise KeyError(name)
+        return result
 
+    @staticmethod
+    def find(text: str, limit: int=5) -> list:
+        """
+        Get ISO 3166-1 alpha-2 codes of countries matching a name as typed by a user (see Language.find())
+        """
+        return _country_index.find(text, limit)
 
 languages = dict([
     ("aa", "Afar"),
@@ -522,6 +637,34 @@ countries = dict([
 ])
 
 
+def benchmark(rounds=20):
+    """
+    Times name -> code lookups of every language and country name against the linear search this module used to do.
+    """
+    import timeit
+
+    def linear(table, name):
+        if isinstance(name, str):
+            return [key for key, value in table.items()
+                    if isinstance(value, str) and value == name or isinstance(value, tuple) and name in value][0]
+        return [key for key, value in table.items() if isinstance(value, tuple) and value == name][0]
+
+    names = [(languages, Language.code, value) for value in languages.values()]
+    names += [(countries, Country.code, value) for value in countries.values()]
+    built = timeit.timeit(lambda: (_language_index.code(""), _country_index.code("")), number=1)
+    before = timeit.timeit(lambda: [linear(table, name) for table, _, name in names], number=rounds)
+    after = timeit.timeit(lambda: [code(name) for _, code, name in names], number=rounds)
+    typed = ["english", "Span", "portugese", "germna", "united sta", "brasil"]
+    fuzzy = timeit.timeit(lambda: [Language.find(text) + Country.find(text) for text in typed], number=rounds)
+    lookups = len(names) * rounds
+    return {
+        'index_build': built,
+        'linear_us': 1e6 * before / lookups,
+        'indexed_us': 1e6 * after / lookups,
+        'find_us': 1e6 * fuzzy / (2 * len(typed) * rounds),
+    }
+
+
 # For testing purposes
 if __name__ == "__main__":
     for key, value in languages.items():
@@ -531,3 +674,6 @@ if __name__ == "__main__":
 
     for key, value in countries.items():
         print("{} corresponds to {}".format(Country.code(value), Country.name(key)))
+
+    for key, value in benchmark().items():
+        print("{}: {:.3f}".format(key, value))
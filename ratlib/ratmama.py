@@ -0,0 +1,174 @@
+"""
+Parsing of RatMama's "Incoming Client" announcements.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+RatMama announces every client that connects through the web client on a single line with a fixed layout.  parse()
+matches that line once and returns every field the board needs, already normalised, so nothing downstream has to scan
+the line again.
+"""
+import collections
+import re
+
+from ratlib.autocorrect import CorrectionResult
+from ratlib.languages import Language
+
+
+__all__ = ['Signal', 'regex', 'parse', 'benchmark']
+
+
+regex = re.compile(r"""
+    # Verbose: whitespace and comments in the pattern are ignored.
+    # Saved at https://regex101.com/r/jhKtQD/1
+    \s*                                  # Handle any possible leading whitespace
+    Incoming\s+Client:\s*   # Match "Incoming Client" prefix
+    # Wrap the entirety of rest of the pattern in a group to make it easier to echo the entire thing
+    (?P<all>
+    (?P<cmdr>[^@#\d\s].*?)               # Match CDMR name.  Don't allow leading digits or @/#, as it breaks things
+                                         # (and probably isn't a legal name anyways).  Dispatch can manually handle
+                                         # those cases if it turns out to be a thing, or someone can fix Ratmama too.
+    \s+-\s+                              #  -
+    System:\s*(?P<system>.*?)            # Match system name
+    (?:\s[sS][yY][sS][tT][eE][mM]|)      # Strip " system" from end, if present (case insensitive)
+    \s+-\s+                              #  -
+    Platform:\s*(?P<platform>\w+)        # Match platform (currently can't contain spaces)
+    \s+-\s+                              #  -
+    O2:\s*(?P<o2>.+?)                    # Match oxygen status
+    \s+-\s+                              #  -
+    Language:\s*
+    (?P<full_language>                   # Match full language text (for regenerating the line)
+    (?P<language>.+?)\s*                 # Match language name.
+    \(                                   # The "(" of "(en-US)"
+    (?P<language_code>.+?)               # "en"
+    (?:                                  # Optional group
+        -(?P<language_country>.+)        # "-", "US" (currently unused)
+    )?                                   # Actually make the group optional.
+    \)                                   # The ")" of "(en-US)"
+    )                                    # End of full language text
+    (?:                                  # Possibly match IRC nickname
+    \s+-\s+                              #  -
+    IRC\s+Nickname:\s*(?P<nick>[^\s]+)   # IRC nickname
+    )?                                   # ... emphasis on "Possibly"
+    )                                    # End of the main capture group
+    \s*                                  # Handle any possible trailing whitespace
+    $                                    # End of pattern
+""", re.VERBOSE)
+
+
+_platforms = {'pc': 'pc', 'xb': 'xb', 'xbox': 'xb', 'xb1': 'xb', 'ps': 'ps', 'ps4': 'ps'}
+
+
+class Signal(collections.namedtuple('Signal', [
+    'cmdr', 'system', 'platform', 'o2', 'code_red', 'language_code', 'nick', 'fields', 'correction'
+])):
+    """
+    A parsed announcement.
+
+    :ivar cmdr: Commander name.
+    :ivar system: Reported system, as typed.
+    :ivar platform: 'pc', 'xb', 'ps', or the platform as given in lowercase if it is not one of those.
+    :ivar o2: Oxygen status, as given.
+    :ivar code_red: True unless O2 is "OK".
+    :ivar language_code: ISO 639-1 code.  Falls back to the language name if RatMama's code is not one we know.
+    :ivar nick: IRC nickname.  Defaults to the commander name.
+    :ivar fields: All of the regex groups, for formatting.
+    :ivar correction: CorrectionResult for the reported system.
+    """
+    __slots__ = ()
+
+    fmt = (
+        "{ratsignal} - CMDR {cmdr} - Reported System: {system} - Platform: {platform} - O2: {o2}"
+        " - Language: {full_language}"
+    )
+    nick_fmt = " - IRC Nickname: {nick}"
+
+    def line(self, ratsignal, **overrides):
+        """
+        Returns the signal line as it is quoted on the case, with overrides substituted for any of its fields.
+        """
+        fields = dict(self.fields, ratsignal=ratsignal)
+        fields.update(overrides)
+        return (self.fmt + (self.nick_fmt if self.fields['nick'] else "")).format(**fields)
+
+    def quotes(self, ratsignal):
+        """
+        Returns the lines to quote on the case: the signal line with any autocorrected system name, and a note of the
+        original.
+        """
+        if not self.correction.fixed:
+            return [self.line(ratsignal)]
+        originals = ", ".join('"...{name}"'.format(name=system) for system in self.correction.corrections)
+        return [
+            self.line(ratsignal, system=self.correction.output),
+            "[Autocorrected system name{}, original{} {}]".format(
+                *(("s", "s were") if self.correction.fixed > 1 else ("", " was")), originals
+            )
+        ]
+
+
+def parse(line):
+    """
+    Parses an announcement line.  Returns a Signal, or None if line is not an announcement.
+    """
+    match = regex.fullmatch(line)
+    if not match:
+        return None
+    fields = match.groupdict()
+    platform = fields['platform'].lower()
+    language_code = fields['language_code'].strip().lower()
+    if not Language.name(language_code, raise_error=False):
+        language_code = Language.code(fields['language'], raise_error=False) or language_code
+    return Signal(
+        cmdr=fields['cmdr'],
+        system=fields['system'],
+        platform=_platforms.get(platform, platform),
+        o2=fields['o2'],
+        code_red=fields['o2'] != "OK",
+        language_code=language_code,
+        nick=fields['nick'] or fields['cmdr'],
+        fields=fields,
+        correction=CorrectionResult(fields['system'])  # Not cached: every announcement is a new line.
+    )
+
+
+def benchmark(count=10000):
+    """
+    Times parse() against the old announcement handling: the same match, then autocorrection and platform detection
+    over the whole line.
+    """
+    import timeit
+
+    line = (
+        "Incoming Client: Some Commander - System: Eol Prou RS-T dl-3164 system - Platform: PC - O2: NOT OK"
+        " - Language: English (en-US) - IRC Nickname: Some_Commander"
+    )
+    platform_regexes = [re.compile(pattern, re.IGNORECASE | re.VERBOSE) for pattern in (
+        r"(?:[^\w-]|\A) pc (?:[^\w-]|\Z)",
+        r"(?:[^\w-]|\A) xb(?:ox)? (?:-?(?:1|one))? (?:[^\w-]|\Z)",
+        r"(?:[^\w-]|\A) [pP](?:lay)?(?:[- ])?[sS](?:tation)? (?:[- ]?(?:4|four))? (?:[^\w-]|\Z)",
+    )]
+
+    def before():
+        fields = regex.fullmatch(line).groupdict()
+        text = (Signal.fmt + Signal.nick_fmt).format(ratsignal="RATSIGNAL", **fields)
+        text = CorrectionResult(text).output
+        return [pattern.search(text) for pattern in platform_regexes]
+
+    def after():
+        signal = parse(line)
+        return signal.quotes("RATSIGNAL")
+
+    return {
+        'before_us': 1e6 * timeit.timeit(before, number=count) / count,
+        'after_us': 1e6 * timeit.timeit(after, number=count) / count,
+    }
+
+
+if __name__ == '__main__':
+    for key, value in benchmark().items():
+        print("{}: {:.2f}".format(key, value))
@@ -0,0 +1,406 @@
+"""
+Board replication between multiple bot instances.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+Changes to the RescueBoard of the leading instance are published as small JSON events.  Events carry only which case
+changed and its board index; followers re-read the case from the API (which remains authoritative) and apply it to
+their own board.  Exactly one instance leads at any time, and only the leader answers in channel.
+
+Two transports are provided:
+- PostgresChannel uses LISTEN/NOTIFY on the bot's database, and a session-level advisory lock for leader election.  The
+  lock is released by PostgreSQL as soon as the leader's connection drops, so a follower takes over within
+  POLL_INTERVAL.
+- LocalChannel is an in-process stand-in backed by a LocalHub, for tests and single-process setups.
+"""
+import collections
+import functools
+import itertools
+import json
+import select
+import threading
+import traceback
+import uuid
+import zlib
+
+import sqlalchemy as sa
+from sopel.module import NOLIMIT
+
+__all__ = [
+    'Event', 'LocalHub', 'LocalChannel', 'PostgresChannel', 'BoardReplicator',
+    'setup', 'shutdown', 'is_leader', 'require_leader'
+]
+
+
+class Event:
+    """Board event codes."""
+    ADD = 'a'
+    CHANGE = 'c'
+    REMOVE = 'r'
+    RESYNC = 's'  # Never published; generated locally when a follower detects lost events.
+
+
+def lock_key(name):
+    """
+    Returns a stable 32-bit advisory lock key for the named channel.
+    """
+    return zlib.crc32(name.encode('utf-8')) & 0x7fffffff
+
+
+class LocalHub:
+    """
+    In-process message bus shared by LocalChannels.  Delivery is synchronous and in order.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.channels = collections.defaultdict(list)
+        self.leaders = {}
+
+    def subscribe(self, channel):
+        with self._lock:
+            self.channels[channel.name].append(channel)
+
+    def unsubscribe(self, channel):
+        with self._lock:
+            if channel in self.channels[channel.name]:
+                self.channels[channel.name].remove(channel)
+            if self.leaders.get(channel.name) is channel:
+                del self.leaders[channel.name]
+
+    def publish(self, name, payload):
+        with self._lock:
+            channels = list(self.channels[name])
+        for channel in channels:
+            channel.deliver(payload)
+
+    def try_lead(self, channel):
+        with self._lock:
+            leader = self.leaders.setdefault(channel.name, channel)
+            return leader is channel
+
+
+class LocalChannel:
+    """
+    Transport using a LocalHub.  Use the same hub for every instance that should see each other.
+    """
+    def __init__(self, hub, name, callback, on_leader_change=None):
+        """
+        :param hub: LocalHub to attach to.
+        :param name: Channel name.
+        :param callback: Called with the payload of every message, including our own.
+        :param on_leader_change: Called with True or False when this channel gains or loses leadership.
+        """
+        self.hub = hub
+        self.name = name
+        self.callback = callback
+        self.on_leader_change = on_leader_change
+        self.leader = False
+
+    def start(self):
+        self.hub.subscribe(self)
+        self.elect()
+
+    def elect(self):
+        """
+        Attempts to become the leader.  Returns True if we are.
+        """
+        if not self.leader and self.hub.try_lead(self):
+            self.leader = True
+            if self.on_leader_change:
+                self.on_leader_change(True)
+        return self.leader
+
+    def deliver(self, payload):
+        self.callback(payload)
+
+    def publish(self, payload):
+        self.hub.publish(self.name, payload)
+
+    def close(self):
+        self.hub.unsubscribe(self)
+        self.leader = False
+        for channel in list(self.hub.channels[self.name]):
+            if channel.elect():
+                break
+
+
+class PostgresChannel:
+    """
+    Transport using PostgreSQL LISTEN/NOTIFY.
+
+    Listening and leader election share one dedicated connection, which is polled by a background thread.
+    Notifications are sent through the engine's regular connection pool.
+    """
+    POLL_INTERVAL = 0.25  # Seconds between election attempts; also bounds how long close() takes.
+
+    def __init__(self, engine, name, callback, on_leader_change=None):
+        """
+        :param engine: SQLAlchemy engine connected to a PostgreSQL database.
+        :param name: Channel name.  Must be a valid identifier.
+        :param callback: Called with the payload of every notification, including our own.
+        :param on_leader_change: Called with True or False when this channel gains or loses leadership.
+        """
+        self.engine = engine
+        self.name = name
+        self.callback = callback
+        self.on_leader_change = on_leader_change
+        self.key = lock_key(name)
+        self.leader = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+
+    def _connect(self):
+        import psycopg2.extensions
+        fairy = self.engine.raw_connection()
+        fairy.detach()  # Keep it out of the pool; its lifetime is tied to our leadership.
+        conn = self._conn = getattr(fairy, 'dbapi_connection', None) or fairy.connection
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute('LISTEN "{}"'.format(self.name))
+        return conn
+
+    def _set_leader(self, leader):
+        if leader == self.leader:
+            return
+        self.leader = leader
+        if self.on_leader_change:
+            self.on_leader_change(leader)
+
+    def elect(self):
+        """
+        Attempts to become the leader.  Returns True if we are.
+        """
+        if not self.leader:
+            with self._conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+                self._set_leader(bool(cursor.fetchone()[0]))
+        return self.leader
+
+    def start(self):
+        self._connect()
+        self.elect()  # Settle initial leadership before the bot starts handling anything.
+        self._thread = threading.Thread(target=self._run, name='replication-listen', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._set_leader(False)
+                    self._connect()
+                self.elect()
+                if select.select([self._conn], [], [], self.POLL_INTERVAL) == ([], [], []):
+                    continue
+                self._conn.poll()
+                while self._conn.notifies:
+                    notify = self._conn.notifies.pop(0)
+                    self.callback(notify.payload)
+            except Exception:
+                traceback.print_exc()
+                self._set_leader(False)
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._stop.wait(self.POLL_INTERVAL)
+
+    def publish(self, payload):
+        with self.engine.begin() as conn:
+            conn.execute(sa.text("SELECT pg_notify(:channel, :payload)"), {'channel': self.name, 'payload': payload})
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._conn is not None and not self._conn.closed:
+            self._conn.close()  # Also releases the advisory lock.
+        self._set_leader(False)
+
+
+class BoardReplicator:
+    """
+    Publishes changes made to a RescueBoard while leading, and applies changes received from the leader otherwise.
+
+    Instances are board listeners: register them with RescueBoard(listeners=[replicator]).  Outgoing events are
+    coalesced per case by a sender thread, so a burst of changes to one case results in a single notification.
+    Incoming events are applied by a separate thread, since applying one usually involves an API call.
+    """
+    def __init__(self, apply, on_leader_change=None):
+        """
+        :param apply: Called with each incoming event dict.  Must not raise.
+        :param on_leader_change: Called with True or False when this instance gains or loses leadership.
+        """
+        self.origin = uuid.uuid4().hex[:12]
+        self.apply = apply
+        self.on_leader_change = on_leader_change
+        self.channel = None
+        self.seq = itertools.count(1)
+        self.last_seen = {}  # origin -> last sequence number received
+
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()  # rescue id -> event
+        self._incoming = collections.deque()
+        self._stopping = False
+        self._threads = []
+
+    @property
+    def leader(self):
+        return self.channel is not None and self.channel.leader
+
+    def start(self, channel):
+        """
+        Starts replication over the specified transport, which should have been created with our receive() and
+        leader_changed() as callbacks.
+        """
+        self.channel = channel
+        for target, name in ((self._send_loop, 'replication-send'), (self._apply_loop, 'replication-apply')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        channel.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        if self.channel:
+            self.channel.close()
+
+    def leader_changed(self, leader):
+        if leader:
+            with self._cond:
+                self._incoming.clear()  # Anything still queued is stale; we're the authority now.
+        if self.on_leader_change:
+            try:
+                self.on_leader_change(leader)
+            except Exception:
+                traceback.print_exc()
+
+    def __call__(self, event, rescue):
+        """
+        Board listener.  Queues a change for publication if we are leading.
+        """
+        if not self.leader or rescue.id is None:
+            return  # Cases are only announced once the API has assigned them an id.
+        with self._cond:
+            previous = self._pending.pop(rescue.id, None)
+            if previous and previous['e'] == Event.ADD and event == Event.CHANGE:
+                event = Event.ADD
+            self._pending[rescue.id] = {'e': event, 'i': rescue.id, 'b': rescue.boardindex}
+            self._cond.notify_all()
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                _, event = self._pending.popitem(last=False)
+            event.update(o=self.origin, s=next(self.seq))
+            try:
+                self.channel.publish(json.dumps(event, separators=(',', ':')))
+            except Exception:
+                traceback.print_exc()
+
+    def receive(self, payload):
+        """
+        Transport callback.  Queues incoming events from other instances.
+        """
+        try:
+            event = json.loads(payload)
+            origin, seq = event['o'], event['s']
+        except (ValueError, KeyError, TypeError):
+            print("[Replication] Ignoring malformed event: {!r}".format(payload))
+            return
+        if origin == self.origin or self.leader:
+            return
+        last = self.last_seen.get(origin)
+        self.last_seen[origin] = seq
+        with self._cond:
+            if last is not None and seq != last + 1:
+                # Lost events (e.g. reconnected listener).  Start over from the API.
+                self._incoming.clear()
+                self._incoming.append({'e': Event.RESYNC, 'o': origin, 's': seq})
+            self._incoming.append(event)
+            self._cond.notify_all()
+
+    def _apply_loop(self):
+        while True:
+            with self._cond:
+                while not self._incoming and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                event = self._incoming.popleft()
+            try:
+                self.apply(event)
+            except Exception:
+                traceback.print_exc()
+
+
+# Shared by all bots in this process that use 'local' replication.
+LOCAL_HUB = LocalHub()
+
+
+def setup(bot, apply, on_leader_change=None):
+    """
+    Starts replication for this bot, if enabled in its configuration.  Returns the BoardReplicator or None.
+
+    :param bot: Sopel bot
+    :param apply: Called with each incoming event dict from the leader.
+    :param on_leader_change: Called with True or False when this instance gains or loses leadership.
+    """
+    config = bot.config.ratbot
+    bot.memory['ratbot']['replication'] = None
+    if config.replication in (None, 'off'):
+        return None
+    replicator = BoardReplicator(apply, on_leader_change)
+    name = config.replication_channel
+    if config.replication == 'local':
+        channel = LocalChannel(LOCAL_HUB, name, replicator.receive, replicator.leader_changed)
+    else:
+        engine = bot.memory['ratbot']['engine']
+        channel = PostgresChannel(engine, name, replicator.receive, replicator.leader_changed)
+    bot.memory['ratbot']['replication'] = replicator
+    replicator.start(channel)
+    print("[Replication] Instance {} on channel {!r}: {}".format(
+        replicator.origin, name, "leading" if replicator.leader else "following"
+    ))
+    return replicator
+
+
+def shutdown(bot):
+    replicator = bot.memory['ratbot'].get('replication')
+    if replicator is not None:
+        replicator.stop()
+        bot.memory['ratbot']['replication'] = None
+
+
+def is_leader(bot):
+    """
+    Returns True if this instance should answer in channel: either it leads, or replication is disabled.
+    """
+    replicator = bot.memory['ratbot'].get('replication') if 'ratbot' in bot.memory else None
+    return replicator is None or replicator.leader
+
+
+def require_leader(fn):
+    """
+    Decorator that silently ignores triggers on instances that are not leading.
+    """
+    @functools.wraps(fn)
+    def wrapper(bot, trigger, *args, **kwargs):
+        if not is_leader(bot):
+            return NOLIMIT
+        return fn(bot, trigger, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,95 @@
+"""
+Waypoint route planning over a spatial index of starsystems.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+This is the same greedy search the find_route() database function performs: from each waypoint, aim maxdistance
+towards the target, search a growing sphere around that point, and jump to the reachable system closest to the target.
+Candidate distances are computed with NumPy, which releases the GIL, so several plans can run on threads at once.
+"""
+import collections
+
+import numpy as np
+
+
+__all__ = ['Waypoint', 'PlotCancelled', 'plan_route']
+
+
+Waypoint = collections.namedtuple('Waypoint', ['eddb_id', 'location', 'distance', 'remaining', 'final'])
+
+
+class PlotCancelled(Exception):
+    """Raised by plan_route() when its cancel event is set."""
+    def __init__(self, waypoints):
+        super().__init__("Plot cancelled after {} jumps.".format(max(len(waypoints) - 1, 0)))
+        self.waypoints = waypoints
+
+
+def _distance(a, b):
+    return float(np.sqrt(((np.asarray(a) - np.asarray(b)) ** 2).sum()))
+
+
+def plan_route(index, source, target, maxdistance, cancel=None, progress=None, max_jumps=None):
+    """
+    Plans a route from source to target with jumps of at most maxdistance.
+
+    :param index: SpatialIndex of starsystems, with eddb_ids as ids.
+    :param source: (eddb_id, (x, y, z)) of the starting system.
+    :param target: (eddb_id, (x, y, z)) of the destination system.
+    :param maxdistance: Maximum distance between waypoints.
+    :param cancel: Optional threading.Event.  If it is set, PlotCancelled is raised at the next waypoint.
+    :param progress: Optional function called with each Waypoint as it is found.
+    :param max_jumps: Gives up after this many jumps.  Defaults to ten times the minimum needed.
+    :return: A list of Waypoints, starting with the source.  If the last one is not final, the search got stuck.
+    """
+    source_id, here = source[0], np.asarray(source[1], dtype=np.float64)
+    target_id, goal = target[0], np.asarray(target[1], dtype=np.float64)
+    remaining = _distance(here, goal)
+    if max_jumps is None:
+        max_jumps = 10 * int(remaining // maxdistance + 1) + 10
+    min_radius = min(maxdistance, max(20.0, maxdistance / 16))
+    max_radius = 2 * maxdistance
+
+    waypoints = []
+
+    def add(waypoint):
+        waypoints.append(waypoint)
+        if progress:
+            progress(waypoint)
+
+    add(Waypoint(source_id, tuple(map(float, here)), 0.0, remaining, source_id == target_id))
+    while not waypoints[-1].final and len(waypoints) <= max_jumps:
+        if cancel is not None and cancel.is_set():
+            raise PlotCancelled(waypoints)
+        if remaining <= maxdistance:
+            add(Waypoint(target_id, tuple(map(float, goal)), remaining, 0.0, True))
+            break
+
+        aim = here + (goal - here) * (maxdistance / remaining)
+        radius = min_radius
+        found = None
+        while radius <= max_radius:
+            indices, _ = index.within_indices(aim, radius)
+            radius *= 2
+            if not len(indices):
+                continue
+            coords = index.coords[indices]
+            from_here = np.sqrt(((coords - here) ** 2).sum(axis=1))
+            to_goal = np.sqrt(((coords - goal) ** 2).sum(axis=1))
+            usable = np.flatnonzero((from_here <= maxdistance) & (to_goal < remaining))
+            if len(usable):
+                best = usable[np.argmin(to_goal[usable])]
+                found = indices[best], from_here[best], to_goal[best]
+                break
+        if found is None:
+            break  # Stuck: nothing reachable is closer to the target.
+        position, distance, remaining = found
+        here = index.coords[position]
+        eddb_id = index.ids[position].item()
+        add(Waypoint(eddb_id, tuple(map(float, here)), float(distance), float(remaining), eddb_id == target_id))
+    return waypoints
@@ -0,0 +1,247 @@
+"""
+Prioritised task scheduling.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+Work is divided into named lanes, each with its own queue and concurrency limit, so that a multi-hour starsystem
+refresh cannot hold up case saves.  Within a lane, tasks run in priority order (lowest value first), then in order of
+submission.
+
+Lanes of kind 'process' hand their tasks to a process pool (so functions and arguments must be picklable), but are
+otherwise scheduled exactly like thread lanes.  None of the default lanes need one.
+"""
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+__all__ = ['Priority', 'Lane', 'Scheduler', 'DEFAULT_LANES']
+
+
+class Priority:
+    """Common task priorities.  Any number will do; lower runs first."""
+    URGENT = 0  # Code red case saves
+    HIGH = 10
+    NORMAL = 20
+    LOW = 30
+
+
+class Lane:
+    """
+    A queue of tasks and the workers that run them.
+    """
+    SAMPLES = 1000  # Number of recent queue latencies kept for percentiles.
+
+    def __init__(self, name, workers, kind='thread'):
+        """
+        :param name: Lane name.
+        :param workers: Maximum number of tasks from this lane running at once.
+        :param kind: 'thread' or 'process'.
+        """
+        if kind not in ('thread', 'process'):
+            raise ValueError("Unknown lane kind {!r}".format(kind))
+        self.name = name
+        self.workers = workers
+        self.kind = kind
+        self.pool = None
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._threads = []
+        self._shutdown = False
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.waits = collections.deque(maxlen=self.SAMPLES)
+        self.max_wait = 0.0
+
+    def submit(self, priority, fn, args=(), kwargs=None):
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Cannot schedule new tasks after shutdown")
+            heapq.heappush(self._queue, (priority, next(self._seq), time.monotonic(), future, fn, args, kwargs or {}))
+            self.submitted += 1
+            if len(self._threads) < self.workers and len(self._threads) < self.running + len(self._queue):
+                self._start_worker()
+            self._cond.notify()
+        return future
+
+    def _start_worker(self):
+        if self.kind == 'process' and self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        thread = threading.Thread(
+            target=self._work, name="scheduler-{}-{}".format(self.name, len(self._threads)), daemon=True
+        )
+        self._threads.append(thread)
+        thread.start()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._shutdown:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                priority, seq, queued, future, fn, args, kwargs = heapq.heappop(self._queue)
+                if not future.set_running_or_notify_cancel():
+                    self.cancelled += 1
+                    continue
+                wait = time.monotonic() - queued
+                self.waits.append(wait)
+                self.max_wait = max(self.max_wait, wait)
+                self.running += 1
+
+            try:
+                if self.pool is not None:
+                    result = self.pool.submit(fn, *args, **kwargs).result()
+                else:
+                    result = fn(*args, **kwargs)
+            except BaseException as ex:
+                future.set_exception(ex)
+                ok = False
+            else:
+                future.set_result(result)
+                ok = True
+
+            with self._cond:
+                self.running -= 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def shutdown(self, wait=True, cancel_pending=False, timeout=None):
+        """
+        Stops accepting tasks.  Queued tasks still run unless cancel_pending is True.
+
+        :param wait: Wait for running (and, if not cancelled, queued) tasks to finish.
+        :param cancel_pending: Cancel tasks that have not started.
+        :param timeout: Maximum time to wait for each worker, or None to wait indefinitely.
+        """
+        with self._cond:
+            self._shutdown = True
+            if cancel_pending:
+                for item in self._queue:
+                    if item[3].cancel():
+                        self.cancelled += 1
+                self._queue.clear()
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join(timeout)
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
+
+    def stats(self):
+        """
+        Returns a dict of counters and queue latencies (in seconds) for this lane.
+        """
+        with self._cond:
+            waits = sorted(self.waits)
+            result = {
+                'kind': self.kind, 'workers': self.workers, 'queued': len(self._queue), 'running': self.running,
+                'submitted': self.submitted, 'completed': self.completed, 'failed': self.failed,
+                'cancelled': self.cancelled, 'max_wait': self.max_wait,
+            }
+        for name, pct in (('p50', 50), ('p95', 95), ('p99', 99)):
+            result['wait_' + name] = waits[min(len(waits) - 1, len(waits) * pct // 100)] if waits else None
+        return result
+
+
+# name: (workers, kind)
+DEFAULT_LANES = collections.OrderedDict([
+    ('interactive', (6, 'thread')),  # API calls made on behalf of someone in channel, e.g. case saves.
+    ('background', (2, 'thread')),   # Bulk and long-running jobs, e.g. starsystem refreshes.
+    ('routing', (4, 'thread')),      # Route plots; NumPy releases the GIL, and the spatial index is too big to pickle.
+    ('lookup', (3, 'thread')),       # Calls to third-party services that may hang, e.g. the Systems API.
+    ('shortener', (2, 'thread')),    # Paperwork links shortened ahead of time; a resync can queue one per case.
+])
+
+
+class Scheduler:
+    """
+    Collection of lanes.
+
+    Also usable as a drop-in concurrent.futures Executor: submit() and map() use the default lane at normal priority.
+    """
+    def __init__(self, lanes=None, default='interactive'):
+        """
+        :param lanes: Mapping of lane name to (workers, kind).  Defaults to DEFAULT_LANES.
+        :param default: Name of the lane used by submit().
+        """
+        self.lanes = collections.OrderedDict(
+            (name, Lane(name, workers, kind)) for name, (workers, kind) in (lanes or DEFAULT_LANES).items()
+        )
+        if default not in self.lanes:
+            raise ValueError("Default lane {!r} is not defined.".format(default))
+        self.default = default
+        self._shutdown = False
+
+    def schedule(self, lane, fn, args=(), kwargs=None, priority=Priority.NORMAL):
+        """
+        Schedules fn(*args, **kwargs) on the named lane.  Returns a Future.
+
+        :param lane: Lane name.
+        :param fn: Function to call.
+        :param args: Positional arguments.
+        :param kwargs: Keyword arguments.
+        :param priority: Task priority.  See Priority.
+        """
+        try:
+            lane = self.lanes[lane]
+        except KeyError:
+            raise ValueError("Unknown lane {!r}".format(lane)) from None
+        return lane.submit(priority, fn, args, kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.schedule(self.default, fn, args, kwargs)
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+
+        def results():
+            for future in futures:
+                yield future.result(timeout)
+        return results()
+
+    def shutdown(self, wait=True, cancel_pending=False, timeout=None):
+        """
+        Shuts down all lanes.  Safe to call more than once.
+
+        :param wait: Wait for tasks to finish.
+        :param cancel_pending: Cancel tasks that have not started.
+        :param timeout: Maximum time to wait for each worker thread, or None to wait indefinitely.
+        """
+        if self._shutdown:
+            return
+        self._shutdown = True
+        for lane in self.lanes.values():
+            try:
+                lane.shutdown(wait=wait, cancel_pending=cancel_pending, timeout=timeout)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        """
+        Returns a dict mapping lane names to Lane.stats()
+        """
+        return collections.OrderedDict((name, lane.stats()) for name, lane in self.lanes.items())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
@@ -0,0 +1,160 @@
+"""
+Scanning outgoing text for client details.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+Anything the bot publishes outside IRC (tweets, for instance) must not name a client or where they are.
+SensitiveTerms is a board listener that keeps the client names, nicknames and systems of every open case, and matches
+text against all of them at once with an Aho-Corasick automaton: one pass over the text, however many cases are open,
+and without touching the board or its lock.  The automaton is only rebuilt when the set of terms actually changes, and
+then lazily by the next scan.
+"""
+import collections
+import threading
+
+from ratlib.replication import Event
+
+
+__all__ = ['Automaton', 'SensitiveTerms', 'scan']
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton over a fixed set of terms.  Matching is case-insensitive and ignores where words begin or end.
+    """
+    def __init__(self, terms):
+        self.terms = sorted({term.casefold() for term in terms if term})
+        goto = [{}]
+        output = [()]
+        for ix, term in enumerate(self.terms):
+            node = 0
+            for char in term:
+                child = goto[node].get(char)
+                if child is None:
+                    child = goto[node][char] = len(goto)
+                    goto.append({})
+                    output.append(())
+                node = child
+            output[node] += (ix,)
+
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                output[child] += output[fail[child]]
+        self.goto, self.fail, self.output = goto, fail, output
+
+    def __len__(self):
+        return len(self.terms)
+
+    def finditer(self, text):
+        """
+        Yields (end, term) for every occurrence of a term in text, where end is the position just past the match in
+        text.casefold().
+        """
+        goto, fail, output, terms = self.goto, self.fail, self.output, self.terms
+        node = 0
+        for pos, char in enumerate(text.casefold()):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for ix in output[node]:
+                yield pos + 1, terms[ix]
+
+    def search(self, text):
+        """
+        Returns the first term found in text, or None.
+        """
+        for _, term in self.finditer(text):
+            return term
+        return None
+
+
+class SensitiveTerms:
+    """
+    Board listener (see RescueBoard.listeners) that tracks the sensitive terms of each case.
+
+    :ivar terms_of: Function returning the terms of a case.
+    :ivar rebuilds: Number of times the automaton was rebuilt.
+    """
+    def __init__(self, terms_of):
+        self.terms_of = terms_of
+        self.rebuilds = 0
+        self._lock = threading.Lock()
+        self._cases = {}  # id(case) -> frozenset of terms
+        self._counts = collections.Counter()
+        self._automaton = Automaton(())
+        self._stale = False
+
+    def __call__(self, event, case):
+        terms = frozenset() if event == Event.REMOVE else frozenset(
+            term.casefold() for term in self.terms_of(case) if term
+        )
+        with self._lock:
+            old = self._cases.pop(id(case), frozenset())
+            if terms:
+                self._cases[id(case)] = terms
+            if old == terms:
+                return
+            for term in old - terms:
+                self._counts[term] -= 1
+                if not self._counts[term]:
+                    del self._counts[term]
+                    self._stale = True
+            for term in terms - old:
+                if not self._counts[term]:
+                    self._stale = True
+                self._counts[term] += 1
+
+    def reset(self, cases=()):
+        """
+        Forgets every case, then adds cases.  Used when the board is replaced wholesale.
+        """
+        with self._lock:
+            self._cases.clear()
+            self._counts.clear()
+            self._stale = True
+        for case in cases:
+            self(Event.ADD, case)
+
+    @property
+    def automaton(self):
+        """
+        The automaton for the current terms, rebuilding it first if they changed.
+        """
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._automaton = Automaton(self._counts)
+                    self._stale = False
+                    self.rebuilds += 1
+        return self._automaton
+
+    def search(self, text):
+        """
+        Returns the first sensitive term found in text, or None.
+        """
+        return self.automaton.search(text)
+
+    def stats(self):
+        automaton = self.automaton
+        return {'cases': len(self._cases), 'terms': len(automaton), 'states': len(automaton.goto),
+                'rebuilds': self.rebuilds}
+
+
+def scan(bot, text):
+    """
+    Returns the first client detail of an open case found in text, or None.  Use before publishing text anywhere.
+    """
+    return bot.memory['ratbot']['sensitive'].search(text)
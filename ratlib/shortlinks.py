@@ -0,0 +1,110 @@
+"""
+Short links made ahead of time.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+Links are shortened on the scheduler's own small shortener lane and remembered in workdir/shortlinks.json, so a URL is
+only ever sent to the shortener once, and a burst of new cases (e.g. at startup) never ties up the interactive lane.
+Callers that need a link right away get the short link if it is known and the long one otherwise; nothing waits on the
+shortener unless it asks to.
+"""
+import concurrent.futures
+import threading
+import traceback
+
+from ratlib.jsonstore import get_store
+from ratlib.scheduler import Priority
+
+
+__all__ = ['ShortLinks', 'paperwork_url']
+
+
+def paperwork_url(id):
+    """
+    Returns the URL of the paperwork for the rescue with the given API id.
+    """
+    return "https://fuelrats.com/paperwork/{id}/edit".format(id=id)
+
+
+class ShortLinks:
+    """
+    Background URL shortening with a persistent cache.
+
+    :ivar limit: Number of links to remember.  The oldest are forgotten first.
+    """
+    def __init__(self, bot, filename='shortlinks.json', limit=5000):
+        self.bot = bot
+        self.store = get_store(bot, filename)
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._pending = {}  # url -> Future
+
+    def cached(self, url):
+        """
+        Returns the short link for url if it is known, or None.
+        """
+        with self.store.lock:
+            return self.store.data.get(url)
+
+    def request(self, url, priority=Priority.LOW):
+        """
+        Starts shortening url unless its short link is known or already being made.
+
+        :param priority: Priority on the shortener lane.  Use a higher one if someone is waiting for the link.
+        :return: A Future of the short link, or None if it is known or no shortener is configured.
+        """
+        if self.cached(url):
+            return None
+        shortener = self.bot.memory['ratbot'].get('shortener')
+        if not shortener:
+            return None
+        with self._lock:
+            future = self._pending.get(url)
+            if future is None:
+                if self.cached(url):
+                    return None  # Finished since we last looked.
+                future = self._pending[url] = self.bot.memory['ratbot']['executor'].schedule(
+                    'shortener', self._shorten, (shortener, url), priority=priority
+                )
+            return future
+
+    def _shorten(self, shortener, url):
+        try:
+            short = shortener.shorten(url)['shorturl']
+            with self.store.change() as links:
+                links[url] = short
+                while len(links) > self.limit:
+                    del links[next(iter(links))]
+            return short
+        except Exception:
+            print("[ShortLinks] Couldn't shorten {}".format(url))
+            traceback.print_exc()
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+
+    def link(self, url, wait=0):
+        """
+        Returns the short link for url if it is known, or url itself.  Starts shortening url if needed.
+
+        :param url: URL to shorten.
+        :param wait: Seconds to wait for the shortener if the short link is not known yet.
+        """
+        short = self.cached(url)
+        if short:
+            return short
+        future = self.request(url, priority=Priority.HIGH if wait else Priority.LOW)
+        if future is not None and wait:
+            try:
+                return future.result(timeout=wait)
+            except concurrent.futures.TimeoutError:
+                pass
+            except Exception:
+                pass  # Logged by _shorten.
+        return url
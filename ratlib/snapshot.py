@@ -0,0 +1,256 @@
+"""
+Columnar on-disk snapshot of the starsystem catalogue.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+A snapshot is a directory of flat files, written at the end of each starsystem refresh:
+
+    meta.json            Version (status.starsystem_refreshed), row count and file list.
+    eddb_id.npy          int32, sorted ascending.
+    coords.npy           float32 (N, 3) of (x, y, z); NaN where unknown.
+    prefix.npy           int32 index into the prefix arrays.
+    name_offsets.npy     int64 (N + 1); name i is names.bin[name_offsets[i]:name_offsets[i + 1]], UTF-8.
+    names.bin
+    prefix_word_ct.npy   int16 word count of each prefix.
+    prefix_offsets.npy   int64; first words, as for names.
+    prefix_words.bin
+
+Everything is opened with memory mapping, so loading costs next to nothing and every process using the same snapshot
+shares the same pages.  Snapshots are written to a new directory and published by atomically replacing
+starsystems.json, which names the current directory; open snapshots keep working after their files are removed.
+"""
+import datetime
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import sqlalchemy as sa
+
+from ratlib.db import Starsystem, StarsystemPrefix, get_status
+
+
+__all__ = ['SNAPSHOT_FORMAT', 'version_of', 'write_snapshot', 'StarsystemSnapshot', 'open_snapshot', 'get_snapshot']
+
+
+SNAPSHOT_FORMAT = 1
+POINTER = 'starsystems.json'
+
+
+def version_of(refreshed):
+    """
+    Returns the snapshot version string for a status.starsystem_refreshed timestamp.
+    """
+    return refreshed.astimezone(datetime.timezone.utc).isoformat() if refreshed else None
+
+
+class _Column:
+    """Growable NumPy array, written out once complete."""
+    def __init__(self, dtype, capacity, width=None):
+        self.shape = (width,) if width else ()
+        self.data = np.empty((capacity,) + self.shape, dtype=dtype)
+        self.count = 0
+
+    def extend(self, values):
+        end = self.count + len(values)
+        if end > len(self.data):
+            self.data = np.resize(self.data, (max(end, 2 * len(self.data)),) + self.shape)
+        self.data[self.count:end] = values
+        self.count = end
+
+    def save(self, filename):
+        np.save(filename, self.data[:self.count])
+
+
+class _Strings:
+    """Offset-indexed UTF-8 blob, written as it grows."""
+    def __init__(self, path, offsets, capacity):
+        self.file = open(path + '.bin', 'wb')
+        self.offsets = _Column(np.int64, capacity + 1)
+        self.offsets.extend([0])
+        self.offsets_file = offsets
+        self.position = 0
+
+    def extend(self, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        lengths = np.fromiter((len(item) for item in encoded), dtype=np.int64, count=len(encoded))
+        self.offsets.extend(self.position + np.cumsum(lengths))
+        self.position += int(lengths.sum())
+        self.file.write(b''.join(encoded))
+
+    def close(self):
+        self.file.close()
+        self.offsets.save(self.offsets_file)
+
+
+def write_snapshot(db, workdir, version, chunksize=100000, keep=1):
+    """
+    Writes a snapshot of the starsystem tables and publishes it.
+
+    :param db: Database session.
+    :param workdir: Directory to write to.
+    :param version: Snapshot version, from version_of().
+    :param chunksize: Rows fetched at a time.
+    :param keep: Number of previous snapshot directories to keep.
+    :return: Path of the new snapshot directory.
+    """
+    name = 'starsystems.{}'.format(uuid.uuid4().hex[:12])
+    path = os.path.join(workdir, name)
+    os.makedirs(path)
+    try:
+        prefixes = db.query(StarsystemPrefix.first_word, StarsystemPrefix.word_ct) \
+            .order_by(StarsystemPrefix.first_word, StarsystemPrefix.word_ct).all()
+        prefix_ids = {prefix: ix for ix, prefix in enumerate(prefixes)}
+        words = _Strings(os.path.join(path, 'prefix_words'), os.path.join(path, 'prefix_offsets.npy'), len(prefixes))
+        words.extend([word for word, _ in prefixes])
+        words.close()
+        np.save(os.path.join(path, 'prefix_word_ct.npy'), np.array([ct for _, ct in prefixes], dtype=np.int16))
+
+        conn = db.connection()
+        capacity = int(conn.execute(sa.text(
+            "SELECT reltuples::bigint FROM pg_class WHERE relname = :table"
+        ), {'table': Starsystem.__tablename__}).scalar() or 1024)
+        capacity = max(capacity, 1024)
+        ids = _Column(np.int32, capacity)
+        coords = _Column(np.float32, capacity, 3)
+        prefix = _Column(np.int32, capacity)
+        names = _Strings(os.path.join(path, 'names'), os.path.join(path, 'name_offsets.npy'), capacity)
+
+        result = conn.execution_options(stream_results=True).execute(sa.text(
+            "SELECT eddb_id, name, first_word, word_ct, (xz[0])::float8, y::float8, (xz[1])::float8"
+            " FROM {} ORDER BY eddb_id".format(Starsystem.__tablename__)
+        ))
+        nan = float('nan')
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+            ids.extend([row[0] for row in rows])
+            names.extend([row[1] for row in rows])
+            prefix.extend([prefix_ids.get((row[2], row[3]), -1) for row in rows])
+            coords.extend([
+                (nan if row[4] is None else row[4], nan if row[5] is None else row[5], nan if row[6] is None else row[6])
+                for row in rows
+            ])
+        names.close()
+        ids.save(os.path.join(path, 'eddb_id.npy'))
+        coords.save(os.path.join(path, 'coords.npy'))
+        prefix.save(os.path.join(path, 'prefix.npy'))
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump({
+                'format': SNAPSHOT_FORMAT, 'version': version, 'count': ids.count, 'prefixes': len(prefixes),
+                'written': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            }, f)
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+    # Publish
+    pointer = os.path.join(workdir, POINTER)
+    try:
+        with open(pointer, 'r', encoding='utf8') as f:
+            history = json.load(f).get('history', [])
+    except (OSError, ValueError):
+        history = []
+    temp = pointer + '.tmp'
+    with open(temp, 'w', encoding='utf8') as f:
+        json.dump({'current': name, 'version': version, 'history': [name] + history[:keep]}, f)
+    os.replace(temp, pointer)
+    for old in history[keep:]:
+        shutil.rmtree(os.path.join(workdir, old), ignore_errors=True)
+    return path
+
+
+class StarsystemSnapshot:
+    """
+    A read-only, memory-mapped snapshot.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError("Unsupported snapshot format {!r}".format(self.meta.get('format')))
+        self.version = self.meta['version']
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        def blob(name):
+            filename = os.path.join(path, name + '.bin')
+            if not os.path.getsize(filename):
+                return b''  # Empty files cannot be memory-mapped.
+            return np.memmap(filename, dtype=np.uint8, mode='r')
+
+        self.eddb_id = load('eddb_id')
+        self.coords = load('coords')
+        self.prefix = load('prefix')
+        self.name_offsets = load('name_offsets')
+        self.names_blob = blob('names')
+        self.prefix_word_ct = load('prefix_word_ct')
+        self.prefix_offsets = load('prefix_offsets')
+        self.prefix_words_blob = blob('prefix_words')
+
+    def __len__(self):
+        return len(self.eddb_id)
+
+    def name(self, ix):
+        """Returns the name of the system at position ix."""
+        return bytes(self.names_blob[self.name_offsets[ix]:self.name_offsets[ix + 1]]).decode('utf-8')
+
+    def prefix_of(self, ix):
+        """Returns the (first_word, word_ct) prefix of the system at position ix, or None."""
+        prefix = int(self.prefix[ix])
+        if prefix < 0:
+            return None
+        word = bytes(self.prefix_words_blob[self.prefix_offsets[prefix]:self.prefix_offsets[prefix + 1]])
+        return word.decode('utf-8'), int(self.prefix_word_ct[prefix])
+
+    def find(self, eddb_id):
+        """Returns the position of the system with the given eddb_id, or None."""
+        ix = int(np.searchsorted(self.eddb_id, eddb_id))
+        return ix if ix < len(self.eddb_id) and self.eddb_id[ix] == eddb_id else None
+
+    def with_coordinates(self):
+        """Returns (eddb_ids, coords) of systems with known coordinates, as float64."""
+        known = ~np.isnan(self.coords).any(axis=1)
+        return np.asarray(self.eddb_id[known], dtype=np.int64), np.asarray(self.coords[known], dtype=np.float64)
+
+
+def open_snapshot(workdir, version=None):
+    """
+    Opens the current snapshot in workdir.  Returns None if there is none, or if version is given and does not match.
+    """
+    try:
+        with open(os.path.join(workdir, POINTER), 'r', encoding='utf8') as f:
+            pointer = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if version is not None and pointer.get('version') != version:
+        return None
+    try:
+        snapshot = StarsystemSnapshot(os.path.join(workdir, pointer['current']))
+    except (OSError, ValueError, KeyError) as ex:
+        print("Unable to open starsystem snapshot: " + str(ex))
+        return None
+    if version is not None and snapshot.version != version:
+        return None
+    return snapshot
+
+
+def get_snapshot(bot, db):
+    """
+    Returns the snapshot matching the database's last starsystem refresh, opening it if needed, or None.
+    """
+    version = version_of(get_status(db).starsystem_refreshed)
+    snapshot = bot.memory['ratbot'].get('starsystem_snapshot')
+    if snapshot is None or snapshot.version != version:
+        snapshot = open_snapshot(bot.config.ratbot.workdir, version) if version else None
+        bot.memory['ratbot']['starsystem_snapshot'] = snapshot
+    return snapshot
@@ -10,14 +10,19 @@ under the Eiffel Forum License, version 2
 
 See LICENSE.md
 """
+import collections
 import datetime
 import os.path
 import re
-import concurrent.futures
 import functools
 
+import ratlib.autocorrect
 import ratlib.db
+import ratlib.jsonstore
+import ratlib.scheduler
+import ratlib.spatial
 import ratlib.starsystem
+from ratlib.util import timed, TimedResult
 from sopel.config import StaticSection, types
 from sopel.tools import Identifier
 from sopel.tools import SopelMemory
@@ -27,7 +32,7 @@ import itertools
 
 __all__ = [
     'BooleanAttribute', 'RatbotConfigurationSection', 'configure', 'setup',  # Sopel setup
-    'best_channel_mode', 'OutputFilterWrapper', 'filter_output',  # IRC utility
+    'best_channel_mode', 'OutputFilter', 'OutputFilterWrapper', 'filter_output',  # IRC utility
     'makepath',  # General utility
     'cmd_version'
 ]
@@ -61,6 +66,7 @@ class RatbotConfigurationSection(StaticSection):
     alembic = types.FilenameAttribute('alembic', directory=False, default='alembic.ini')
     debug_sql = BooleanAttribute('debug_sql', default=False)
     sapi_url = types.ValidatedAttribute('sapi_url', str, default="https://system.api.fuelrats.com/")
+    sapi_budget = types.ValidatedAttribute('sapi_budget', float, default=3.0)
     edsm_url = types.ValidatedAttribute('edsm_url', str, default="http://edsm.net/api-v1/systems?coords=1")
     edsm_maxage = types.ValidatedAttribute('edsm_maxage', int, default=12*60*60)
     edsm_autorefresh = types.ValidatedAttribute('edsm_autorefresh', int, default=4*60*60)
@@ -72,6 +78,17 @@ class RatbotConfigurationSection(StaticSection):
     debug_channel = types.ValidatedAttribute('debug_channel', str, default='#mechadeploy')
     chunked_systems = BooleanAttribute('chunked_systems', default=True)  # Should be edsm_chunked_systems to fit others
     hastebin_url = types.ValidatedAttribute('hastebin_url', 'str', default="http://hastebin.com/")
+    db_pool_size = types.ValidatedAttribute('db_pool_size', int, default=10)
+    db_max_overflow = types.ValidatedAttribute('db_max_overflow', int, default=5)
+    db_pool_timeout = types.ValidatedAttribute('db_pool_timeout', int, default=30)
+    db_leak_timeout = types.ValidatedAttribute('db_leak_timeout', int, default=120)
+    db_slow_query = types.ValidatedAttribute('db_slow_query', float, default=0.5)
+    spatial_systems = BooleanAttribute('spatial_systems', default=False)
+    maxplots = types.ValidatedAttribute('maxplots', int, default=4)
+    autocorrect_cache = types.ValidatedAttribute('autocorrect_cache', int, default=1024)
+    autocorrect_validate = BooleanAttribute('autocorrect_validate', default=True)
+    replication = types.ChoiceAttribute('replication', ['off', 'postgres', 'local'], default='off')
+    replication_channel = types.ValidatedAttribute('replication_channel', str, default='ratboard')
 
 
 def parameterize(params=None, usage=None, split=re.compile(r'\s+').split):
@@ -87,8 +104,8 @@ def parameterize(params=None, usage=None, split=re.compile(r'\s+').split):
     be added on based on splitting the trigger text into words and mapping them against the characters appearing in
     'params', as follows:
 
-    'r': Parameter will be the case found by board.find(..., create=False).  Outputs an error message instead of
-    calling the wrapped function if the case is not found.
+    'r': Parameter will be the case found by board.find(..., create=False, fuzzy=True).  Outputs an error message
+    instead of calling the wrapped function if the case is not found.
     'R': As above, but the case can be created.
     'f': Like 'r', but the parameter will be the entire find() result tuple (rescue, created)
     'F': Like 'R', but the parameter will be the entire find() result tuple (rescue, created)
@@ -100,6 +117,8 @@ def parameterize(params=None, usage=None, split=re.compile(r'\s+').split):
     't': Parameter will be the entire remainder of the line.
     'T': Same as 't'.  Backwards compatibility.
 
+    Only 'r' and 'f' fall back to fuzzy matching of client names; 'R' and 'F' create a case instead.
+
     Any remaining 'words' in the argument will be passed to the wrapped function as additional parameters, as params
     contained enough 'w's to pad to the end of the argument list.
 
@@ -144,7 +163,8 @@ def parameterize(params=None, usage=None, split=re.compile(r'\s+').split):
                         if param and param in 'rRfF':
                             if value == bot.config.ratboard.signal:
                                 return bot.reply('No, i am NOT adding a rescue to save '+value+'! Come on, this is dispatch rule #97 !')
-                            value = bot.memory['ratbot']['board'].find(value, create=param in 'RF')
+                            create = param in 'RF'
+                            value = bot.memory['ratbot']['board'].find(value, create=create, fuzzy=not create)
                             if not value[0]:
                                 return bot.reply('Could not find a case with that name or number.')
                             if param in 'rR':
@@ -203,6 +223,9 @@ def configure(config):
     config.ratbot.configure_setting('alembic', "Path to alembic.ini for database upgrades.")
     config.ratbot.configure_setting('debug_sql', "True if SQLAlchemy should echo query information.")
     config.ratbot.configure_setting('sapi_url', "URL of the Systems API to use to gather starsystem data.")
+    config.ratbot.configure_setting(
+        'sapi_budget', "Seconds !search waits for the Systems API before searching the local database (0 = forever)"
+    )
     config.ratbot.configure_setting('edsm_url', "DEPRECATED - URL for EDSM system data")
     config.ratbot.configure_setting('edsm_maxage', "DEPRECATED - Maximum age of EDSM system data in seconds")
     config.ratbot.configure_setting('edsm_autorefresh', "DEPRECATED - EDSM autorefresh frequency in seconds (0=disable)")
@@ -213,6 +236,27 @@ def configure(config):
     config.ratbot.configure_setting('shortenertoken', "The Auth token the shortener should use")
     config.ratbot.configure_setting('debug_channel', "Channel for debug output")
     config.ratbot.configure_setting('hastebin_url', "Hastebin base URL")
+    config.ratbot.configure_setting('db_pool_size', "Number of database connections to keep open")
+    config.ratbot.configure_setting('db_max_overflow', "Extra database connections allowed during bursts")
+    config.ratbot.configure_setting('db_pool_timeout', "Seconds to wait for a free database connection")
+    config.ratbot.configure_setting(
+        'db_leak_timeout', "Warn about database connections held longer than this many seconds (0 disables)"
+    )
+    config.ratbot.configure_setting(
+        'db_slow_query', "Log SQL statements taking at least this many seconds, with parameters (0 disables)"
+    )
+    config.ratbot.configure_setting(
+        'spatial_systems', "True to keep every starsystem's coordinates in memory, not just landmarks (uses more RAM)"
+    )
+    config.ratbot.configure_setting('maxplots', "Maximum number of !plots running or queued at once")
+    config.ratbot.configure_setting('autocorrect_cache', "Number of system name autocorrections to remember")
+    config.ratbot.configure_setting(
+        'autocorrect_validate', "True to check autocorrected system names against the local starsystem database"
+    )
+    config.ratbot.configure_setting(
+        'replication', "Board replication between instances: off, postgres (LISTEN/NOTIFY) or local (in-process)"
+    )
+    config.ratbot.configure_setting('replication_channel', "Channel name shared by replicated instances")
 
 
 def setup(bot):
@@ -222,9 +266,12 @@ def setup(bot):
     :param bot: Sopel bot being setup.
     """
     if 'ratbot' in bot.memory:
+        if bot.memory['ratbot'].get('shut_down'):
+            restart(bot)
         return
 
     # Attempt to determine some semblance of a version number.
+    version_timer = TimedResult()
     version = None
     try:
         if bot.config.ratbot.version_string:
@@ -254,20 +301,62 @@ def setup(bot):
     print("Starting Ratbot version " + version)
 
     bot.memory['ratbot'] = SopelMemory()
-    bot.memory['ratbot']['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=10)  # Queue
+    bot.memory['ratbot']['executor'] = ratlib.scheduler.Scheduler()  # See ratlib.scheduler for lanes
     bot.memory['ratbot']['version'] = version
     bot.memory['ratbot']['stats'] = SopelMemory()
+    bot.memory['ratbot']['stores'] = SopelMemory()  # See ratlib.jsonstore
     bot.memory['ratbot']['stats']['started'] = datetime.datetime.now(tz=datetime.timezone.utc)
-    ratlib.db.setup(bot)
-    ratlib.starsystem.refresh_bloom(bot)
-    ratlib.starsystem.refresh_database(
-        bot,
-        callback=lambda: print("EDSM database is out of date.  Starting background refresh."),
-        background=True
+    ratlib.autocorrect.cache.resize(bot.config.ratbot.autocorrect_cache)
+    phases = bot.memory['ratbot']['stats']['startup'] = collections.OrderedDict(version=version_timer.stop())
+    with timed() as t:
+        ratlib.db.setup(bot)  # Records its own phases.
+    phases['db'] = t.seconds
+    with timed() as t:
+        ratlib.starsystem.refresh_bloom(bot)
+    phases['bloom'] = t.seconds
+    bot.memory['ratbot']['executor'].schedule(
+        'background', ratlib.spatial.refresh, (bot,), priority=ratlib.scheduler.Priority.LOW
     )
+    with timed() as t:
+        ratlib.starsystem.refresh_database(
+            bot,
+            callback=lambda: print("EDSM database is out of date.  Starting background refresh."),
+            background=True
+        )
+    phases['starsystem_check'] = t.seconds
+    print("Startup took {:.2f} seconds ({})".format(
+        sum(phases[key] for key in ('version', 'db', 'bloom', 'starsystem_check')),
+        ", ".join("{}: {:.2f}".format(key, value) for key, value in phases.items())
+    ))
+
+def restart(bot):
+    """
+    Brings back what shutdown() stopped.
+
+    Sopel's .reload calls a module's shutdown() hook and then its setup() hook, but the scheduler and database are
+    shared by every rat-* module, so setup() calls this when they have been shut down.  JSONStores need nothing: they
+    remain usable after being closed.
+    """
+    bot.memory['ratbot']['executor'] = ratlib.scheduler.Scheduler()
+    ratlib.db.restart(bot)
+    bot.memory['ratbot']['shut_down'] = False
+
 
 def shutdown(bot):
-    print('shutting down?')
+    """
+    Common shutdown for all rat-* modules.  Call in each module's shutdown() hook; only the first call does anything
+    until setup() is called again (see restart()).
+
+    Tasks that have not started yet are cancelled, and running ones get a few seconds to finish.  Pending JSONStore
+    changes are written.
+    """
+    if 'ratbot' not in bot.memory or bot.memory['ratbot'].get('shut_down'):
+        return
+    print("Shutting down Ratbot")
+    bot.memory['ratbot']['shut_down'] = True
+    bot.memory['ratbot']['executor'].shutdown(wait=True, cancel_pending=True, timeout=5)
+    ratlib.db.shutdown(bot)
+    ratlib.jsonstore.close_stores(bot)
 
 def makepath(dir, filename):
     """
@@ -281,24 +370,79 @@ def makepath(dir, filename):
     return filename if os.path.isabs(filename) else os.path.join(dir, filename)
 
 
+class OutputFilter:
+    """
+    Applies a list of (pattern, replacement) regex substitutions to output in a single pass.
+
+    All patterns are combined into one alternation, and the alternative that matched determines which replacement
+    gets expanded.  Results are memoized, since the same lines (case listings, quotes, facts) tend to be output over
+    and over again.
+
+    Patterns are re-matched against the matched text to expand their replacement, so they should not rely on
+    lookarounds or word boundaries outside of their own match.
+    """
+    FLAGS = (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE))
+
+    def __init__(self, replacements, cachesize=1024):
+        """
+        Creates a new OutputFilter.
+
+        :param replacements: Sequence of (compiled pattern, replacement template) tuples, applied in order of priority.
+        :param cachesize: Maximum number of memoized results.  0 disables caching.
+        """
+        self.replacements = list(replacements)
+        self.dispatch = {}
+        parts = []
+        for ix, (pattern, repl) in enumerate(self.replacements):
+            group = "_f{}".format(ix)
+            flags = "".join(char for char, flag in self.FLAGS if pattern.flags & flag)
+            parts.append("(?P<{group}>(?{flags}:{pattern}))".format(group=group, flags=flags, pattern=pattern.pattern))
+            self.dispatch[group] = (pattern, repl)
+        self.regex = re.compile("|".join(parts)) if parts else None
+        if cachesize:
+            self.transform = functools.lru_cache(maxsize=cachesize)(self.transform)
+
+    def _expand(self, match):
+        pattern, repl = self.dispatch[match.lastgroup]
+        return pattern.fullmatch(match.group(0)).expand(repl)
+
+    def transform(self, message):
+        """
+        Returns message with all replacements applied.
+        """
+        if self.regex is None:
+            return message
+        return self.regex.sub(self._expand, message)
+
+
 class OutputFilterWrapper:
     """
     Wraps a SopelBot or SopelWrapper
     """
+    __slots__ = ('_bot',)
+
     # List of regex replacements to perform on output.
     replacements = [
         (re.compile(r'(r)at(signal)', re.IGNORECASE), r'\g<1>@\g<2>'),
         (re.compile('(cod|cas)e (r)e(d)', re.IGNORECASE), r'\g<1>3 \g<2>3\g<3>')
     ]
-    _bot = None
 
     def __init__(self, bot):
         super().__setattr__('_bot', bot)
 
+    @classmethod
+    def get_filter(cls):
+        """
+        Returns the OutputFilter for this class's replacements, building it on first use.
+        """
+        result = cls.__dict__.get('_filter')
+        if result is None:
+            result = OutputFilter(cls.replacements)
+            type.__setattr__(cls, '_filter', result)
+        return result
+
     def transform(self, message):
-        for pattern, repl in self.replacements:
-            message = pattern.sub(repl, message)
-        return message
+        return self.get_filter().transform(message)
 
     def say(self, message, *args, transform=True, **kwargs):
         if transform:
@@ -345,6 +489,52 @@ def filter_output(fn):
     """
     @functools.wraps(fn)
     def wrapper(bot, trigger):
-        bot = OutputFilterWrapper(bot)
+        if not isinstance(bot, OutputFilterWrapper):  # Don't wrap twice when filtered commands call each other.
+            bot = OutputFilterWrapper(bot)
         return fn(bot, trigger)
     return wrapper
+
+
+def benchmark_filter(messages=None, number=10000):
+    """
+    Measures output filtering overhead.  Returns a dict of average seconds per message.
+
+    'sequential' is the old approach of running each replacement in turn, 'combined' is a single pass with memoization
+    disabled and 'cached' is the filter as it is actually used.
+
+    :param messages: Messages to filter.  Defaults to a mix of case lines that do and don't need filtering.
+    :param number: Number of passes over the messages.
+    """
+    import timeit
+
+    if messages is None:
+        messages = [
+            "[0]Some Client(CR) PC, [1]Other Client XB, [2]Third Client PS4",
+            "Received RATSIGNAL from SomeClient.  Calling all available rats!  (Case 3, PC)",
+            "CODE RED! SomeClient is on emergency oxygen.",
+            "[3][Mecha 2m,10s ago] Incoming Client: Some Client - System: Eravate - Platform: PC - O2: OK",
+            "Assigned rats: RatOne, RatTwo, RatThree",
+        ]
+    replacements = OutputFilterWrapper.replacements
+
+    def sequential():
+        for message in messages:
+            for pattern, repl in replacements:
+                message = pattern.sub(repl, message)
+
+    uncached = OutputFilter(replacements, cachesize=0)
+    cached = OutputFilter(replacements)
+
+    def run(fn):
+        return timeit.timeit(fn, number=number) / (number * len(messages))
+
+    return {
+        'sequential': run(sequential),
+        'combined': run(lambda: [uncached.transform(message) for message in messages]),
+        'cached': run(lambda: [cached.transform(message) for message in messages]),
+    }
+
+
+if __name__ == '__main__':
+    for name, seconds in benchmark_filter().items():
+        print("{:>10}: {:.3f} usec/message".format(name, seconds * 1e6))
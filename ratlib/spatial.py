@@ -0,0 +1,514 @@
+"""
+In-memory spatial index of starsystem coordinates.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+Coordinates are held in NumPy arrays sorted by uniform grid cell, so the points in any block of cells can be found with
+a binary search per cell.  Nearest-neighbour searches start with a box one cell across and double it until enough
+points are inside the search sphere; queries spanning more than MAX_CELLS cells just scan everything, which for the
+few hundred landmarks is what happens anyway.
+
+Indexes are rebuilt by refresh() after each starsystem refresh and stored in bot.memory['ratbot']['spatial'].
+Landmarks are always indexed.  Indexing every starsystem takes a few hundred megabytes, so it is only done if the
+spatial_systems setting is enabled.  Starsystem coordinates come from the current snapshot (see ratlib.snapshot) if
+there is one, and from the database otherwise.
+
+Run this module with a database URL to benchmark it against the starsystem_distance() SQL function, and to compare
+bulk coordinate reads against the ORM.
+"""
+import collections
+import time
+
+import numpy as np
+import sqlalchemy as sa
+
+from ratlib.db import with_session, Landmark, Starsystem
+from ratlib.snapshot import get_snapshot
+from ratlib.util import timed
+
+
+__all__ = [
+    'Match', 'SpatialIndex', 'read_coordinates', 'load_landmarks', 'load_starsystems', 'refresh', 'get_index',
+    'nearest_landmark'
+]
+
+
+Match = collections.namedtuple('Match', ['id', 'name', 'distance'])
+
+
+class SpatialIndex:
+    """
+    Grid index of points in 3D space.
+    """
+    MAX_CELLS = 4096     # Queries covering more cells than this scan all points instead.
+    MIN_CELL_SIZE = 1.0  # Light years.
+    _BITS = 21           # Bits per axis in a cell key.
+    _OFFSET = 1 << (_BITS - 1)
+
+    def __init__(self, ids, coords, names=None, cell_size=None, per_cell=16):
+        """
+        :param ids: Sequence of identifiers, one per point.
+        :param coords: Sequence of (x, y, z) coordinates.
+        :param names: Optional sequence of names, one per point.
+        :param cell_size: Grid cell size.  By default, chosen so that an average cell holds per_cell points.
+        :param per_cell: Target number of points per cell, if cell_size is not specified.
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        ids = np.asarray(ids)
+        if len(ids) != len(coords):
+            raise ValueError("ids and coords must be the same length.")
+        if cell_size is None:
+            cell_size = self.suggest_cell_size(coords, per_cell)
+        self.cell_size = max(float(cell_size), self.MIN_CELL_SIZE)
+
+        keys = self._keys(self._cells(coords))
+        order = np.argsort(keys, kind='stable')
+        self.coords = coords[order]
+        self.ids = ids[order]
+        self.names = None if names is None else np.asarray(names, dtype=object)[order]
+        self.cell_keys, self.cell_starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        self.cell_ends = self.cell_starts + counts
+
+    @classmethod
+    def suggest_cell_size(cls, coords, per_cell=16):
+        """
+        Returns a cell size giving about per_cell points per cell if coords were spread evenly over their bounding box.
+        """
+        if len(coords) < 2:
+            return cls.MIN_CELL_SIZE
+        extent = np.maximum(coords.max(axis=0) - coords.min(axis=0), cls.MIN_CELL_SIZE)
+        return float((np.prod(extent) * per_cell / len(coords)) ** (1 / 3))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cells(self, coords):
+        return np.floor(np.asarray(coords) / self.cell_size).astype(np.int64)
+
+    @classmethod
+    def _keys(cls, cells):
+        cells = cells + cls._OFFSET
+        return (cells[..., 0] << (2 * cls._BITS)) | (cells[..., 1] << cls._BITS) | cells[..., 2]
+
+    def _candidates(self, point, radius):
+        """
+        Returns indices of all points in cells that intersect a box of the given radius around point, or None if that
+        box covers too many cells to be worth it.
+        """
+        lo = self._cells(point - radius)
+        hi = self._cells(point + radius)
+        if np.prod(hi - lo + 1) > min(self.MAX_CELLS, len(self.cell_keys)):
+            return None
+        grid = np.stack(
+            np.meshgrid(*(np.arange(a, b + 1) for a, b in zip(lo, hi)), indexing='ij'), axis=-1
+        ).reshape(-1, 3)
+        keys = self._keys(grid)
+        pos = np.searchsorted(self.cell_keys, keys)
+        found = pos < len(self.cell_keys)
+        pos, keys = pos[found], keys[found]
+        pos = pos[self.cell_keys[pos] == keys]
+        starts, lengths = self.cell_starts[pos], self.cell_ends[pos] - self.cell_starts[pos]
+        # Concatenate the ranges starts[i]:starts[i]+lengths[i]
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+
+    def _distances(self, indices, point):
+        delta = self.coords if indices is None else self.coords[indices]
+        return np.sqrt(((delta - point) ** 2).sum(axis=1))
+
+    def within_indices(self, point, radius):
+        """
+        Returns (indices, distances) of all points within radius of point, nearest first.
+        """
+        point = np.asarray(point, dtype=np.float64)
+        indices = self._candidates(point, radius)
+        if indices is None:
+            indices = np.arange(len(self.ids))
+        distances = self._distances(indices, point)
+        mask = distances <= radius
+        indices, distances = indices[mask], distances[mask]
+        order = np.argsort(distances, kind='stable')
+        return indices[order], distances[order]
+
+    def nearest_indices(self, point, k=1, max_distance=None):
+        """
+        Returns (indices, distances) of the k points nearest to point, nearest first.  Fewer are returned if the index
+        is smaller than k or if fewer than k points lie within max_distance.
+        """
+        point = np.asarray(point, dtype=np.float64)
+        radius = self.cell_size
+        while True:
+            if max_distance is not None and radius >= max_distance:
+                radius = max_distance
+            indices = self._candidates(point, radius)
+            exhaustive = indices is None
+            if exhaustive:
+                indices = np.arange(len(self.ids))
+            distances = self._distances(indices, point)
+            limit = max_distance if exhaustive else radius
+            if limit is not None:
+                mask = distances <= limit
+                indices, distances = indices[mask], distances[mask]
+            if len(indices) >= k or exhaustive or radius == max_distance:
+                break
+            radius *= 2
+        if len(indices) > k:
+            part = np.argpartition(distances, k - 1)[:k]
+            indices, distances = indices[part], distances[part]
+        order = np.argsort(distances, kind='stable')
+        return indices[order], distances[order]
+
+    def nearest_many_indices(self, points, k=1, max_distance=None, chunk=256):
+        """
+        Batch version of nearest_indices().  Returns (indices, distances) arrays of shape (len(points), k), padded
+        with -1 and infinity where fewer than k points were found.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        k = min(k, len(self.ids))
+        indices = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.inf)
+        if not k:
+            return indices, distances
+        if len(self.ids) <= 1024:
+            # Small index: compute the whole distance matrix, a chunk of queries at a time.
+            for start in range(0, len(points), chunk):
+                block = points[start:start + chunk]
+                matrix = np.sqrt(((block[:, None, :] - self.coords[None, :, :]) ** 2).sum(axis=2))
+                if max_distance is not None:
+                    matrix[matrix > max_distance] = np.inf
+                part = np.argpartition(matrix, k - 1, axis=1)[:, :k] if k < len(self.ids) else \
+                    np.tile(np.arange(k), (len(block), 1))
+                dist = np.take_along_axis(matrix, part, axis=1)
+                order = np.argsort(dist, axis=1, kind='stable')
+                part, dist = np.take_along_axis(part, order, axis=1), np.take_along_axis(dist, order, axis=1)
+                part[np.isinf(dist)] = -1
+                indices[start:start + chunk], distances[start:start + chunk] = part, dist
+            return indices, distances
+        for row, point in enumerate(points):
+            found, dist = self.nearest_indices(point, k, max_distance)
+            indices[row, :len(found)], distances[row, :len(found)] = found, dist
+        return indices, distances
+
+    def _matches(self, indices, distances):
+        names = self.names
+        ids = self.ids.tolist()  # Converts NumPy scalars to Python types.
+        return [
+            Match(ids[ix], None if names is None else names[ix], float(distance))
+            for ix, distance in zip(indices, distances) if ix >= 0
+        ]
+
+    def within(self, point, radius):
+        """
+        Returns a list of Matches for all points within radius of point, nearest first.
+        """
+        return self._matches(*self.within_indices(point, radius))
+
+    def nearest(self, point, k=1, max_distance=None):
+        """
+        Returns a list of Matches for the k points nearest to point, nearest first.
+        """
+        return self._matches(*self.nearest_indices(point, k, max_distance))
+
+    def nearest_many(self, points, k=1, max_distance=None):
+        """
+        Returns a list of lists of Matches, one list per point.
+        """
+        indices, distances = self.nearest_many_indices(points, k, max_distance)
+        return [self._matches(*row) for row in zip(indices, distances)]
+
+    def within_many(self, points, radius):
+        """
+        Returns a list of lists of Matches, one list per point.
+        """
+        return [self.within(point, radius) for point in np.asarray(points, dtype=np.float64).reshape(-1, 3)]
+
+
+def _load(db, columns, table, chunksize=100000):
+    """
+    Selects (id, name) columns and coordinates from table and returns a SpatialIndex of them.
+    """
+    ids, names, coords = [], [], []
+    # Raw SQL, since SQLPoint does not support subscripts and decoding points row by row is slow.
+    statement = sa.text(
+        "SELECT {columns}, xz[0], y, xz[1] FROM {table} WHERE xz IS NOT NULL AND y IS NOT NULL"
+        .format(columns=columns, table=table)
+    )
+    result = db.connection().execution_options(stream_results=True).execute(statement)
+    while True:
+        rows = result.fetchmany(chunksize)
+        if not rows:
+            break
+        ids.extend(row[0] for row in rows)
+        names.extend(row[1] for row in rows)
+        coords.append(np.array([row[2:] for row in rows], dtype=np.float64))
+    coords = np.concatenate(coords) if coords else np.empty((0, 3))
+    return SpatialIndex(ids, coords, names=names if any(name is not None for name in names) else None)
+
+
+class _BinaryCopyReader:
+    """
+    File-like sink for COPY ... TO STDOUT (FORMAT binary) of (int4, float8, float8, float8) rows without NULLs.
+
+    Every such row has the same size, so each chunk received is decoded with a single np.frombuffer() straight into
+    preallocated arrays.
+    """
+    SIGNATURE = b'PGCOPY\n\xff\r\n\0'
+    ROW = np.dtype([
+        ('fields', '>i2'),
+        ('id_len', '>i4'), ('id', '>i4'),
+        ('x_len', '>i4'), ('x', '>f8'),
+        ('y_len', '>i4'), ('y', '>f8'),
+        ('z_len', '>i4'), ('z', '>f8'),
+    ])
+
+    def __init__(self, capacity):
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.coords = np.empty((capacity, 3), dtype=np.float64)
+        self.count = 0
+        self._pending = b''
+        self._header = False
+
+    def write(self, data):
+        buf = self._pending + bytes(data)
+        pos = 0
+        if not self._header:
+            if len(buf) < 19:
+                self._pending = buf
+                return
+            if buf[:11] != self.SIGNATURE:
+                raise ValueError("Not a binary COPY stream.")
+            pos = 19 + int.from_bytes(buf[15:19], 'big')  # Skip the header extension area.
+            if len(buf) < pos:
+                self._pending = buf
+                return
+            self._header = True
+        count = (len(buf) - pos) // self.ROW.itemsize
+        if count:
+            rows = np.frombuffer(buf, dtype=self.ROW, count=count, offset=pos)
+            if not (
+                (rows['fields'] == 4).all() and (rows['id_len'] == 4).all() and (rows['x_len'] == 8).all()
+                and (rows['y_len'] == 8).all() and (rows['z_len'] == 8).all()
+            ):
+                raise ValueError("Unexpected row layout in COPY stream.")
+            self._append(rows)
+            pos += count * self.ROW.itemsize
+        self._pending = buf[pos:]  # Partial row, or the end-of-data marker.
+
+    def _append(self, rows):
+        end = self.count + len(rows)
+        if end > len(self.ids):
+            capacity = max(end, 2 * len(self.ids))
+            self.ids = np.resize(self.ids, capacity)
+            self.coords = np.resize(self.coords, (capacity, 3))
+        self.ids[self.count:end] = rows['id']
+        self.coords[self.count:end, 0] = rows['x']
+        self.coords[self.count:end, 1] = rows['y']
+        self.coords[self.count:end, 2] = rows['z']
+        self.count = end
+
+
+def read_coordinates(db, table=None, key='eddb_id', limit=None, chunksize=1 << 20):
+    """
+    Reads the integer key and coordinates of every row with known coordinates in table, as fast as possible.
+
+    Uses a binary COPY where the driver supports it, so no value is ever converted to a Python object; otherwise
+    selects the coordinates as plain floats.
+
+    :param db: Database session.
+    :param table: Table name.  Defaults to starsystem.
+    :param key: Integer (int4) key column.
+    :param limit: Maximum number of rows to read.
+    :param chunksize: Bytes per read from a binary COPY, or rows per fetch otherwise.
+    :return: (ids, coords), where ids is an int64 array and coords is a (len(ids), 3) float64 array of (x, y, z).
+    """
+    table = table or Starsystem.__tablename__
+    select = (
+        "SELECT {key}::int4, (xz[0])::float8, y::float8, (xz[1])::float8 FROM {table}"
+        " WHERE xz IS NOT NULL AND y IS NOT NULL"
+    ).format(key=key, table=table)
+    if limit is not None:
+        select += " LIMIT {:d}".format(limit)
+    conn = db.connection()
+    capacity = conn.execute(sa.text(
+        "SELECT reltuples::bigint FROM pg_class WHERE relname = :table"  # Estimate; the reader grows as needed.
+    ), {'table': table}).scalar() or 1024
+    if limit is not None:
+        capacity = min(capacity, limit)
+    cursor = conn.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            reader = _BinaryCopyReader(max(int(capacity), 1024))
+            cursor.copy_expert("COPY ({}) TO STDOUT (FORMAT binary)".format(select), reader, size=chunksize)
+            return reader.ids[:reader.count].copy(), reader.coords[:reader.count].copy()
+    finally:
+        cursor.close()
+
+    ids, coords = [], []
+    result = conn.execution_options(stream_results=True).execute(sa.text(select))
+    while True:
+        rows = result.fetchmany(min(chunksize, 100000))
+        if not rows:
+            break
+        block = np.array(rows, dtype=np.float64)
+        ids.append(block[:, 0].astype(np.int64))
+        coords.append(block[:, 1:])
+    if not ids:
+        return np.empty(0, dtype=np.int64), np.empty((0, 3))
+    return np.concatenate(ids), np.concatenate(coords)
+
+
+def load_landmarks(db):
+    """
+    Returns a SpatialIndex of all landmarks with known coordinates.  Ids are lowercase names.
+    """
+    return _load(db, "name_lower, name", Landmark.__tablename__)
+
+
+def load_starsystems(db):
+    """
+    Returns a SpatialIndex of all starsystems with known coordinates.  Ids are eddb_ids; names are not loaded.
+    """
+    return SpatialIndex(*read_coordinates(db))
+
+
+@with_session(long_running=True)
+def refresh(bot, systems=None, db=None):
+    """
+    Rebuilds the spatial indexes.
+
+    :param bot: Bot instance
+    :param systems: True to index all starsystems, as well as landmarks.  Defaults to the spatial_systems setting.
+    :param db: Database handle
+    """
+    if systems is None:
+        systems = bot.config.ratbot.spatial_systems
+    with timed() as t:
+        landmarks = load_landmarks(db)
+        starsystems = None
+        if systems:
+            snapshot = get_snapshot(bot, db)
+            starsystems = SpatialIndex(*snapshot.with_coordinates()) if snapshot else load_starsystems(db)
+    bot.memory['ratbot']['spatial'] = {'landmarks': landmarks, 'systems': starsystems}
+    bot.memory['ratbot']['stats']['spatial'] = {
+        'landmarks': len(landmarks), 'systems': len(starsystems) if starsystems is not None else None, 'time': t.seconds
+    }
+    return bot.memory['ratbot']['spatial']
+
+
+def get_index(bot, name):
+    """
+    Returns the named spatial index ('landmarks' or 'systems'), or None if it has not been built.
+    """
+    return (bot.memory['ratbot'].get('spatial') or {}).get(name)
+
+
+def nearest_landmark(bot, point):
+    """
+    Returns a Match for the landmark nearest to point, or None if no landmarks are indexed.
+    """
+    index = get_index(bot, 'landmarks')
+    if not index:
+        return None
+    matches = index.nearest(point)
+    return matches[0] if matches else None
+
+
+def benchmark(db, samples=1000, k=1):
+    """
+    Times nearest-landmark lookups for random starsystems through a SpatialIndex and through starsystem_distance().
+
+    Returns a dict of timings in seconds per lookup, and the number of lookups where the two disagreed, as well as
+    where batch lookups through the index disagreed with single ones.
+    """
+    with timed() as t:
+        index = load_landmarks(db)
+    build = t.seconds
+    table = Starsystem.__table__
+    rows = db.execute(
+        sa.select([table.c.xz, table.c.y])
+        .where(sa.and_(table.c.xz.isnot(None), table.c.y.isnot(None)))
+        .order_by(sa.func.random()).limit(samples)
+    ).fetchall()
+    points = np.array([(row.xz.x, row.y, row.xz.z) for row in rows], dtype=np.float64).reshape(-1, 3)
+
+    started = time.perf_counter()
+    local = [index.nearest(point, k) for point in points]
+    local_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch = index.nearest_many(points, k)
+    batch_time = time.perf_counter() - started
+    batch_mismatches = sum(
+        [round(match.distance, 3) for match in one] != [round(match.distance, 3) for match in many]
+        for one, many in zip(local, batch)
+    )
+
+    distance = sa.func.starsystem_distance(Landmark.xz, Landmark.y, sa.func.point(sa.bindparam('x'), sa.bindparam('z')),
+                                           sa.bindparam('y'))
+    query = db.query(Landmark.name_lower, distance.label('distance')).filter(Landmark.has_coordinates) \
+        .order_by(distance).limit(k)
+    mismatches = 0
+    started = time.perf_counter()
+    for point, expected in zip(points, local):
+        remote = query.params(x=point[0], y=point[1], z=point[2]).all()
+        if [row.name_lower for row in remote] != [match.id for match in expected]:
+            # Ties can legitimately be ordered differently.
+            if [round(row.distance, 3) for row in remote] != [round(match.distance, 3) for match in expected]:
+                mismatches += 1
+    sql_time = time.perf_counter() - started
+
+    count = max(len(points), 1)
+    return {
+        'landmarks': len(index), 'lookups': len(points), 'build': build,
+        'index': local_time / count, 'index_batch': batch_time / count, 'sql': sql_time / count,
+        'mismatches': mismatches, 'batch_mismatches': batch_mismatches,
+    }
+
+
+def benchmark_read(db, rows=1000000):
+    """
+    Times reading rows starsystem coordinates through the ORM and through read_coordinates().
+
+    Returns a dict of seconds taken by each, and the number of rows read.
+    """
+    started = time.perf_counter()
+    count = 0
+    for xz, y in db.query(Starsystem.xz, Starsystem.y).filter(Starsystem.has_coordinates).limit(rows) \
+            .yield_per(100000):
+        count += 1
+    orm_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    ids, _ = read_coordinates(db, limit=rows)
+    bulk_time = time.perf_counter() - started
+    return {'rows': count, 'orm': orm_time, 'bulk': bulk_time, 'bulk_rows': len(ids)}
+
+
+if __name__ == '__main__':
+    import sys
+    from sqlalchemy import orm
+
+    if len(sys.argv) < 2:
+        print("Usage: python -m ratlib.spatial <database url> [samples]")
+        sys.exit(1)
+    session = orm.sessionmaker(sa.create_engine(sys.argv[1]))()
+    result = benchmark(session, samples=int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    print(
+        "{lookups} lookups over {landmarks} landmarks (index built in {build:.3f}s)\n"
+        "  SpatialIndex: {index_us:.1f} us/lookup, batched: {batch_us:.1f} us/lookup\n"
+        "  SQL:          {sql_us:.1f} us/lookup\n"
+        "  Mismatches:   {mismatches}"
+        .format(
+            index_us=result['index'] * 1e6, batch_us=result['index_batch'] * 1e6, sql_us=result['sql'] * 1e6,
+            **result
+        )
+    )
+    result = benchmark_read(session)
+    print(
+        "Reading {rows} starsystem coordinates: ORM {orm:.2f}s, read_coordinates() {bulk:.2f}s".format(**result)
+    )
@@ -0,0 +1,169 @@
+"""
+SQL statement profiling.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+
+QueryProfiler hooks an engine's cursor execution events and aggregates timings per statement shape: the SQL text with
+whitespace collapsed and expanded IN-lists folded, so the same query with different parameters counts as one.
+Statements slower than a threshold are logged with their parameters filled in.
+"""
+import collections
+import re
+import threading
+import time
+import traceback
+
+import sqlalchemy as sa
+
+from ratlib.literalstatement import literalquery
+
+
+__all__ = ['QueryProfiler', 'statement_shape']
+
+
+_re_whitespace = re.compile(r'\s+')
+# psycopg2-style placeholders in a list, as produced by IN (...) with many values.
+_re_bind_list = re.compile(r'%\([^)]+\)s(?:\s*,\s*%\([^)]+\)s)+')
+_re_bind = re.compile(r'%\([^)]+\)s|\?|:\w+')
+
+
+def statement_shape(statement):
+    """
+    Returns a normalized form of statement for grouping.  Bind parameter names are replaced by '?', so statements
+    differing only in generated parameter names are grouped too.
+    """
+    statement = _re_whitespace.sub(' ', statement).strip()
+    statement = _re_bind_list.sub('?, ...', statement)
+    return _re_bind.sub('?', statement)
+
+
+class ShapeStats:
+    """
+    Timings for one statement shape.  Times are in seconds.
+    """
+    SAMPLES = 512  # Number of recent timings kept for percentiles.
+
+    __slots__ = ('shape', 'count', 'total', 'max', 'rows', 'samples')
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.samples = collections.deque(maxlen=self.SAMPLES)
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if rows is not None and rows >= 0:
+            self.rows += rows
+        self.samples.append(seconds)
+
+    def as_dict(self):
+        samples = sorted(self.samples)
+        result = {
+            'shape': self.shape, 'count': self.count, 'total': self.total, 'max': self.max, 'rows': self.rows,
+            'mean': self.total / self.count if self.count else None,
+        }
+        for name, pct in (('p50', 50), ('p95', 95), ('p99', 99)):
+            result[name] = samples[min(len(samples) - 1, len(samples) * pct // 100)] if samples else None
+        return result
+
+
+class QueryProfiler:
+    """
+    Aggregates statement timings for an engine.
+    """
+    MAX_SHAPES = 2000  # Statements are normally generated from a fixed set of queries; this guards against the odd one.
+    MAX_SLOW = 50  # Number of slow statements remembered.
+
+    def __init__(self, slow_threshold=0.5, log=print):
+        """
+        :param slow_threshold: Statements taking at least this many seconds are logged.  None disables logging.
+        :param log: Function called with slow query log lines.
+        """
+        self._lock = threading.Lock()
+        self.shapes = {}
+        self.slow = collections.deque(maxlen=self.MAX_SLOW)
+        self.slow_threshold = slow_threshold
+        self.log = log
+        self.started = time.time()
+
+    def attach(self, engine):
+        sa.event.listen(engine, 'before_cursor_execute', self._before)
+        sa.event.listen(engine, 'after_cursor_execute', self._after)
+        return self
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_profiler_started', []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        try:
+            started = conn.info['_profiler_started'].pop()
+        except (KeyError, IndexError):
+            return
+        elapsed = time.perf_counter() - started
+        rows = getattr(cursor, 'rowcount', None)
+        shape = statement_shape(statement)
+        with self._lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                if len(self.shapes) >= self.MAX_SHAPES:
+                    shape = '<other>'
+                    stats = self.shapes.get(shape)
+                if stats is None:
+                    stats = self.shapes[shape] = ShapeStats(shape)
+            stats.add(elapsed, rows)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            literal = self.literal(cursor, statement, parameters, context)
+            self.slow.append({'time': time.time(), 'seconds': elapsed, 'rows': rows, 'statement': literal})
+            self.log("[SQL] Slow statement ({:.3f}s, {} rows): {}".format(elapsed, rows, literal))
+
+    @staticmethod
+    def literal(cursor, statement, parameters, context):
+        """
+        Returns statement with its parameters filled in, for logging only.
+        """
+        try:
+            if hasattr(cursor, 'mogrify') and not isinstance(parameters, (list, tuple)):
+                result = cursor.mogrify(statement, parameters)
+                return result.decode('utf-8', 'replace') if isinstance(result, bytes) else result
+            if context is not None and getattr(context, 'compiled', None) is not None:
+                return literalquery(context.compiled.statement)
+        except Exception:
+            traceback.print_exc()
+        return "{} -- {!r}".format(statement, parameters)
+
+    def top(self, n=10, key='total'):
+        """
+        Returns the as_dict() of the n statement shapes with the highest value of key, highest first.
+        """
+        with self._lock:
+            stats = [shape.as_dict() for shape in self.shapes.values()]
+        stats.sort(key=lambda item: item[key] or 0, reverse=True)
+        return stats if n is None else stats[:n]
+
+    def dump(self):
+        """
+        Returns everything recorded, as a JSON-serializable dict.
+        """
+        return {
+            'since': self.started,
+            'now': time.time(),
+            'slow_threshold': self.slow_threshold,
+            'statements': self.top(None),
+            'slow': list(self.slow),
+        }
+
+    def reset(self):
+        with self._lock:
+            self.shapes.clear()
+            self.slow.clear()
+            self.started = time.time()
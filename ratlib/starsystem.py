@@ -10,11 +10,15 @@ Licensed under the BSD 3-Clause License.
 
 See LICENSE.md
 """
+import collections
+import concurrent.futures
 import io
 import datetime
+import random
 import re
 import operator
 import threading
+import time
 from urllib.parse import urljoin, quote_plus
 import csv
 try:
@@ -28,12 +32,17 @@ from requests.exceptions import Timeout
 import sqlalchemy as sa
 from sqlalchemy import sql, orm, schema
 
-from ratlib.db import get_status, get_session, with_session, Starsystem, StarsystemPrefix, SQLPoint, Point
+from ratlib.db import get_status, session_scope, with_session, Starsystem, StarsystemPrefix, SQLPoint, Point
 from ratlib.bloom import BloomFilter
 from ratlib.timeutil import format_timestamp
 from ratlib.util import timed, TimedResult
+from ratlib.scheduler import Priority
+import ratlib.autocorrect
+import ratlib.snapshot
+import ratlib.spatial
 
 FLUSH_THRESHOLD = 25000  # Chunk size when refreshing starsystems
+SAPI_TIMEOUT = 10  # Seconds to wait for the Systems API to connect, and then between bytes of its response
 
 
 class ConcurrentOperationError(RuntimeError):
@@ -79,7 +88,7 @@ def refresh_database(
             _lock.release()
 
 
-@with_session
+@with_session(long_running=True)
 def _refresh_database(bot, force=False, prune=True, callback=None, background=False, db=None):
     """
     Actual implementation of refresh_database.
@@ -120,8 +129,9 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
 
     if background:
         print('Scheduling background refresh of starsystem data')
-        return bot.memory['ratbot']['executor'].submit(
-            _refresh_database, bot, force=True, callback=None, background=False
+        return bot.memory['ratbot']['executor'].schedule(
+            'background', _refresh_database, (bot,), dict(force=True, callback=None, background=False),
+            priority=Priority.LOW
         )
 
     conn = db.connection()
@@ -137,6 +147,8 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
         'stats': 0,     # Time spent (re)computing system statistics
         'bloom': 0,     # Time spent (re)building the system prefix bloom filter.
         'optimize': 0,  # Time spent optimizing/analyzing tables.
+        'snapshot': 0,  # Time spent writing the columnar snapshot.
+        'spatial': 0,   # Time spent rebuilding the spatial index.
         'misc': 0,      # Miscellaneous tasks (total time - all other stats)
         'total': 0,     # Total time spent.
     }
@@ -360,10 +372,27 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
         raise
     log("Starsystem database update committed")
 
+    with timed() as t:
+        log("Writing starsystem snapshot")
+        try:
+            db.refresh(status)
+            ratlib.snapshot.write_snapshot(
+                db, bot.config.ratbot.workdir, ratlib.snapshot.version_of(status.starsystem_refreshed)
+            )
+        except Exception:
+            import traceback
+            traceback.print_exc()  # Consumers fall back to the database.
+    stats['snapshot'] = t.seconds
+
     with timed() as t:
         log("Rebuilding bloom filter")
         refresh_bloom(bot)
+        validation_cache.clear()
     stats['bloom'] += t.seconds
+    with timed() as t:
+        log("Rebuilding spatial index")
+        ratlib.spatial.refresh(bot)
+    stats['spatial'] = t.seconds
 
     overall_timer.stop()
     stats['misc'] = overall_timer.seconds - sum(stats.values())
@@ -397,9 +426,9 @@ def refresh_bloom(bot, db=None):
     return bloom
 
 
-def sysapi_query(bot, system, querytype=None):
+def sysapi_query(bot, system, querytype=None, timeout=SAPI_TIMEOUT):
     """
-    Queries systems api for name matches or landmarks.
+    Queries systems api for name matches or landmarks.  Gives up after timeout seconds without a response.
     """
 
     sapi_url = bot.config.ratbot.sapi_url or "https://system.api.fuelrats.com/"
@@ -412,7 +441,7 @@ def sysapi_query(bot, system, querytype=None):
         endpoint = f"search?name={encoded}"
 
     try:
-        response = requests.get(urljoin(sapi_url, endpoint))
+        response = requests.get(urljoin(sapi_url, endpoint), timeout=timeout)
         if response.status_code != 200:
             return {"meta": {"error": "System API did not respond with valid data."}}
         result = response.json()
@@ -423,6 +452,174 @@ def sysapi_query(bot, system, querytype=None):
     return result
 
 
+def search_local(db, text, limit=10):
+    """
+    Searches starsystem names in the local database by trigram similarity.  Requires pg_trgm.
+
+    Returns a list of (name, similarity) tuples, best match first.
+
+    :param db: Database session.
+    :param text: System name to search for.
+    :param limit: Maximum number of results.
+    """
+    text = text.lower()
+    score = sql.func.similarity(Starsystem.name_lower, text)
+    query = (
+        db.query(Starsystem.name, score.label('similarity'))
+        .filter(Starsystem.name_lower.op('%')(text))  # Uses starsystem_name_trgm_ix
+        .order_by(score.desc(), Starsystem.name_lower)
+        .limit(limit)
+    )
+    return [(name, float(similarity)) for name, similarity in query]
+
+
+def search(bot, system, budget=None):
+    """
+    Searches for system names through the Systems API, falling back to search_local() if the API fails or takes
+    longer than budget seconds.
+
+    Returns the Systems API result, or a result in the same format with meta.source set to "local" for local results.
+
+    :param bot: Bot instance
+    :param system: System name to search for.
+    :param budget: Seconds to wait for the Systems API.  Defaults to the sapi_budget setting.
+    """
+    if budget is None:
+        budget = bot.config.ratbot.sapi_budget
+    future = bot.memory['ratbot']['executor'].schedule(
+        'lookup', sysapi_query, (bot, system, 'smart'), priority=Priority.HIGH
+    )
+    try:
+        result = future.result(timeout=budget or None)
+        if result and 'data' in result:
+            return result
+        if result and result.get('meta', {}).get('error') == "No hits.":
+            return result
+    except concurrent.futures.TimeoutError:
+        result = {"meta": {"error": "The request to Systems API timed out!"}}  # Left running, until SAPI_TIMEOUT.
+    except Exception as ex:
+        result = {"meta": {"error": str(ex)}}
+
+    try:
+        with session_scope(bot) as db:
+            matches = search_local(db, system)
+    except sa.exc.DBAPIError as ex:
+        print("[Search] Local search failed: " + str(ex))
+        return result
+    if not matches:
+        return {"meta": {"error": "No hits.", "source": "local"}}
+    return {
+        "meta": {"source": "local", "remote_error": (result or {}).get('meta', {}).get('error')},
+        "data": [{"name": name, "similarity": similarity} for name, similarity in matches],
+    }
+
+
+def benchmark_search(db, samples=200, limit=10, seed=None):
+    """
+    Times search_local() for randomly chosen systems with one character changed, as if mistyped.
+
+    Returns a dict with the mean and worst time per search in seconds, and how often the intended system was found.
+    """
+    rng = random.Random(seed)
+    names = [
+        row[0] for row in
+        db.query(Starsystem.name).order_by(sql.func.random()).limit(samples)
+    ]
+    times, found = [], 0
+    for name in names:
+        pos = rng.randrange(len(name))
+        typo = name[:pos] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[pos + 1:]
+        started = time.perf_counter()
+        result = search_local(db, typo, limit)
+        times.append(time.perf_counter() - started)
+        found += any(match.lower() == name.lower() for match, _ in result)
+    count = max(len(times), 1)
+    return {
+        'searches': len(times), 'mean': sum(times) / count, 'max': max(times, default=0.0),
+        'recall': found / count,
+        'systems': db.query(sql.func.count()).select_from(Starsystem).scalar(),
+    }
+
+
+ValidatedName = collections.namedtuple('ValidatedName', ['typed', 'name', 'confidence', 'checked'])
+ValidatedName.__doc__ = """
+Result of checking one possible system name against the catalogue.
+
+typed: The text as it appeared in the line.
+name: The existing system it most likely refers to, properly capitalized, or None.
+confidence: 1 / (number of different existing systems it could refer to), or 0 if none.
+checked: Number of candidate names looked up.
+"""
+
+
+# (sector, code as typed) -> ((name_lower, name) of each reading of the code that exists, ...).  Cleared after each
+# starsystem refresh.
+validation_cache = ratlib.autocorrect.CorrectionCache(maxsize=1024)
+
+
+def validate_names(bot, line):
+    """
+    Finds possible procedurally generated system names in line and checks every lookalike reading of them against the
+    starsystem catalogue.
+
+    Candidates whose first word is not in the bloom filter are discarded without a query; the rest are looked up in one
+    query.  Results are cached per sector and code, so the usual repeated mentions of a case's system cost nothing.
+
+    :param bot: Bot instance
+    :param line: Line of text.
+    :return: A list of ValidatedNames, one per possible system name.
+    """
+    candidate_sets = ratlib.autocorrect.CandidateSet.find_all(line)
+    if not candidate_sets:
+        return []
+    bloom = bot.memory['ratbot'].get('starsystem_bloom')
+    existing = {}  # (sector, code) -> ((name_lower, name), ...)
+    lookups = {}  # (sector, code) -> names to look up
+    for candidates in candidate_sets:
+        for sector in candidates.sectors:
+            key = (sector, candidates.code)
+            if key in existing or key in lookups:
+                continue
+            if bloom is not None and sector.split(' ', 1)[0] not in bloom:
+                continue  # Most chat words before a name are not sectors, and never reach the cache.
+            cached = validation_cache.lookup(key)
+            if cached is not None:
+                existing[key] = cached
+            else:
+                lookups[key] = [sector + code for code in candidates.codes]
+
+    if lookups:
+        wanted = {name for names in lookups.values() for name in names}
+        with session_scope(bot) as db:
+            found = dict(
+                db.query(Starsystem.name_lower, Starsystem.name).filter(Starsystem.name_lower.in_(wanted))
+            )
+        for key, names in lookups.items():
+            existing[key] = tuple((name, found[name]) for name in names if name in found)
+            validation_cache.store(key, existing[key])
+
+    results = []
+    for candidates in candidate_sets:
+        # Longer sector names were listed first; prefer them, then fewer changes.
+        matches = collections.OrderedDict(
+            match for sector in candidates.sectors for match in existing.get((sector, candidates.code), ())
+        )
+        typed = [sector + candidates.code for sector in candidates.sectors]
+        exact = next((name for name in typed if name in matches), None)
+        if exact:
+            distinct = [matches[exact]]  # What was typed exists; no doubt about it.
+        else:
+            distinct = []
+            for name in matches.values():
+                if name not in distinct:
+                    distinct.append(name)
+        results.append(ValidatedName(
+            candidates.typed, distinct[0] if distinct else None, 1 / len(distinct) if distinct else 0.0,
+            len(candidates.names)
+        ))
+    return results
+
+
 def validate(bot, system):
     """
     Validates if the given system name exists in the systems API.
@@ -437,7 +634,21 @@ def validate(bot, system):
 def get_nearest_landmark(bot, system):
     """
     Gets the nearest landmark to the given system. Assumes given system is correct.
+
+    Uses the local spatial index if the system's coordinates are known locally, and the Systems API otherwise.
     """
+    if ratlib.spatial.get_index(bot, 'landmarks'):
+        with session_scope(bot) as db:
+            starsystem = (
+                db.query(Starsystem)
+                .filter(Starsystem.name_lower == system.lower(), Starsystem.has_coordinates)
+                .first()
+            )
+            point = (starsystem.x, starsystem.y, starsystem.z) if starsystem else None
+        if point:
+            match = ratlib.spatial.nearest_landmark(bot, point)
+            if match:
+                return {'name': match.name, 'distance': match.distance}
     landmarkRes = sysapi_query(bot, system, 'landmark')
     if landmarkRes and landmarkRes.get('landmarks'):
         return landmarkRes['landmarks'][0]
@@ -489,9 +700,8 @@ def scan_for_systems(bot, line, min_ratio=0.05, min_length=6):
         return set()
 
     # Still here, so find prefixes in the database
-    db = get_session(bot)
     results = {}
-    try:
+    with session_scope(bot) as db:
         # Find matching prefixes
         for prefix in db.query(StarsystemPrefix).filter(
                 StarsystemPrefix.first_word.in_(candidates.keys()),
@@ -512,5 +722,18 @@ def scan_for_systems(bot, line, min_ratio=0.05, min_length=6):
                     results[prefix.first_word] = systemRes['meta']['name']
                     break
         return set(results.values())
-    finally:
-        db.rollback()
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage: python -m ratlib.starsystem <database url> [samples]")
+        sys.exit(1)
+    session = orm.sessionmaker(sa.create_engine(sys.argv[1]))()
+    result = benchmark_search(session, samples=int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+    print(
+        "{searches} searches over {systems} systems: {mean_ms:.1f} ms mean, {max_ms:.1f} ms worst,"
+        " intended system found {recall:.1%} of the time"
+        .format(mean_ms=result['mean'] * 1000, max_ms=result['max'] * 1000, **result)
+    )
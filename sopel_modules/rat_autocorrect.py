@@ -17,18 +17,47 @@ http://sopel.chat/
 
 This is currently a very rudimentary implementation, lacking any sort of configuration.
 """
+import traceback
+
 from sopel.module import rule, NOLIMIT
 import ratlib.autocorrect
+import ratlib.starsystem
+from ratlib.replication import require_leader
+
+
+def validate(bot, line):
+    """
+    Returns system names in line that could be checked against the starsystem catalogue, as a list of ValidatedNames
+    that found a system.  Empty if validation is disabled or unavailable.
+    """
+    if 'ratbot' not in bot.memory or not bot.config.ratbot.autocorrect_validate:
+        return []
+    try:
+        return [result for result in ratlib.starsystem.validate_names(bot, line) if result.name]
+    except Exception:
+        traceback.print_exc()
+        return []
+
 
 @rule(".+")
+@require_leader
 def correct_system(bot, trigger):
     line = trigger.group(0)
     result = ratlib.autocorrect.correct(line)
-    if result.fixed:
-        names = ", ".join(
-            '"...{old}" is probably "...{new}"'
-                .format(old=old, new=new) for old, new in result.corrections.items()
+    validated = validate(bot, line)
+
+    names = []
+    for item in validated:
+        if item.name.lower().endswith(item.typed.lower()):
+            continue  # Typed correctly.
+        names.append(
+            '"...{old}" is "{new}"'.format(old=item.typed, new=item.name) if item.confidence >= 1 else
+            '"...{old}" is probably "{new}"'.format(old=item.typed, new=item.name)
         )
-        bot.say("{names} (corrected for {nick})".format(names=names, nick=trigger.nick))
+    for old, new in result.corrections.items():
+        if any(old.lower() in item.typed.lower() or item.typed.lower() in old.lower() for item in validated):
+            continue  # The catalogue knows better.
+        names.append('"...{old}" is probably "...{new}"'.format(old=old, new=new))
+    if names:
+        bot.say("{names} (corrected for {nick})".format(names=", ".join(names), nick=trigger.nick))
     return NOLIMIT
-
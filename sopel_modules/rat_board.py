@@ -30,7 +30,8 @@ import threading
 from threading import Timer
 import operator
 import concurrent.futures
-import dateutil.parser
+import functools
+import json
 
 # Sopel imports
 from sopel.formatting import bold, color, colors
@@ -40,17 +41,25 @@ from sopel.config.types import StaticSection, ValidatedAttribute
 from sopel.module import require_privmsg, rate
 
 import ratlib.sopel
-from ratlib import timeutil, starsystem
+from ratlib import timeutil, starsystem, ratmama
 from ratlib.api.props import SystemNameProperty
-from ratlib.autocorrect import correct
-from ratlib.api.props import TrackedBase, TrackedProperty, DateTimeProperty, SetProperty, ListProperty, TypeCoercedProperty, InstrumentedProperty
-from ratlib.api.names import callapi, require_permission, Permissions, getRatName, getRatId, removeTags, flushNames
+from ratlib.autocorrect import correct_many
+from ratlib.api.props import TrackedBase, TrackedProperty, DateTimeProperty, SetProperty, TypeCoercedProperty, InstrumentedProperty
+from ratlib.api.quotes import Quote, QuoteList, QuoteDelta, QuoteListProperty
+from ratlib.api.names import callapi, require_permission, Permissions, getRatName, getRatId, removeTags, flushNames, \
+    addNamesFromV2Response
 from ratlib.sopel import UsageError
 import ratlib.api.http
 import ratlib.db
 from ratlib.db import with_session
 from ratlib.api.v2compatibility import convertV2DataToV1, convertV1RescueToV2
 from ratlib.languages import Language
+from ratlib import fuzzy
+from ratlib import replication
+from ratlib.scheduler import Priority
+from ratlib.sensitive import SensitiveTerms
+from ratlib.shortlinks import ShortLinks, paperwork_url
+from ratlib.replication import Event, require_leader
 
 urljoin = ratlib.api.http.urljoin
 
@@ -84,15 +93,18 @@ def configure(config):
 def setup(bot):
     ratlib.sopel.setup(bot)
     bot.memory['ratbot']['log'] = (threading.Lock(), collections.OrderedDict())
-    bot.memory['ratbot']['board'] = RescueBoard()
+    bot.memory['ratbot']['sensitive'] = SensitiveTerms(rescue_terms)
+    bot.memory['ratbot']['board'] = RescueBoard(listeners=[bot.memory['ratbot']['sensitive']])
     bot.memory['ratbot']['board'].bot = bot
+    bot.memory['ratbot']['shortlinks'] = ShortLinks(bot)
+    bot.memory['ratbot']['board'].listeners.append(functools.partial(prepare_paperwork_link, bot))
     bot.memory['ratbot']['lastsignal'] = None
 
     if not hasattr(bot.config, 'ratboard') or not bot.config.ratboard.signal:
         signal = 'ratsignal'
     else:
         signal = bot.config.ratboard.signal
-        bot.memory['ratbot']['maxplots'] = int(bot.config.ratbot.maxplots) or 4
+    bot.memory['ratbot']['maxplots'] = bot.config.ratbot.maxplots or 4
 
     bot.memory['ratbot']['plots_available'] = threading.Semaphore(value=bot.memory['ratbot']['maxplots'])
 
@@ -124,17 +136,79 @@ def setup(bot):
         bot.memory['ratbot']['apilock'] = threading.Lock()
         print("[RatBoard] Logging API calls to " + bot.config.ratbot.apidebug)
 
+    def on_leader_change(leader):
+        if not started:
+            return
+        debug_channel = bot.config.ratbot.debug_channel
+        if leader:
+            bot.say("[Replication] This instance is now leading.  Resynchronizing the board.", debug_channel)
+            bot.memory['ratbot']['executor'].schedule('interactive', refresh_cases, (bot,), priority=Priority.HIGH)
+        else:
+            bot.say("[Replication] This instance lost leadership and is now following.", debug_channel)
+
+    started = False
+    replicator = replication.setup(bot, functools.partial(apply_replicated_event, bot), on_leader_change)
+    if replicator is not None:
+        bot.memory['ratbot']['board'].listeners.append(replicator)
+
     try:
         refresh_cases(bot)
-        updateBoardIndexes(bot)
+        if replication.is_leader(bot):
+            updateBoardIndexes(bot)
     except ratlib.api.http.BadResponseError:
         warnings.warn("Failed to perform initial sync against the API")
         import traceback
         traceback.print_exc()
+    started = True
+
+
+def shutdown(bot):
+    replication.shutdown(bot)
+    ratlib.sopel.shutdown(bot)
 
 
 FindRescueResult = collections.namedtuple('FindRescueResult', ['rescue', 'created'])
 
+
+def rescue_terms(rescue):
+    """
+    Returns the details of a case that must not be published outside IRC: client name, IRC nickname (with and without
+    tags, and with underscores as spaces) and system.  See ratlib.sensitive.
+    """
+    terms = [rescue.client, rescue.system]
+    nick = rescue.data.get('IRCNick') if rescue.data else None
+    if nick:
+        terms.extend((str(nick), removeTags(str(nick))))
+    terms = [str(term).strip() for term in terms if term and str(term) not in _placeholder_terms]
+    return [term for term in terms + [term.replace('_', ' ') for term in terms] if term]
+
+
+# Placeholders used for unknown clients and nicknames, which are not client details.
+_placeholder_terms = {'<unknown client>', 'unknown client name', '<unknown IRC Nickname>'}
+
+
+def prepare_paperwork_link(bot, event, rescue):
+    """
+    Board listener that starts shortening the paperwork link of a case as soon as it has an API id, so closing it does
+    not have to wait for the shortener.
+    """
+    if event == Event.REMOVE or not rescue.id or rescue.paperwork_link:
+        return
+    shortlinks = bot.memory['ratbot'].get('shortlinks')
+    if shortlinks is None:
+        return  # Still starting up.
+    url = paperwork_url(rescue.id)
+    rescue.paperwork_link = shortlinks.cached(url)
+    if rescue.paperwork_link:
+        return
+    future = shortlinks.request(url)
+    if future is not None:
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                rescue.paperwork_link = future.result()
+        future.add_done_callback(done)
+
+
 class RescueBoard:
     """
     Manages all attached cases, including API calls.
@@ -146,12 +220,24 @@ class RescueBoard:
         'nick': lambda x: None if x.data is None or (not x.data.get('IRCNick')) else str(x.data['IRCNick']).lower(),
     }
 
+    # Indexes that also feed the fuzzy index.
+    FUZZY_INDEX_TYPES = ('client', 'nick')
+    # Minimum similarity for find() to accept a fuzzy match, and how far ahead of the runner-up it must be.
+    FUZZY_THRESHOLD = 0.5
+    FUZZY_MARGIN = 0.1
+
     MAX_POOLED_CASES = 10
     bot = None
 
-    def __init__(self):
+    def __init__(self, listeners=None):
+        """
+        :param listeners: Callables invoked as listener(event, rescue) after a case is added, changed or removed,
+            where event is one of ratlib.replication.Event's codes.  Called with the board locked.
+        """
         self._lock = threading.RLock()
         self.indexes = {k: {} for k in self.INDEX_TYPES.keys()}
+        self.fuzzy = fuzzy.TrigramIndex()
+        self.listeners = list(listeners or ())
 
         # Boardindex pool
         self.maxpool = self.MAX_POOLED_CASES
@@ -164,19 +250,69 @@ class RescueBoard:
     def __exit__(self, exc_type, exc_val, exc_tb):
         return self._lock.__exit__(exc_type, exc_val, exc_tb)
 
-    def add(self, rescue):
+    @staticmethod
+    def fuzzy_key(value):
+        """
+        Returns the fuzzy index key for a client or nick index value: tags removed and Unicode-folded.
+        """
+        if value is None:
+            return None
+        return fuzzy.normalize(removeTags(str(value))) or None
+
+    def _update_fuzzy(self, rescue, index, old=None, new=None):
+        """
+        Moves rescue from old to new in the fuzzy index, if index is one of FUZZY_INDEX_TYPES.
+        """
+        if index not in self.FUZZY_INDEX_TYPES:
+            return
+        old, new = self.fuzzy_key(old), self.fuzzy_key(new)
+        if old == new:
+            return
+        if old is not None:
+            # The same key may still be valid through the other index (e.g. client and nick being identical).
+            if not any(
+                self.fuzzy_key(self.INDEX_TYPES[other](rescue)) == old
+                for other in self.FUZZY_INDEX_TYPES if other != index
+            ):
+                self.fuzzy.discard(old, rescue)
+        if new is not None:
+            self.fuzzy.add(new, rescue)
+
+    def _emit(self, event, rescue):
+        for listener in self.listeners:
+            try:
+                listener(event, rescue)
+            except Exception:
+                traceback.print_exc()
+
+    def add(self, rescue, boardindex=None):
         """
         Adds the selected case to our indexes.
+
+        :param rescue: Rescue to add.
+        :param boardindex: Use this boardindex rather than the next free one, if it is not taken.  Used to mirror
+            another instance's board.
         """
         with self:
             assert rescue.board is None, "Rescue is already assigned."
             assert rescue.boardindex is None, "Rescue already has a boardindex."
             # Assign an boardindex
             rescue.board = self
-            try:
-                rescue.boardindex = self.pool.popleft()
-            except IndexError:
-                rescue.boardindex = next(self.counter)
+            if boardindex is not None and boardindex in self.indexes['boardindex']:
+                warnings.warn("Boardindex {!r} is already taken.".format(boardindex))
+                boardindex = None
+            if boardindex is None:
+                try:
+                    rescue.boardindex = self.pool.popleft()
+                except IndexError:
+                    rescue.boardindex = next(self.counter)
+            else:
+                rescue.boardindex = boardindex
+                if boardindex < self.maxpool:
+                    with contextlib.suppress(ValueError):
+                        self.pool.remove(boardindex)
+                else:
+                    self.counter = itertools.count(start=max(boardindex + 1, next(self.counter)))
 
             # Add to indexes
             for index, fn in self.INDEX_TYPES.items():
@@ -188,6 +324,8 @@ class RescueBoard:
                     warnings.warn("Key {key!r} is already in index {index!r}".format(key=key, index=index))
                     continue
                 self.indexes[index][key] = rescue
+                self._update_fuzzy(rescue, index, new=key)
+            self._emit(Event.ADD, rescue)
 
     def remove(self, rescue):
         """
@@ -197,6 +335,10 @@ class RescueBoard:
             # Remove from indexes
             assert rescue.board is self, "Rescue is not ours."
             assert rescue.boardindex is not None, "Rescue had no boardindex."
+            for index in self.FUZZY_INDEX_TYPES:
+                key = self.fuzzy_key(self.INDEX_TYPES[index](rescue))
+                if key is not None:
+                    self.fuzzy.discard(key, rescue)
             for index, fn in self.INDEX_TYPES.items():
                 key = fn(rescue)
                 if key is None:
@@ -212,6 +354,7 @@ class RescueBoard:
                 self.pool.append(rescue.boardindex)
             if not self.indexes['boardindex']:  # Board is clear.
                 self.counter = itertools.count(start=self.maxpool)
+            self._emit(Event.REMOVE, rescue)
 
     @contextlib.contextmanager
     def change(self, rescue):
@@ -232,6 +375,7 @@ class RescueBoard:
                 new = fn(rescue)
                 old = snapshot[index]
                 if old != new:
+                    self._update_fuzzy(rescue, index, old, new)
                     if old is not None:
                         if self.indexes[index].get(old) != rescue:
                             warnings.warn(
@@ -245,6 +389,7 @@ class RescueBoard:
                         else:
                             # print('Updating index '+str(index)+' with '+str(new))
                             self.indexes[index][new] = rescue
+            self._emit(Event.CHANGE, rescue)
 
     def create(self):
         """
@@ -254,13 +399,34 @@ class RescueBoard:
         self.add(rescue)
         return rescue
 
-    def find(self, search, create=False):
+    def find_fuzzy(self, search, limit=5, threshold=0.3):
+        """
+        Returns a ranked list of (rescue, score) tuples whose client or nick resemble search, best match first.
+
+        Matching ignores case, accents, IRC tags (e.g. "[PC]") and underscores vs. spaces.
+
+        :param search: Client name or nick to search for.
+        :param limit: Maximum number of candidates to return.
+        :param threshold: Minimum similarity (0..1) of a candidate.
+        """
+        key = self.fuzzy_key(search)
+        if not key:
+            return []
+        with self:
+            exact = self.fuzzy.get(key)
+            if exact:
+                return [(rescue, 1.0) for rescue in exact][:limit]
+            return self.fuzzy.search(key, limit=limit, threshold=threshold)
+
+    def find(self, search, create=False, fuzzy=False):
         """
         Attempts to find a rescue attached to this board.  If it fails, possibly creates one instead.
 
         :param search: What to search for.
         :param create: Whether to create a case that's not found.  Even if True, this only applies for certain types of
         searches.
+        :param fuzzy: If True and no exact client or nick match exists, falls back to the best fuzzy match.  The match
+        must score at least FUZZY_THRESHOLD and be FUZZY_MARGIN ahead of the runner-up.
         :return: A FindRescueResult tuple of (rescue, created), both of which will be None if no case was found.
 
         If `int(search)` does not raise, `search` is treated as a `boardindex`.  This will never create a case.
@@ -301,6 +467,11 @@ class RescueBoard:
                 continue
             break
 
+        if not rescue and fuzzy:
+            candidates = self.find_fuzzy(search, limit=2, threshold=self.FUZZY_THRESHOLD)
+            if len(candidates) == 1 or (candidates and candidates[0][1] - candidates[1][1] >= self.FUZZY_MARGIN):
+                rescue = candidates[0][0]
+
         if rescue or not create:
             return FindRescueResult(rescue, False if rescue else None)
 
@@ -324,7 +495,7 @@ class Rescue(TrackedBase):
     id = TrackedProperty(remote_name='id', readonly=True)
     rats = SetProperty(default=lambda: set())
     unidentifiedRats = SetProperty(default=lambda: set())
-    quotes = ListProperty(default=lambda: [])
+    quotes = QuoteListProperty(default=lambda: [])
     platform = TrackedProperty(default=None)
     open = TypeCoercedProperty(default=True, coerce=bool)
     epic = TypeCoercedProperty(default=False, coerce=bool)
@@ -342,6 +513,8 @@ class Rescue(TrackedBase):
         super().__init__(**kwargs)
         self.boardindex = None
         self.board = None
+        self.paperwork_link = None  # Short link to the paperwork, once made.  See prepare_paperwork_link()
+        self.save_lock = threading.Lock()  # Held while a save is sent to the API.  See save_case()
 
     def change(self):
         """
@@ -386,6 +559,8 @@ class Rescue(TrackedBase):
         result = {}
         props = self._props if full else self._changed
         for prop in props:
+            if full and self.id is not None and prop.name == 'quotes' and prop not in self._changed:
+                continue  # Quotes are the bulk of a case, so only resend them when they've actually changed.
             prop.write(self, result)
         return result
 
@@ -432,12 +607,15 @@ def refresh_cases(bot, rescue=None, force=False):
     result = callapi(bot, 'GET', uri)
     try:
         addNamesFromV2Response(result['included'])
-    except:
-        pass
+    except KeyError:
+        pass  # No rats included.
     result['data'] = convertV2DataToV1(result['data'])
     # print('[RatBoard] refreshing returned '+str(result))
     if force:
-        bot.memory['ratbot']['board'] = RescueBoard()
+        old = bot.memory['ratbot']['board']
+        bot.memory['ratbot']['board'] = RescueBoard(listeners=old.listeners)
+        bot.memory['ratbot']['board'].bot = bot
+        bot.memory['ratbot']['sensitive'].reset()
     board = bot.memory['ratbot']['board']
 
     if rescue:
@@ -468,6 +646,53 @@ def refresh_cases(bot, rescue=None, force=False):
             if case:
                 board.remove(case)
 
+def apply_replicated_event(bot, event):
+    """
+    Applies a board event received from the leading instance (see ratlib.replication) to our board.
+
+    Events only identify the case, so its current state is retrieved from the API.
+
+    :param bot: Sopel bot
+    :param event: Event dict.
+    """
+    board = bot.memory['ratbot']['board']
+    if event['e'] == Event.RESYNC:
+        refresh_cases(bot, force=True)
+        return
+    if event['e'] == Event.REMOVE:
+        with board:
+            existing = board.indexes['id'].get(event['i'])
+            if existing:
+                board.remove(existing)
+        return
+    if not bot.config.ratbot.apiurl:
+        return
+    result = callapi(bot, 'GET', '/rescues/' + event['i'])
+    try:
+        addNamesFromV2Response(result['included'])
+    except KeyError:
+        pass  # No rats included.
+    data = convertV2DataToV1(result['data'])
+    boardindex = event.get('b')
+
+    with board:
+        existing = board.indexes['id'].get(event['i'])
+        if not data:
+            if existing:
+                board.remove(existing)
+            return
+        if existing and boardindex is not None and existing.boardindex != boardindex:
+            # Leader renumbered the case.
+            board.remove(existing)
+            existing.board = existing.boardindex = None
+            board.add(existing, boardindex=boardindex)
+        if existing:
+            with existing.change():
+                existing.refresh(data[0], merge=False)
+            return
+        board.add(Rescue.load(data[0]), boardindex=boardindex)
+
+
 def updateBoardIndexes(bot):
     board = bot.memory['ratbot']['board']
 
@@ -490,6 +715,37 @@ def cmd_reindex(bot, trigger):
     updateBoardIndexes(bot)
     bot.say("Done.")
 
+def fetch_quotes(bot, rescue):
+    """
+    Retrieves the complete list of quotes for a case from the API, in API format.
+
+    :param bot: Bot instance
+    :param rescue: Rescue to retrieve quotes for.  Must have an id.
+    """
+    result = callapi(bot, 'GET', '/rescues/' + rescue.id)
+    return result['data'][0]['attributes']['quotes'] or []
+
+
+def load_quote_history(bot, rescue):
+    """
+    Retrieves the quotes of a case that are not held in memory (see QuoteList) from the API.
+
+    :param bot: Bot instance
+    :param rescue: Rescue to load history for.
+    :return: A list of Quotes for lines 0 through rescue.quotes.offset - 1, or None if they could not be retrieved.
+    """
+    offset = rescue.quotes.offset
+    if not offset:
+        return []
+    if rescue.id is None or not bot.config.ratbot.apiurl:
+        return None
+    try:
+        quotes = fetch_quotes(bot, rescue)
+    except (ratlib.api.http.APIError, KeyError, IndexError, TypeError):
+        return None
+    return [Quote.load(quote) for quote in quotes[:offset]]
+
+
 def save_case(bot, rescue, forceFull=False):
     """
     Begins saving changes to a case.  Returns the future.
@@ -513,7 +769,13 @@ def save_case(bot, rescue, forceFull=False):
         method = "POST"
 
     def task():
-        result = callapi(bot, method, uri, data=convertV1RescueToV2(data))
+        # Saves of the same case go one at a time, so that a save that reads the quotes from the API sees those added
+        # by the save before it rather than overwriting them.
+        with rescue.save_lock:
+            if isinstance(data.get('quotes'), QuoteDelta):
+                # Older quotes aren't in memory, so combine our changes with what the API has.
+                data['quotes'] = data['quotes'].apply(fetch_quotes(bot, rescue))
+            result = callapi(bot, method, uri, data=convertV1RescueToV2(data))
         rescue.commit()
         try:
             addNamesFromV2Response(result['included'])
@@ -526,7 +788,8 @@ def save_case(bot, rescue, forceFull=False):
             rescue.refresh(result['data'][0])
         return rescue
 
-    return bot.memory['ratbot']['executor'].submit(task)
+    priority = Priority.URGENT if rescue.codeRed else Priority.NORMAL
+    return bot.memory['ratbot']['executor'].schedule('interactive', task, priority=priority)
 
 
 def save_case_later(bot, rescue, message=None, timeout=10, forceFull=False):
@@ -635,8 +898,7 @@ def append_quotes(bot, search, lines, autocorrect=True, create=True, detect_plat
         lines = [lines]
     if autocorrect:
         rv.added_lines = []
-        for line in lines:
-            result = correct(line)
+        for result in correct_many(lines):
             rv.added_lines.append(result.output)
             if result.fixed:
                 rv.autocorrected = True
@@ -693,11 +955,7 @@ def append_quotes(bot, search, lines, autocorrect=True, create=True, detect_plat
             rv.rescue.platform = platforms.pop()
             rv.detected_platform = rv.rescue.platform
 
-    json_lines = []
-    for line in rv.added_lines:
-        json_lines.append({"message":line, "updatedAt":timeutil.utc_now_tz(),
-                           "createdAt":timeutil.utc_now_tz(), "author":author, "lastAuthor":author})
-    rv.rescue.quotes.extend(json_lines)
+    rv.rescue.quotes.extend(Quote.create(line, author) for line in rv.added_lines)
     return rv
 
 
@@ -732,6 +990,7 @@ def rule_history(bot, trigger):
 # @rule(r'\s*(ratsignal|testsignal)(.*)')
 @priority('high')
 @ratlib.sopel.filter_output
+@require_leader
 def rule_ratsignal(bot, trigger):
     """Light the rat signal, somebody needs fuel."""
     line = trigger.group()
@@ -817,8 +1076,17 @@ def func_quote(bot, trigger, rescue, showboardindex=True):
         bot.say("Assigned rats: " + ", ".join(ratnames))
     if rescue.unidentifiedRats:
         bot.say("Assigned unidentifiedRats: " + ", ".join(rescue.unidentifiedRats))
-    for ix, quote in enumerate(rescue.quotes):
-        pdate = "unknown" if quote["updatedAt"] is None else timeutil.friendly_timedelta(dateutil.parser.parse(quote['updatedAt']))
+    quotes = list(rescue.quotes)
+    start = 0
+    if rescue.quotes.offset:
+        history = load_quote_history(bot, rescue)
+        if history is None:
+            start = rescue.quotes.offset
+            bot.say("[{} older line(s) could not be retrieved]".format(start))
+        else:
+            quotes = history + quotes
+    for ix, quote in enumerate(quotes, start=start):
+        pdate = "unknown" if quote.updatedAt is None else timeutil.friendly_timedelta(quote.updatedAt)
         if quote['lastAuthor'] is None:
             bot.say(
                 '[{ix}][{quote[author]} {ago}] {quote[message]}'.format(ix=ix, quote=quote, ago=pdate))
@@ -857,11 +1125,10 @@ def func_clear(bot, trigger, rescue, markingForDeletion=False, *firstlimpet):
         bot.say('The case platform is unknown. Please set it with the corresponding command and try again.')
         return
 
-    url = "https://fuelrats.com/paperwork/{rescue.id}/edit".format(rescue=rescue)
-    try:
-        url = bot.memory['ratbot']['shortener'].shorten(url)['shorturl']
-    except:
-        print('[RatBoard] Couldn\'t grab shortened URL for Paperwork. Ignoring, posting long link.')
+    # Usually shortened when the case got its id; never wait for the shortener here.
+    url = paperwork_url(rescue.id)
+    if rescue.id:
+        url = rescue.paperwork_link or bot.memory['ratbot']['shortlinks'].link(url)
 
     if len(firstlimpet) == 1:
         rat = getRatId(bot, firstlimpet[0], rescue.platform)['id']
@@ -1185,15 +1452,20 @@ def cmd_sub(bot, trigger, rescue, lineno, line=None):
         return bot.reply('Line number must be an integer.')
     if lineno < 0:
         return bot.reply('Line number cannot be negative.')
-    if lineno >= len(rescue.quotes):
-        return bot.reply('Case only has {} line(s)'.format(len(rescue.quotes)))
+    if lineno >= rescue.quotes.total:
+        return bot.reply('Case only has {} line(s)'.format(rescue.quotes.total))
+    if lineno < rescue.quotes.offset:
+        # Line isn't in memory; pull in the full history so it can be edited.
+        history = load_quote_history(bot, rescue)
+        if history is None:
+            return bot.reply("Couldn't retrieve line {} from the API.  Try again later.".format(lineno))
+        rescue.quotes = QuoteList(history + list(rescue.quotes), maxlen=None)
+    ix = lineno - rescue.quotes.offset
     if not line:
-        rescue.quotes.pop(lineno)
+        rescue.quotes.pop(ix)
         bot.say("Deleted line {}".format(lineno))
     else:
-        rescue.quotes[lineno] = {"message":line, "updatedAt":timeutil.utc_now_tz(),
-                                 "createdAt":rescue.quotes[lineno]["createdAt"],
-                                 "author":rescue.quotes[lineno]["author"], "lastAuthor":trigger.nick}
+        rescue.quotes[ix] = rescue.quotes[ix].edit(line, trigger.nick)
         bot.say("Updated line {}".format(lineno))
 
     save_case_later(bot, rescue)
@@ -1490,150 +1762,125 @@ def cmd_commander(bot, trigger, rescue, commander, db=None):
         )
     )
 
-_ratmama_regex = re.compile(r"""
-    (?x)
-    # The above makes whitespace and comments in the pattern ignored.
-    # Saved at https://regex101.com/r/jhKtQD/1
-    \s*                                  # Handle any possible leading whitespace
-    Incoming\s+Client:\s*   # Match "Incoming Client" prefix
-    # Wrap the entirety of rest of the pattern in a group to make it easier to echo the entire thing
-    (?P<all>
-    (?P<cmdr>[^@#\d\s].*?)               # Match CDMR name.  Don't allow leading digits or @/#, as it breaks things
-                                         # (and probably isn't a legal name anyways).  Dispatch can manually handle
-                                         # those cases if it turns out to be a thing, or someone can fix Ratmama too.
-    \s+-\s+                              #  -
-    System:\s*(?P<system>.*?)            # Match system name
-    (?:\s[sS][yY][sS][tT][eE][mM]|)      # Strip " system" from end, if present (case insensitive)
-    \s+-\s+                              #  -
-    Platform:\s*(?P<platform>\w+)        # Match platform (currently can't contain spaces)
-    \s+-\s+                              #  -
-    O2:\s*(?P<o2>.+?)                    # Match oxygen status
-    \s+-\s+                              #  -
-    Language:\s*
-    (?P<full_language>                   # Match full language text (for regenerating the line)
-    (?P<language>.+?)\s*                 # Match language name. (currently unused)
-    \(                                   # The "(" of "(en-US)"
-    (?P<language_code>.+?)               # "en"
-    (?:                                  # Optional group
-        -(?P<language_country>.+)        # "-", "US" (currently unused)
-    )?                                   # Actually make the group optional.
-    \)                                   # The ")" of "(en-US)"
-    )                                    # End of full language text
-    (?:                                  # Possibly match IRC nickname
-    \s+-\s+                              #  -
-    IRC\s+Nickname:\s*(?P<nick>[^\s]+)   # IRC nickname
-    )?                                   # ... emphasis on "Possibly"
-    )                                    # End of the main capture group
-    \s*                                  # Handle any possible trailing whitespace
-    $                                    # End of pattern
-""")
-
 @rule('Incoming Client:.* - O2:.*')
 @require_chanmsg
+@require_leader
 def ratmama_parse(bot, trigger):
     """
     Parse Incoming KiwiIRC clients that are announced by RatMama
 
+    The signal is announced as soon as the case is updated.  Saving the case and checking its system happen afterwards
+    on the scheduler, and report back to the channel when they have something to say.
+
     :param trigger: line that triggered this
     """
-    # print('[RatBoard] triggered ratmama_parse')
-    # print('[RatBoard] line: ' + line)
+    if Identifier(trigger.nick) not in ('Ratmama[BOT]', 'Dewin', 'unknown'):
+        return
+    signal = ratmama.parse(trigger.group())
+    if not signal:
+        return
 
-    if Identifier(trigger.nick) in ('Ratmama[BOT]', 'Dewin', 'unknown'):
-        match = _ratmama_regex.fullmatch(trigger.group())
-        if not match:
-            return
+    # Save time of new Ratsignal
+    bot.memory['ratbot']['lastsignal'] = datetime.datetime.utcnow()
+    ratsignal = bot.config.ratboard.signal.upper()
 
-        # Save time of new Ratsignal
-        bot.memory['ratbot']['lastsignal'] = datetime.datetime.utcnow()
+    board = bot.memory['ratbot']['board']
+    case, created = board.find(signal.cmdr, create=True)
+    with board.change(case):
+        case.quotes.extend(Quote.create(line, "Mecha") for line in signal.quotes(ratsignal))
+        if not case.system:
+            case.system = signal.system
+        case.codeRed = signal.code_red
+        case.platform = signal.platform
+        case.data.update(defaultdata)
+        case.data.update({
+            'langID': signal.language_code,
+            'IRCNick': signal.nick,
+            "boardIndex": int(case.boardindex)
+        })
+    if not bot.config.ratbot.apiurl:
+        case.touch()
+    future = save_case(bot, case, forceFull=True)
+    if future:
+        future.add_done_callback(functools.partial(_ratmama_saved, bot, case))
 
-        # Parse results
-        fields = match.groupdict()
-        fields["ratsignal"] = bot.config.ratboard.signal.upper()
+    if not created:
+        # using lower() as systems may be saved in different capitalisation than the client entered it
+        if case.system.lower() != signal.system.lower():
+            bot.say(
+                "Caution - Reported and autodetected System do not match! Dispatch, check it is set to the correct"
+                " one! (" + case.system + " vs " + signal.system + ")"
+            )
+        bot.say("{0.client} has reconnected to the IRC! (Case #{0.boardindex})".format(case))
+        return
 
-        # Create format string
-        fmt = (
-            "{ratsignal} - CMDR {cmdr} - Reported System: {system} - Platform: {platform} - O2: {o2}"
-            " - Language: {full_language}"
+    # Add IRC formatting to fields, then substitute them into to output to the channel
+    fields = dict(signal.fields)
+    if case.codeRed:
+        fields["o2"] = bold(color(fields["o2"], colors.RED))
+    if case.platform == 'xb':
+        fields["platform"] = color(fields["platform"], colors.GREEN)
+        fields["platform_signal"] = "XB_SIGNAL"
+    elif case.platform == 'ps':
+        fields["platform"] = color("PS4", colors.LIGHT_BLUE)
+        fields["platform_signal"] = "PS_SIGNAL"
+    elif case.platform == 'pc':
+        fields["platform_signal"] = "PC_SIGNAL"
+    fields["platform"] = bold(fields["platform"])
+    fields["system"] = bold(signal.system)
+    fields["cmdr"] = bold(fields["cmdr"])
+    if len(signal.system) <= 2:
+        fields["system"] += " (too short to verify)"
+
+    announcement = signal.line(ratsignal, **fields) + " (Case #{})".format(case.boardindex)
+    if "platform_signal" in fields:
+        announcement += " ({})".format(fields["platform_signal"])
+    bot.say(announcement)
+    if case.codeRed:
+        prepcrstring = getFact(bot, factname='prepcr', lang=signal.language_code)
+        bot.say(signal.nick + " " + prepcrstring)
+    if len(signal.system) > 2:
+        bot.memory['ratbot']['executor'].schedule(
+            'lookup', ratmama_locate, (bot, case, signal.system),
+            priority=Priority.URGENT if case.codeRed else Priority.HIGH
         )
-        if fields["nick"]:
-            fmt += " - IRC Nickname: {nick}"
 
-        # Create plaintext versions of newline
-        result = append_quotes(bot, fields["cmdr"], fmt.format(**fields), create=True, author="Mecha")
-        case = result.rescue  # Reduce typing later.
+    bot.memory['ratbot']['lastsignal'] = datetime.datetime.utcnow()
+    global preptimer
+    try:
+        preptimer.cancel()
+    except:
+        pass
+    if not case.codeRed:
+        preptimer = Timer(180, prepexpired, args=[bot])
+        preptimer.start()
 
-        # Update the case
-        if not case.system:
-            case.system = fields["system"]
-        # using lower() as systems may be saved in different capitalisation than the client entered it
-        if case.system.lower() != fields["system"].lower():
-            bot.say("Caution - Reported and autodetected System do not match! Dispatch, check it is set to the correct one! (" + case.system + " vs " + fields["system"] + ")")
-        case.codeRed = (fields["o2"] != "OK")
-        if fields["platform"] == "PS4":
-            case.platform = "ps"
-        else:
-            case.platform = fields["platform"].lower()
-        if not fields["nick"]:
-            fields["nick"] = fields["cmdr"]
-        with bot.memory['ratbot']['board'].change(case):
-            case.data.update(defaultdata)
-            case.data.update({
-                'langID': fields["language_code"],
-                'IRCNick': fields["nick"],
-                "boardIndex": int(case.boardindex)
-            })
 
-        save_case_later(bot, case, forceFull=True)
-        if result.created:
-            # Add IRC formatting to fields, then substitute them into to output to the channel
-            # (But only if this is a new case, because we aren't using it otherwise)
-
-            system = fields["system"]
-
-            if case.codeRed:
-                fields["o2"] = bold(color(fields["o2"], colors.RED))
-
-            if case.platform == 'xb':
-                fields["platform"] = color(fields["platform"], colors.GREEN)
-                fields["platform_signal"] = "XB_SIGNAL"
-            elif case.platform == 'ps':
-                fields["platform"] = color("PS4", colors.LIGHT_BLUE)
-                fields["platform_signal"] = "PS_SIGNAL"
-            elif case.platform == 'pc':
-                fields["platform_signal"] = "PC_SIGNAL"
-            fields["platform"] = bold(fields["platform"])
-            fields["system"] = bold(system)
-            fields["cmdr"] = bold(fields["cmdr"])
-
-
-            if len(system) > 2:
-                validatedSystem = starsystem.validate(bot, system)
-                if validatedSystem:
-                    nearest = starsystem.get_nearest_landmark(bot, validatedSystem)
-                    if nearest and nearest['name'].casefold() != validatedSystem.casefold():
-                            fields["system"] += " ({:.2f} LY from {})".format(nearest['distance'], nearest['name'])
-                else:
-                    fields["system"] += " (not in Fuelrats System Database)"
-            else:
-                fields["system"] += " (too short to verify)"
-
-            bot.say((fmt + " (Case #{boardindex}) ({platform_signal})").format(boardindex=case.boardindex, **fields))
-            if case.codeRed:
-                prepcrstring = getFact(bot, factname='prepcr', lang=fields["language_code"])
-                bot.say(
-                    fields["nick"] + " " + prepcrstring)
-            bot.memory['ratbot']['lastsignal'] = datetime.datetime.utcnow()
-            global preptimer
-            try:
-                preptimer.cancel()
-            except:
-                pass
-            if not case.codeRed:
-                preptimer = Timer(180, prepexpired, args=[bot])
-                preptimer.start()
-        else:
-            bot.say("{0.client} has reconnected to the IRC! (Case #{0.boardindex})".format(case))
+def ratmama_locate(bot, case, system):
+    """
+    Checks a newly signalled system against the Systems API and reports the nearest landmark, or that it was not found.
+    """
+    try:
+        validatedSystem = starsystem.validate(bot, system)
+        if not validatedSystem:
+            bot.say("Case #{0.boardindex}: {1} is not in Fuelrats System Database".format(case, bold(system)))
+            return
+        nearest = starsystem.get_nearest_landmark(bot, validatedSystem)
+        if nearest and nearest['name'].casefold() != validatedSystem.casefold():
+            bot.say("Case #{0.boardindex}: {1} is {2:.2f} LY from {3}".format(
+                case, bold(validatedSystem), nearest['distance'], nearest['name']
+            ))
+    except Exception:
+        traceback.print_exc()
+
+
+def _ratmama_saved(bot, case, future):
+    """Reports a failed save of a signalled case."""
+    ex = future.exception()
+    if ex is None:
+        return
+    traceback.print_exception(type(ex), ex, ex.__traceback__)
+    bot.say("API update of case #{0.boardindex} ({0.client}) failed: {1}".format(case, ex))
 
 
 @commands('closed', 'recent')
@@ -1800,16 +2047,15 @@ def cmd_pwl(bot, trigger, case):
     required parameters: client name or board index
     aliases: pwl, pwlink, paperwork, paperworklink
     """
-    url = "https://fuelrats.com/paperwork/{rescue.id}/edit".format(
-        rescue=case, apiurl=str(bot.config.ratbot.apiurl).strip('/'))
-    shortened = url
-    if bot.memory['ratbot']['shortener']:
-        shortened = bot.memory['ratbot']['shortener'].shorten(url)['shorturl']
+    shortened = paperwork_url(case.id)
+    if case.id:
+        shortened = case.paperwork_link or bot.memory['ratbot']['shortlinks'].link(shortened, wait=2)
     bot.reply('Here you go: ' + str(shortened))
 
 
 # This should go elsewhere, but here for now.
 @commands('version', 'uptime')
+@require_leader
 def cmd_version(bot, trigger):
     """
     Shows the bot's current version and Uptime
@@ -1838,7 +2084,89 @@ def cmd_flush(bot, trigger):
     bot.say('Cached names flushed!')
 
 
+@commands('queues', 'lanes')
+@require_permission(Permissions.techrat)
+def cmd_queues(bot, trigger):
+    """
+    Shows task scheduler lanes: queued/running tasks and how long tasks waited before starting.
+    aliases: queues, lanes
+    """
+    def fmt(seconds):
+        return "-" if seconds is None else "{:.2f}s".format(seconds)
+
+    for name, stats in bot.memory['ratbot']['executor'].stats().items():
+        bot.say(
+            "{name} ({kind} x{workers}): {queued} queued, {running} running, {completed} done, {failed} failed."
+            "  Wait p50 {p50}, p95 {p95}, max {max}"
+            .format(
+                name=name, p50=fmt(stats['wait_p50']), p95=fmt(stats['wait_p95']), max=fmt(stats['max_wait']),
+                **stats
+            )
+        )
+
+
+@commands('dbstats')
+@require_permission(Permissions.techrat)
+def cmd_dbstats(bot, trigger):
+    """
+    Shows the SQL statements that took the most database time since startup, or manages the statistics.
+    required parameters: [count] to show that many statements (default 5), "dump" to write everything to a JSON file in
+    the work directory, or "reset" to start over.
+    """
+    profiler = bot.memory['ratbot'].get('db_profiler')
+    if profiler is None:
+        bot.reply("SQL profiling is not enabled.")
+        return NOLIMIT
+    arg = (trigger.group(3) or '').strip().lower()
+
+    if arg == 'reset':
+        profiler.reset()
+        bot.reply("SQL statistics reset.")
+        return
+    if arg == 'dump':
+        dump = profiler.dump()
+        tracker = bot.memory['ratbot'].get('db_tracker')
+        if tracker is not None:
+            dump['sessions'] = tracker.stats()
+        filename = ratlib.sopel.makepath(bot.config.ratbot.workdir, 'dbstats.json')
+        with open(filename, 'w', encoding='utf8') as f:
+            json.dump(dump, f, indent=2, default=str)
+        bot.reply("Wrote statistics for {} statements to {}".format(len(dump['statements']), filename))
+        return
+    try:
+        count = int(arg or 5)
+    except ValueError:
+        count = 0
+    if count < 1:
+        bot.reply("Usage: !dbstats [count|dump|reset]")
+        return NOLIMIT
+    count = min(count, 20)
+
+    def ms(seconds):
+        return "-" if seconds is None else "{:.1f}ms".format(seconds * 1000)
+
+    top = profiler.top(count)
+    if not top:
+        bot.say("No SQL statements recorded yet.")
+        return
+    for ix, stats in enumerate(top, 1):
+        shape = stats['shape']
+        if len(shape) > 150:
+            shape = shape[:147] + "..."
+        bot.say(
+            "#{ix}: {total:.2f}s in {count} calls, p50 {p50}, p95 {p95}, p99 {p99}, {rows:.1f} rows avg: {shape}".format(
+                ix=ix, total=stats['total'], count=stats['count'], p50=ms(stats['p50']), p95=ms(stats['p95']),
+                p99=ms(stats['p99']), rows=stats['rows'] / stats['count'], shape=shape
+            )
+        )
+    if profiler.slow:
+        bot.say("{} recent statements exceeded {:.2f}s; see \"!dbstats dump\" for details.".format(
+            len(profiler.slow), profiler.slow_threshold
+        ))
+
+
 @commands('host')
+@require_leader
 def cmd_host(bot, trigger):
     """
     Shows you your current host to verify priviliges
@@ -1863,10 +2191,17 @@ def cmd_forceRefreshBoard(bot, trigger):
 
 
 def getFact(bot, factname, lang='en'):
-    try:
-        return ratlib.db.Fact.find(db=bot.memory['ratbot']['db'](), name=factname, lang=lang).message
-    except AttributeError:
-        return ratlib.db.Fact.find(db=bot.memory['ratbot']['db'](), name=factname, lang='en').message
+    """
+    Returns the message of a fact in the given language, falling back to English.
+    """
+    if 'ratfacts' in bot.memory:
+        fact = bot.memory['ratfacts']['cache'].find(factname, [lang, 'en'])
+        if fact is None:
+            raise AttributeError("No such fact: {!r}".format(factname))
+        return fact.message
+    with ratlib.db.session_scope(bot) as db:
+        fact = ratlib.db.Fact.find(db, name=factname, lang=lang) or ratlib.db.Fact.find(db, name=factname, lang='en')
+        return fact.message
 
 
 def rescueMarkedForDeletion(rescue):
@@ -2041,12 +2376,11 @@ def cmd_pwn(bot, trigger):
             bot.say("Incomplete Paperwork Cases:")
         else:
             bot.say("All Paperwork done!")
+        shortlinks = bot.memory['ratbot']['shortlinks']
         for case in data:
-            url = "https://fuelrats.com/paperwork/{id}/edit".format(id=case['id'])
-            try:
-                url = bot.memory['ratbot']['shortener'].shorten(url)['shorturl']
-            except:
-                print('[RatBoard] Couldn\'t grab shortened URL for Paperwork. Ignoring, posting long link.')
+            shortlinks.request(paperwork_url(case['id']), priority=Priority.HIGH)  # Shorten them all at once.
+        for case in data:
+            url = shortlinks.link(paperwork_url(case['id']), wait=5)
             ratname = getRatName(bot, ratid=case['firstLimpet'])[0]
             bot.say("Rescue of {case[client]} at {case[system]} by {ratname} - link: {url}".format(case=case, ratname=ratname, url=url))
 
@@ -2086,13 +2420,13 @@ def cmd_invalid(bot, trigger, caseid):
 
 
 @commands('lang', 'language')
-@parameterize('rw', usage='<case number or name> <language code>')
+@parameterize('rw', usage='<case number or name> <language code or name>')
 @require_permission(Permissions.rat)
 def cmd_lang(bot, trigger, case, lang):
     """
     Sets a case's language
     """
-    lang = lang.lower()
+    lang = Language.resolve(lang) or lang.lower()
     try:
         lang_name = Language.name(lang)
         with bot.memory['ratbot']['board'].change(case):
@@ -2101,4 +2435,4 @@ def cmd_lang(bot, trigger, case, lang):
         save_case_later(bot, case, forceFull=True)
         bot.say('Language on case {case.client_name} changed to {lang}.'.format(case=case, lang=lang_name))
     except KeyError:
-        bot.say('Unrecognized language code: ' + lang)
+        bot.say('Unrecognized language: ' + lang)
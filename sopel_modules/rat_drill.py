@@ -16,15 +16,12 @@ This module is built on top of the Sopel system.
 http://sopel.chat/
 """
 
-#Python core imports
-import json
-import os
-
 #Sopel Imports
 from sopel.module import commands
-from sopel.tools import SopelMemory
 
 import ratlib.sopel
+from ratlib.jsonstore import get_store
+from ratlib.replication import require_leader
 
 def configure(config):
     ratlib.sopel.configure(config)
@@ -32,9 +29,13 @@ def configure(config):
 def setup(bot):
     ratlib.sopel.setup(bot)
 
-    bot.memory['ratbot']['drilllist'] = ratlib.sopel.makepath(bot.config.ratbot.workdir, 'drills.json')
+    bot.memory['ratbot']['drilllist'] = get_store(bot, 'drills.json')
+
+def shutdown(bot):
+    ratlib.sopel.shutdown(bot)
 
 @commands('drill')
+@require_leader
 def listDrills(bot, trigger):
     """Lists all current rats waiting for a drill, and their drill type."""
 
@@ -55,11 +56,7 @@ def listDrills(bot, trigger):
         ratdrills = True
 
     # Load the list
-    try:
-        with open(bot.memory['ratbot']['drilllist']) as f:
-            ls = json.load(f)
-    except IOError as e:
-        return bot.say('I can\'t seem to open the list.')
+    ls = bot.memory['ratbot']['drilllist'].read()
 
     # Parse the list
     pdrill = set()
@@ -86,6 +83,7 @@ def listDrills(bot, trigger):
         return bot.reply(msg)
 
 @commands('drilladd')
+@require_leader
 def addDrill(bot, trigger):
     """Adds a rat to the list of awaiting drills.
     Arguments:
@@ -117,24 +115,15 @@ def addDrill(bot, trigger):
     # Prepare new rat
     drill = {trigger.group(4): {'patchdrill':pdrill,'ratdrill':rdrill}}
 
-    # Fetch list
-    try:
-        with open(bot.memory['ratbot']['drilllist']) as f:
-            ls = json.load(f)
-    except IOError:
-        # File doesn't exist.
-        ls = dict()
-
     # Add rat
-    ls.update(drill)
-
-    with open(bot.memory['ratbot']['drilllist'], 'w') as f:
-        json.dump(ls, f)
+    with bot.memory['ratbot']['drilllist'].change() as ls:
+        ls.update(drill)
 
     return bot.reply('CMDR %s added to drill list.' % (trigger.group(4),))
 
 
 @commands('drilldel', 'drillrem')
+@require_leader
 def removeDrill(bot, trigger):
     """Removes a rat from the list of awaiting drills.
     NOTE: to only remove the rat from 1 type, use !drilladd instead"""
@@ -145,19 +134,11 @@ def removeDrill(bot, trigger):
     else:
         CMDR = trigger.group(3)
 
-    # Load list
-    with open(bot.memory['ratbot']['drilllist']) as f:
-        ls = json.load(f)
-
-    # Check if in the list
-    if CMDR not in ls:
+    # Check if in the list, and remove from it.
+    with bot.memory['ratbot']['drilllist'].change() as ls:
+        found = ls.pop(CMDR, None) is not None
+    if not found:
         return bot.reply('CMDR %s not in the drill list.' % (CMDR,))
 
-
-    # Remove from and upload list.
-    del ls[CMDR]
-    with open(bot.memory['ratbot']['drilllist'], 'w') as f:
-        json.dump(ls, f)
-
     return bot.reply('CMDR %s removed from the list.' % (CMDR,))
 
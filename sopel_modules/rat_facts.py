@@ -20,20 +20,24 @@ import json
 import os.path
 import re
 import glob
-import textwrap
+import traceback
 
-from sopel.module import commands, NOLIMIT, HALFOP, OP
+from sopel.module import commands, interval, NOLIMIT, HALFOP, OP
 from sopel.config.types import StaticSection, ValidatedAttribute, ListAttribute
 from sopel.tools import SopelMemory, Identifier
-from sqlalchemy import exc, inspect
-from ratlib.db import Fact, with_session
+from sqlalchemy import inspect
+from ratlib.db import Fact, with_session, session_scope
+from ratlib.facts import FactCache, FactWatcher, ImportResult, bulk_import, fact_rows
+from ratlib.formatting import split_message, split_recipients, group_recipients
 import ratlib.sopel
 from ratlib.api.names import *
+from ratlib.replication import require_leader, is_leader
 
 
 class RatfactsSection(StaticSection):
     filename = ValidatedAttribute('filename', str, default='')
     lang = ListAttribute('lang', default=['en'])
+    watch_interval = ValidatedAttribute('watch_interval', int, default=60)
 
 
 def configure(config):
@@ -53,6 +57,12 @@ def configure(config):
             " The first language in this list is the default language for new facts."
         )
     )
+    config.ratfacts.configure_setting(
+        'watch_interval',
+        (
+            "Check the fact file(s) for changes every N seconds and import what changed.  0 disables."
+        )
+    )
 
 
 @with_session
@@ -60,48 +70,38 @@ def import_facts(bot, merge=False, db=None):
     """
     Import json data into the fact database
 
+    Each file is written with a single bulk statement (see ratlib.facts.bulk_import), all in one transaction.
+
     :param bot: Sopel instance
     :param merge: If True, incoming facts overwrite existing ones rather than being ignored.
     :param db: Database session.
+    :return: An ImportResult totalling all files, or None if no filename is configured.
     """
     filename = bot.config.ratfacts.filename
     if not filename:
-        return
+        return None
     try:
         lang = bot.memory['ratfacts']['lang'][0]
     except:
         lang = 'en'
 
-    def _gen(json):
-        for k, v in json.items():
-            if isinstance(v, dict):
-                for name, message in v.items():
-                    if isinstance(message, dict):  # New-style facts.json with attribution
-                        yield Fact(name=name, lang=k, message=message['fact'], author=message.get('author'))
-                    else:  # Newer-style facts.json with language but not attribution -- or explicit deletion of fact.
-                        yield Fact(name=name, lang=k, message=message)
-            else:  # Old-style facts.json, single language
-                yield Fact(name=k, lang=lang, message=v)
-
-    for fact in _gen(load_fact_json(filename)):
-        try:
-            with db.begin_nested():
-                if merge:
-                    fact = db.merge(fact)
-                    if fact.message is None:
-                        if fact in db.new:
-                            db.expunge(fact)
-                        else:
-                            db.delete(fact)
-                else:
-                    if fact.message is None:
-                        continue
-                    db.add(fact)
-                db.flush()
-        except exc.DatabaseError:
-            if merge:  # Shouldn't have errors in this case
-                raise
-    db.commit()
+    if os.path.isdir(filename):
+        filenames = sorted(glob.iglob(os.path.join(filename, "*.json")))
+    else:
+        filenames = [filename]
+
+    result = ImportResult()
+    try:
+        for path in filenames:
+            result += bulk_import(db, fact_rows(load_fact_json(path, recurse=False), lang), merge=merge)
+        db.commit()
+    except:
+        db.rollback()
+        raise
+    print("[RatFacts] Imported {} file(s): {}".format(len(filenames), result))
+    if 'ratfacts' in bot.memory and result:
+        bot.memory['ratfacts']['cache'].invalidate(db)
+    return result
 
 
 def setup(bot):
@@ -113,10 +113,57 @@ def setup(bot):
         lang = list(x.strip() for x in lang.split(","))
     bot.memory['ratfacts'] = SopelMemory()
     bot.memory['ratfacts']['lang'] = lang
+    bot.memory['ratfacts']['cache'] = FactCache()
+    bot.memory['ratfacts']['watcher'] = None
+    with session_scope(bot) as db:
+        bot.memory['ratfacts']['cache'].load(db)
+
+    # Import facts, and keep watching them for changes.
+    if bot.config.ratfacts.filename:
+        bot.memory['ratfacts']['watcher'] = FactWatcher(bot.config.ratfacts.filename, lang[0])
+        try:
+            watch_facts(bot, initial=True)
+        except Exception:
+            print("[RatFacts] Initial fact import failed.")
+            traceback.print_exc()
+        frequency = int(bot.config.ratfacts.watch_interval or 0)
+        if frequency > 0:
+            interval(frequency)(task_watch_facts)
+
+
+def watch_facts(bot, initial=False):
+    """
+    Imports changes to fact files since the last check, updates the fact cache and announces what changed.
 
+    :param bot: Sopel instance
+    :param initial: Passed to FactWatcher.scan()
+    :return: A list of (filename, ImportResult) for the files that changed.
+    """
+    watcher = bot.memory['ratfacts']['watcher']
+    if watcher is None:
+        return []
+    snapshot = dict(watcher.files)
+    try:
+        with session_scope(bot) as db:
+            results = watcher.scan(db, initial=initial)
+            changed = [(os.path.basename(filename), result) for filename, result in results if result]
+            db.commit()
+            if changed:
+                bot.memory['ratfacts']['cache'].invalidate(db)
+    except:
+        watcher.files = snapshot  # Nothing was applied, so try again next time.
+        raise
+
+    if changed:
+        summary = "; ".join("{}: {}".format(filename, result) for filename, result in changed)
+        print("[RatFacts] Fact files changed.  " + summary)
+        if not initial and is_leader(bot):
+            bot.say("[RatFacts] Reloaded facts.  " + summary, bot.config.ratbot.debug_channel)
+    return results
 
-    # Import facts
-    # import_facts(bot)
+
+def task_watch_facts(bot):
+    watch_facts(bot)
 
 
 def load_fact_json(path, recurse=True):
@@ -151,21 +198,55 @@ def load_fact_json(path, recurse=True):
     return facts
 
 
+@interval(FactCache.CHECK_INTERVAL)
 @with_session
-def find_fact(bot, text, exact=False, db=None):
+def task_check_facts(bot, db=None):
+    """
+    Picks up fact changes made by other processes.
+    """
+    bot.memory['ratfacts']['cache'].check(db, force=True)
+
+
+def find_fact(bot, text, exact=False):
+    """
+    Finds a fact by name, or by name-lang, using the fact cache.
+
+    :param bot: Sopel instance
+    :param text: Fact name, optionally followed by a language specifier.
+    :param exact: If True, only searches the given language (or the default language if there is none) rather than
+        falling back to the configured language search order.
+    """
+    cache = bot.memory['ratfacts']['cache']
     lang_search = bot.memory['ratfacts']['lang']
 
-    fact = Fact.find(db, name=text, lang=lang_search[0] if exact else lang_search)
+    fact = cache.find(text, lang_search[0] if exact else lang_search)
     if fact:
         return fact
     if '-' in text:
         name, lang = text.rsplit('-', 1)
         if not exact:
             lang = [lang] + lang_search
-        return Fact.find(db, name=name, lang=lang)
+        return cache.find(name, lang)
     return None
 
 
+def suggest_facts(bot, trigger):
+    """
+    Tells the user about similarly named facts when they try to recite one that does not exist.
+
+    Stays quiet for commands that belong to other modules.
+    """
+    command = trigger.group(1).lower()
+    if command in (getattr(bot, 'doc', None) or {}):
+        return
+    suggestions = bot.memory['ratfacts']['cache'].suggest(command)
+    if suggestions:
+        bot.notice(
+            "No fact called '{}'.  Did you mean: {}?".format(command, ", ".join(suggestions)),
+            trigger.nick
+        )
+
+
 def format_fact(fact):
     return (
         "\x02{fact.name}-{fact.lang}\x02 - {fact.message} ({author})"
@@ -174,39 +255,44 @@ def format_fact(fact):
 
 
 @commands(r'[^\s]+')
+@require_leader
 def cmd_recite_fact(bot, trigger):
     """Recite facts"""
     fact = find_fact(bot, trigger.group(1))
     if not fact:
+        suggest_facts(bot, trigger)
         return NOLIMIT
 
-    multiple = False
-    lines = None
-
-    if len(fact.message) > 400:
-        multiple = True
-        lines = textwrap.wrap(fact.message, 400, break_long_words=False)
-
-    rats = trigger.group(2)
-    if rats:
-        # Reorganize the rat list for consistent & proper separation
-        # Split whitespace, comma, colon and semicolon (all common IRC multinick separators) then rejoin with commas
-        rats = ", ".join(filter(None, re.split(r"[,\s+]", rats))) or None
-        if multiple:
-            for l in lines:
-                bot.reply(l, reply_to=rats)
-            return
-        else:
-            return bot.reply(fact.message, reply_to=rats)
-    if multiple:
-        for l in lines:
-            bot.say(l)
-        return
+    # Reorganize the rat list for consistent & proper separation
+    # Split whitespace, comma and plus (all common IRC multinick separators); recite_fact rejoins them with commas
+    recite_fact(bot, fact, split_recipients(trigger.group(2)))
 
-    return bot.say(fact.message)
+
+def recite_fact(bot, fact, rats=None):
+    """
+    Recites a fact, optionally addressed to one or more rats.
+
+    The fact's lines are split ahead of time (see FactCache), and the fact is sent once however many rats there are.
+    Rats are addressed in as few groups as will fit on a line: all but the last group get a line of their own ahead of
+    the fact, and the last is addressed by each line of it, as a single rat would be.
+
+    :param bot: Sopel instance
+    :param fact: A CachedFact
+    :param rats: Sequence of nicknames to address.
+    """
+    if not rats:
+        for line in fact.lines:
+            bot.say(line)
+        return
+    groups = group_recipients(rats)
+    for group in groups[:-1]:
+        bot.say(group + ",")
+    for line in fact.lines:
+        bot.reply(line, reply_to=groups[-1])
 
 
 @commands('fact', 'facts')
+@require_leader
 @with_session
 def cmd_fact(bot, trigger, db=None):
     """
@@ -215,6 +301,7 @@ def cmd_fact(bot, trigger, db=None):
     !fact - Lists all known facts
     !fact FACT [full] - Shows detailed stats on the specified fact.  'full' dumps all translations to a PM.
     !fact LANGUAGE [full] - Shows detailed stats on the specified language.  'full' dumps all facts to a PM.
+    !fact search <terms> - Searches fact names and messages.
 
     The following commands require privileges:
     !fact import [-f] - Reimports JSON data.  -f overwrites existing rows.
@@ -231,25 +318,34 @@ def cmd_fact(bot, trigger, db=None):
 
     if not command:
         # List known facts.
-        unique_facts = list(Fact.unique_names(db))
+        unique_facts = bot.memory['ratfacts']['cache'].names()
         if not unique_facts:
             return bot.reply("Like Jon Snow, I know nothing.  (Or there's a problem with the fact database.)")
         line = "{} known fact(s): {}".format(len(unique_facts), ", ".join(unique_facts))
-        if len(line) > 400:
-            lines = textwrap.wrap(line, 400, break_long_words=False)
-            for l in lines:
-                bot.say(l)
-            return
-        return bot.say(line)
+        for l in split_message(line):
+            bot.say(l)
+        return
 
     @require_permission(Permissions.overseer)
     def cmd_fact_import(bot, trigger):
-        import_facts(bot, merge=(option == '-f'))
-        return bot.say("Facts imported.")
+        result = import_facts(bot, merge=(option == '-f'))
+        return bot.say("Facts imported: {}.".format(result) if result is not None else "No fact files configured.")
 
     if command == 'import':
         return cmd_fact_import(bot, trigger)
 
+    if command == 'search':
+        terms = " ".join(filter(None, (option, extra)))
+        if not terms:
+            bot.reply("Usage: !fact search <terms>")
+            return NOLIMIT
+        results = bot.memory['ratfacts']['cache'].search(terms, db=db)
+        if not results:
+            bot.reply("No facts found matching '{}'.".format(terms))
+            return NOLIMIT
+        bot.say("Facts matching '{}': {}".format(terms, ", ".join(name for name, score in results)))
+        return NOLIMIT
+
 
     @require_permission(Permissions.overseer)
     def cmd_fact_edit(bot, trigger):
@@ -271,12 +367,14 @@ def cmd_fact(bot, trigger, db=None):
             fact = db.merge(Fact(name=name, lang=lang, message=extra, author=str(trigger.nick)))
             is_new = not inspect(fact).persistent
             db.commit()
+            bot.memory['ratfacts']['cache'].invalidate(db)
             bot.reply(("Added " if is_new else "Updated ") + format_fact(fact))
             return NOLIMIT
         fact = Fact.find(db, name=name, lang=lang)
         if fact:
             db.delete(fact)
             db.commit()
+            bot.memory['ratfacts']['cache'].invalidate(db)
             bot.reply("Deleted " + format_fact(fact))
         else:
             bot.reply("No such fact.")
@@ -288,12 +386,12 @@ def cmd_fact(bot, trigger, db=None):
     def _translation_stats(exists, missing, s='translation', p='translations'):
         if exists:
             exists = "{count} {word} ({names})".format(
-                count=len(exists), word=s if len(exists) == 1 else p, names=", ".join(sorted(exists))
+                count=len(exists), word=s if len(exists) == 1 else p, names=", ".join(exists)
             )
         else:
             exists = "no " + p
         if missing:
-            missing = "missing {count} ({names})".format(count=len(missing), names=", ".join(sorted(missing)))
+            missing = "missing {count} ({names})".format(count=len(missing), names=", ".join(missing))
         else:
             missing = "none missing"
         return exists + ", " + missing
@@ -304,44 +402,25 @@ def cmd_fact(bot, trigger, db=None):
         ('name', 'lang', 'fact', 'translation', 'translations'),
         ('lang', 'name', 'language', 'fact', 'facts')
     ]:
-        if not db.query(Fact.query(db, order_by=False, **{attr: command}).exists()).scalar():
+        stats = bot.memory['ratfacts']['cache'].translation_stats(attr, command)
+        if stats is None:
             continue
-        sq = Fact.unique_query(db, field=getattr(Fact, opposite), order_by=False).subquery()
-        sq_opp = getattr(sq.c, opposite)
-        fact_opp = getattr(Fact, opposite)
-        fact_col = getattr(Fact, attr)
-
-        query = (
-            db.query(Fact, sq_opp)
-                .select_from(sq.outerjoin(Fact, (sq_opp == fact_opp) & (fact_col == command)))
-                .order_by(Fact.message.is_(None), sq_opp)
-        )
-        exists = set()
-        missing = set()
+        facts, missing = stats
         if full:
             if not trigger.is_privmsg:
                 bot.reply("Messaging you what I know about {} '{}'".format(name, command))
             pm("Fact search for {} '{}'".format(name, command))
-
-        for fact, key in query:
-            if fact and full:
+            for fact in facts:
                 pm(format_fact(fact))
-            (exists if fact else missing).add(key)
 
+        exists = [getattr(fact, opposite) for fact in facts]
         summary = (
             "{} '{}': ".format(name.title(), command) +
             _translation_stats(exists, missing, s=opposite_name_s, p=opposite_name_p)
         )
-        if full:
-            lines = textwrap.wrap(summary, 400, break_long_words=False)
-            for l in lines:
-                pm(l)
-            return NOLIMIT
-        else:
-            lines = textwrap.wrap(summary, 400, break_long_words=False)
-            for l in lines:
-                bot.say(l)
-            return NOLIMIT
+        for l in split_message(summary):
+            (pm if full else bot.say)(l)
+        return NOLIMIT
 
     bot.reply("'{}' is not a known fact, language, or subcommand".format(command))
     return NOLIMIT
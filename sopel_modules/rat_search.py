@@ -32,14 +32,18 @@ from sqlalchemy.orm.util import object_state
 
 from ratlib import timeutil
 import ratlib
+import ratlib.routing
 import ratlib.sopel
+import ratlib.spatial
 import ratlib.starsystem as rl_starsystem
 from ratlib.db import with_session, Starsystem, StarsystemPrefix, Landmark, get_status
+import ratlib.autocorrect
 from ratlib.autocorrect import correct
 import re
 from ratlib.api.names import require_permission, Permissions
 from ratlib.hastebin import post_to_hastebin
 from ratlib.util import timed
+from ratlib.replication import require_leader
 
 
 def configure(config):
@@ -50,17 +54,26 @@ def setup(bot):
     ratlib.sopel.setup(bot)
 
     bot.memory['ratbot']['searches'] = SopelMemory()
+    bot.memory['ratbot']['plots'] = {}  # id -> running plot, see cmd_plot
     bot.memory['ratbot']['systemFile'] = ratlib.sopel.makepath(bot.config.ratbot.workdir, 'systems.json')
 
     frequency = int(bot.config.ratbot.edsm_autorefresh or 0)
     if frequency > 0:
         interval(frequency)(task_sysrefresh)
 
+
+def shutdown(bot):
+    for plot in list(bot.memory['ratbot'].get('plots', {}).values()):
+        plot['cancel'].set()
+    ratlib.sopel.shutdown(bot)
+
 @commands('search')
 @example('!search lave', '')
+@require_leader
 def search(bot, trigger):
     """
-    Searches for system name matches. Recoded to pull from Systems API.
+    Searches for system name matches. Recoded to pull from Systems API, with the local starsystem database as a
+    fallback.
     """
 
     system = trigger.group(2)
@@ -83,8 +96,10 @@ def search(bot, trigger):
     if result.fixed:
         system_name += " (autocorrected)"
 
-    result = rl_starsystem.sysapi_query(bot, system, "smart")
+    result = rl_starsystem.search(bot, system)
     if result:
+        if result['meta'].get('source') == 'local':
+            system_name += " (Systems API unavailable, searched locally)"
         if "data" in result:
             row = result['data'][0]
             if 'distance' in row:
@@ -113,12 +128,14 @@ def refresh_time_stats(bot):
         return "No starsystem refresh stats are available."
     return (
         "Refresh took {total:.2f} seconds.  (Load: {load:.2f}, Prune: {prune:.2f}, Systems: {systems:.2f},"
-        " Prefixes: {prefixes:.2f}, Stats: {stats:.2f}, Optimize: {optimize:.2f}, Bloom: {bloom:.2f}, Misc: {misc:.2f})"
-        .format(**stats)
+        " Prefixes: {prefixes:.2f}, Stats: {stats:.2f}, Optimize: {optimize:.2f}, Bloom: {bloom:.2f},"
+        " Snapshot: {snapshot:.2f}, Spatial: {spatial:.2f}, Misc: {misc:.2f})"
+        .format(**dict({'snapshot': 0, 'spatial': 0}, **stats))
     )
 
 
 @commands('sysstats')
+@require_leader
 @with_session
 def cmd_sysstats(bot, trigger, db=None):
     """Diagnostics and statistics."""
@@ -128,7 +145,7 @@ def cmd_sysstats(bot, trigger, db=None):
             result = result.filter(*filters)
         return result.scalar()
 
-    all_options = {'count', 'bloom', 'refresh', 'all'}
+    all_options = {'count', 'bloom', 'refresh', 'spatial', 'autocorrect', 'all'}
     options = (set((trigger.group(2) or '').lower().split(' ')) & all_options) or {'count'}
     if 'all' in options:
         options = all_options
@@ -173,6 +190,24 @@ def cmd_sysstats(bot, trigger, db=None):
                 .format(k=bloom.k, m=bloom.m, pct=bloom.false_positive_chance(), numset=bloom.setbits, **stats)
             )
 
+    if 'autocorrect' in options:
+        stats = ratlib.autocorrect.cache.stats()
+        bot.say(
+            "Autocorrect cache: {size}/{maxsize} entries, {hits} hits, {misses} misses ({rate} hit rate),"
+            " {skipped} lines skipped by the pre-filter."
+            .format(rate="-" if stats['hit_rate'] is None else "{:.1%}".format(stats['hit_rate']), **stats)
+        )
+
+    if 'spatial' in options:
+        stats = bot.memory['ratbot']['stats'].get('spatial')
+        if not stats:
+            bot.say("Spatial index stats are unavailable.")
+        else:
+            bot.say(
+                "Spatial index built in {time:.2f} seconds: {landmarks} landmarks, {systems} starsystems."
+                .format(**dict(stats, systems=stats['systems'] if stats['systems'] is not None else "no"))
+            )
+
 
 def task_sysrefresh(bot):
     try:
@@ -182,6 +217,7 @@ def task_sysrefresh(bot):
 
 
 @commands('sysrefresh')
+@require_leader
 @with_session
 def cmd_sysrefresh(bot, trigger, db=None):
     """
@@ -226,6 +262,7 @@ def cmd_sysrefresh(bot, trigger, db=None):
 
 
 @commands('scan')
+@require_leader
 def cmd_scan(bot, trigger):
     """
     Used for system name detection testing.
@@ -243,24 +280,39 @@ def cmd_scan(bot, trigger):
 
 @commands('plot')
 @require_permission(Permissions.rat)
-# @rate(60 * 30)
 @with_session
 def cmd_plot(bot, trigger, db=None):
     """
     Usage: !plot <sys1> to <sys2>
-            This function has a limit of once per 30 minutes per person as it is a taxing calculation.
-            Plots a route from sys1 to sys2 with waypoints every 1000 Lightyears. It only calculates these waypoints,
+           !plot cancel
+            Plots a route from sys1 to sys2 with waypoints every 990 Lightyears. It only calculates these waypoints,
             so some waypoints MAY be unreachable, but it should be suitable for most of the Milky way, except when
-            crossing outer limbs.
+            crossing outer limbs.  "!plot cancel" stops your running plots.
     """
-    bot.say("This function has been superseded by improvements in the in-game route plotter, and Spansh's neutron plotter https://spansh.co.uk/plotter")
-    return NOLIMIT
-
     maxdistance = 990
+    line = (trigger.group(2) or '').strip()
+    plots = bot.memory['ratbot']['plots']
+
+    if line.lower() == 'cancel':
+        cancelled = []
+        for plot in list(plots.values()):
+            if plot['nick'] == trigger.nick:
+                plot['cancel'].set()
+                cancelled.append("{jumps} jumps in, {remaining:.2f} LY remaining".format(**plot))
+        bot.reply(
+            "Cancelling {} plot(s): {}".format(len(cancelled), "; ".join(cancelled)) if cancelled
+            else "You have no plots running."
+        )
+        return NOLIMIT
+
+    index = ratlib.spatial.get_index(bot, 'systems')
+    if index is None:
+        bot.reply(
+            "Plotting is unavailable; starsystem coordinates are not loaded.  In the meantime, try Spansh's neutron"
+            " plotter: https://spansh.co.uk/plotter"
+        )
+        return NOLIMIT
 
-    # if not trigger._is_privmsg:
-    #     bot.say("This command is spammy, please use it in a private message.")
-    #     return NOLIMIT
     locked = False
     try:
         locked = bot.memory['ratbot']['plots_available'].acquire(blocking=False)
@@ -271,8 +323,6 @@ def cmd_plot(bot, trigger, db=None):
             )
             return NOLIMIT
 
-
-        line = (trigger.group(2) or '').strip()
         if line.startswith('-b'):
             # Batched mode is no longer implemented, (all plots are batched) but discard it to not break parsing.
             line = line[2:].strip()
@@ -308,37 +358,45 @@ def cmd_plot(bot, trigger, db=None):
             " to {target.name} ({target.x:.2f}, {target.y:.2f}, {target.z:.2f}) (Total distance: {ly:.2f} LY)"
             .format(source=source, target=target, ly=distance)
         )
-
         bot.reply(banner)
 
+        plot = {'nick': trigger.nick, 'cancel': threading.Event(), 'jumps': 0, 'remaining': distance}
+        endpoints = [(system.eddb_id, (system.x, system.y, system.z)) for system in systems]
+        source_name, target_name = source.name, target.name
+
+        def progress(waypoint):
+            plot['jumps'] += 1 if waypoint.distance else 0
+            plot['remaining'] = waypoint.remaining
+
         def task():
             with timed() as t:
-                db = ratlib.db.get_session(bot)
-                stmt = sql.select([
-                    sql.column('eddb_id'),
-                    sql.column('distance'),
-                    sql.column('remaining'),
-                    sql.column('final'),
-                ]).select_from(sql.func.find_route(source.eddb_id, target.eddb_id, maxdistance)).alias()
-                query = (
-                    db.query(Starsystem, stmt.c.distance, stmt.c.remaining, stmt.c.final)
-                    .join(stmt, Starsystem.eddb_id == stmt.c.eddb_id)
-                    .order_by(stmt.c.remaining.desc())
+                try:
+                    result = ratlib.routing.plan_route(
+                        index, endpoints[0], endpoints[1], maxdistance, cancel=plot['cancel'], progress=progress
+                    )
+                except ratlib.routing.PlotCancelled as ex:
+                    return "Plot from {} to {} cancelled after {} jumps.".format(
+                        source_name, target_name, len(ex.waypoints) - 1
+                    )
+            with ratlib.db.session_scope(bot, 'rat_search:cmd_plot') as db:
+                names = dict(
+                    db.query(Starsystem.eddb_id, Starsystem.name)
+                    .filter(Starsystem.eddb_id.in_({row.eddb_id for row in result}))
                 )
-                result = query.all()
-                text = [banner, '']
-
-                sysline_fmt = "{jump:5}: {sys.name:30}  ({sys.x:.2f}, {sys.y:.2f}, {sys.z:.2f})"
-                travel_fmt = "       -> (jump {distance:.2f} LY; {remaining:.2f} LY remaining)"
-
-                for jump, row in enumerate(result):
-                    if not jump:
-                        jump = "START"
-                    else:
-                        text.append(travel_fmt.format(distance=row.distance, remaining=row.remaining))
-                        if row.final:
-                            jump = "  END"
-                    text.append(sysline_fmt.format(jump=jump, sys=row.Starsystem))
+            text = [banner, '']
+
+            sysline_fmt = "{jump:5}: {name:30}  ({x:.2f}, {y:.2f}, {z:.2f})"
+            travel_fmt = "       -> (jump {distance:.2f} LY; {remaining:.2f} LY remaining)"
+
+            for jump, row in enumerate(result):
+                if not jump:
+                    jump = "START"
+                else:
+                    text.append(travel_fmt.format(distance=row.distance, remaining=row.remaining))
+                    if row.final:
+                        jump = "  END"
+                x, y, z = row.location
+                text.append(sysline_fmt.format(jump=jump, name=names.get(row.eddb_id, '<unknown>'), x=x, y=y, z=z))
             success = result[-1].final
             elapsed = timeutil.format_timedelta(t.delta)
             text.append('')
@@ -350,15 +408,10 @@ def cmd_plot(bot, trigger, db=None):
             url = post_to_hastebin(text, bot.config.ratbot.hastebin_url or "http://hastebin.com/") + ".txt"
 
             if success:
-                return (
-                    "Plot from {source.name} to {target.name} completed: {url}"
-                    .format(source=source, target=target, url=url)
-                )
+                return "Plot from {} to {} completed: {}".format(source_name, target_name, url)
             else:
-                return (
-                    "Plot from {source.name} to {target.name} failed, partial results at: {url}"
-                    .format(source=source, target=target, url=url)
-                )
+                return "Plot from {} to {} failed, partial results at: {}".format(source_name, target_name, url)
+
         def task_done(future):
             try:
                 try:
@@ -367,13 +420,16 @@ def cmd_plot(bot, trigger, db=None):
                     result = str(ex)
                 bot.reply(result)
             finally:
+                plots.pop(id(plot), None)
                 bot.memory['ratbot']['plots_available'].release()
 
         try:
             locked = False
-            future = bot.memory['ratbot']['executor'].submit(task)
+            plots[id(plot)] = plot
+            future = bot.memory['ratbot']['executor'].schedule('routing', task)
             future.add_done_callback(task_done)
         except:
+            plots.pop(id(plot), None)
             locked = True
             raise
 
@@ -14,6 +14,7 @@ from sopel.module import commands
 import ratlib.sopel
 from ratlib.api.http import ShortenerError, Shortener
 from ratlib.sopel import parameterize
+from ratlib.replication import require_leader
 
 
 ## Start Config Section ##
@@ -50,6 +51,7 @@ def setup(bot):
 
 
 @commands('short','shortener','shorten')
+@require_leader
 @parameterize("ww","<url to shorten> [keyword]")
 def shorten_cmd(bot, trigger, url, keyword=None):
     """
@@ -45,6 +45,10 @@ defer.setDebugging(True)
 # ratlib imports
 import ratlib.api.http
 from ratlib.api.names import *
+from ratlib.api.quotes import QuoteDelta
+from ratlib.scheduler import Priority
+from ratlib import replication
+from ratlib.replication import require_leader
 
 urljoin = ratlib.api.http.urljoin
 
@@ -79,6 +83,8 @@ def shutdown(bot=None):
     # Ignored by sopel?!?!?! - Sometimes.
     print('[Websocket] shutdown for socket')
     reactor.stop()
+    if bot is not None:
+        ratlib.sopel.shutdown(bot)
 
 
 
@@ -142,6 +148,7 @@ class Socket:
 
 
 @commands('reconnect')
+@require_leader
 @ratlib.sopel.filter_output
 def sockettest(bot, trigger):
     """
@@ -187,7 +194,8 @@ class MyClientProtocol(WebSocketClientProtocol):
 
     def onClose(self, wasClean, code, reason):
         # print('onclose')
-        MyClientProtocol.bot.say('[RatTracker] Lost connection to RatTracker! Trying to reconnect...')
+        if replication.is_leader(MyClientProtocol.bot):
+            MyClientProtocol.bot.say('[RatTracker] Lost connection to RatTracker! Trying to reconnect...')
         MyClientProtocol.bot.say('[Websocket] Closed connection with Websocket. Reason: ' + str(reason), MyClientProtocol.debug_channel)
         WebSocketClientProtocol.onClose(self, wasClean, code, reason)
 
@@ -214,6 +222,9 @@ def handleWSMessage(payload, senderinstance):
         print("[Websocket] Couldn't get data or action - Ignoring Websocket Event.")
         return
 
+    if not replication.is_leader(bot):
+        return  # The leader announces it and saves the case; its board changes reach us through replication.
+
 
     def filterClient(bot, data):
         resId = data.get('RescueID') or data.get('rescueID') or data.get('RescueId') or data.get(
@@ -483,7 +494,12 @@ def save_case(bot, rescue, forceFull=False):
         method = "POST"
 
     def task():
-        result = callapi(bot, method, uri, data=convertV1RescueToV2(data))
+        with rescue.save_lock:  # See rat_board.save_case
+            if isinstance(data.get('quotes'), QuoteDelta):
+                # Older quotes aren't in memory, so combine our changes with what the API has.  See rat_board.save_case
+                current = callapi(bot, 'GET', '/rescues/' + rescue.id)
+                data['quotes'] = data['quotes'].apply(current['data'][0]['attributes']['quotes'] or [])
+            result = callapi(bot, method, uri, data=convertV1RescueToV2(data))
         rescue.commit()
         try:
             addNamesFromV2Response(result['included'])
@@ -496,7 +512,8 @@ def save_case(bot, rescue, forceFull=False):
             rescue.refresh(result['data'][0])
         return rescue
 
-    return bot.memory['ratbot']['executor'].submit(task)
+    priority = Priority.URGENT if rescue.codeRed else Priority.NORMAL
+    return bot.memory['ratbot']['executor'].schedule('interactive', task, priority=priority)
 
 
 class MyClientFactory(ReconnectingClientFactory, WebSocketClientFactory):
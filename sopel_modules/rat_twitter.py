@@ -23,7 +23,7 @@ from sopel.module import commands
 from twitter import TwitterError
 
 import ratlib.sopel
-from ratlib import starsystem
+from ratlib import starsystem, sensitive
 from ratlib.api.names import Permissions, require_permission
 from ratlib.sopel import parameterize
 
@@ -140,16 +140,9 @@ def cmd_tweet(bot, trigger, line):
         bot.reply("Tweets need to be at least 5 characters long. Did you mean to use !tweetcase?")
         return
 
-    board = bot.memory['ratbot']['board']
-
-    lowerline = line.lower()
-
-    for rescue in board.rescues:
-        with board.change(rescue):
-            if(rescue.client_name.lower() in lowerline or (rescue.system and rescue.system.lower() in lowerline)):
-                bot.say('Tweet not sent - do not give out client information in tweets. Try again.')
-                return
-            pass
+    if sensitive.scan(bot, line):
+        bot.say('Tweet not sent - do not give out client information in tweets. Try again.')
+        return
 
     if debug:
         bot.say('Tweet debug: "{}"'.format(line))